@@ -1,16 +1,95 @@
 import os
 import sys
 import hpackagelib
+import hpackagetrace
 import settings
+
+if __name__ == "__main__" and getattr(sys, "frozen", False):
+    # a frozen installer starts its precompile workers by running this executable again. freeze_support runs the
+    # worker and exits when that's the case, before any of the installer itself starts.
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+if __name__ == "__main__" and "--headless" in sys.argv:
+    # headless installs never need Qt, so hand off to the command line installer before PySide6 gets imported.
+    import hpackagecli
+    sys.argv.remove("--headless")
+    sys.exit(hpackagecli.main())
+
 from PySide6 import QtWidgets, QtGui, QtCore
 import logging
+import threading
 import traceback
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s', level=logging.DEBUG, filename=os.path.join(os.path.expanduser("~"), "hpackage.log"), filemode="w", datefmt="%Y/%m/%d %H:%M:%S")
 
 # TODO: if user doesn't want package files copied elsewhere, don't run shutil
 
+
+class InstallWorker(QtCore.QThread):
+    """
+    Runs hpackagelib.install_package (or install_packages, for a bundle) off the GUI thread and reports progress
+    through signals.
+    """
+    progress = QtCore.Signal(object)
+    succeeded = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+    def __init__(self, configs, package, destination, payload, specs=None, parent=None):
+        super(InstallWorker, self).__init__(parent)
+        self.configs = configs
+        self.package = package
+        self.destination = destination
+        self.payload = payload
+        self.specs = specs
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        logging.info("User cancelled installation.")
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            if self.specs:
+                result = hpackagelib.install_packages(self.configs, self.specs, self.destination, debug=settings.DEBUG,
+                                                      progress=self.progress.emit, cancel=self.cancel_event)
+            else:
+                result = hpackagelib.install_package(self.configs, package=self.package,
+                                                     destination=self.destination, payload=self.payload,
+                                                     debug=settings.DEBUG, progress=self.progress.emit,
+                                                     cancel=self.cancel_event)
+        except hpackagelib.InstallCancelled:
+            self.cancelled.emit()
+            return
+        except Exception:
+            logging.error("Unexpected error during installation!")
+            logging.error(traceback.format_exc())
+            self.failed.emit(traceback.format_exc())
+            return
+        self.succeeded.emit(result)
+
+
+class DiscoveryWorker(QtCore.QThread):
+    """
+    Finds the Houdini configurations, the payload and the default install path off the GUI thread, so the window
+    can paint before a slow or disconnected network home directory has been scanned. Also loads the splash image.
+    """
+    config_found = QtCore.Signal(str)
+    payload_found = QtCore.Signal(object, str)
+    image_loaded = QtCore.Signal(QtGui.QImage)
+
+    def run(self):
+        with hpackagetrace.span("ui_discovery"):
+            # QImage (unlike QPixmap) can be loaded outside the GUI thread.
+            self.image_loaded.emit(QtGui.QImage(hpackagelib.get_resource(settings.IMAGE)))
+            hpackagelib.get_houdini_prefs_paths(found=self.config_found.emit)
+            if self.isInterruptionRequested():
+                return
+            payload = hpackagelib.find_payload_path()
+            self.payload_found.emit(payload, hpackagelib.get_default_install_path())
+
+
 class HPackageUI(QtWidgets.QMainWindow):
     def __init__(self, parent=None):
         super(HPackageUI, self).__init__(parent)
@@ -29,10 +108,8 @@ class HPackageUI(QtWidgets.QMainWindow):
         intro_dialog = QtWidgets.QFrame()
         intro_layout = QtWidgets.QHBoxLayout()
         intro_dialog.setLayout(intro_layout)
-        intro_image = QtGui.QImage(hpackagelib.get_resource(settings.IMAGE))
-        intro_map = QtGui.QPixmap(intro_image)
+        # the splash image is loaded by the discovery worker.
         intro_label_image = QtWidgets.QLabel()
-        intro_label_image.setPixmap(intro_map)
         intro_image_layout = QtWidgets.QVBoxLayout()
         intro_image_layout.addWidget(intro_label_image)
         intro_image_layout.addStretch()
@@ -54,9 +131,23 @@ class HPackageUI(QtWidgets.QMainWindow):
         configs_text.setMaximumWidth(settings.LABELWIDTH)
         configs_text.setWordWrap(True)
         configs_layout.addWidget(configs_text)
+        # a bundle lets the user pick which of its packages to install.
+        packages_list = QtWidgets.QListWidget()
+        for spec in hpackagelib.get_package_specs() if settings.PACKAGES else list():
+            item = QtWidgets.QListWidgetItem(spec["NAME"])
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Checked)
+            packages_list.addItem(item)
+        packages_label = QtWidgets.QLabel("Packages to install:")
+        configs_layout.addWidget(packages_label)
+        configs_layout.addWidget(packages_list)
+        packages_label.setVisible(bool(settings.PACKAGES))
+        packages_list.setVisible(bool(settings.PACKAGES))
         # multilist for houdini installations
         configs_list = QtWidgets.QListWidget()
         configs_layout.addWidget(configs_list)
+        configs_searching = QtWidgets.QLabel("Searching for Houdini configurations...")
+        configs_layout.addWidget(configs_searching)
 
         """ destination dialog """
         dest_dialog = QtWidgets.QFrame()
@@ -67,17 +158,8 @@ class HPackageUI(QtWidgets.QMainWindow):
         dest_label.setWordWrap(True)
         dest_layout.addWidget(dest_label)
         dest_chooser = QtWidgets.QLineEdit()
-        # default path for installation is different if we're dealing with an exe with an embedded payload.
-        try:
-            payload_path = os.path.join(sys._MEIPASS, 'payload')
-            # if this doesn't throw an exception, the payload is embedded
-            default_path = os.path.join(os.path.expanduser("~"), settings.NAME)
-        except Exception:
-            default_path = hpackagelib.find_payload_path()
-            if not default_path:
-                default_path = os.path.join(os.path.expanduser("~"), settings.NAME)
-
-        dest_chooser.setText(default_path)
+        # default path for installation is different if we're dealing with an exe with an embedded payload. it's
+        # filled in by the discovery worker, since finding the payload can mean walking up a network path.
         dest_btn = QtWidgets.QPushButton("...")
         dest_ctrl_layout = QtWidgets.QHBoxLayout()
         dest_ctrl_layout.addWidget(dest_chooser)
@@ -96,6 +178,13 @@ class HPackageUI(QtWidgets.QMainWindow):
         confs_list.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
         ok_layout.addWidget(confs_label)
         ok_layout.addWidget(confs_list)
+        pkgs_label = QtWidgets.QLabel("These packages will be installed:")
+        pkgs_list = QtWidgets.QListWidget()
+        pkgs_list.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        ok_layout.addWidget(pkgs_label)
+        ok_layout.addWidget(pkgs_list)
+        pkgs_label.setVisible(bool(settings.PACKAGES))
+        pkgs_list.setVisible(bool(settings.PACKAGES))
         dest_label = QtWidgets.QLabel("The package files will be installed to this location:")
         dest_path_label = QtWidgets.QLabel()
         ok_layout.addWidget(dest_label)
@@ -104,18 +193,36 @@ class HPackageUI(QtWidgets.QMainWindow):
         ok_layout.addStretch()
         ok_layout.addWidget(conf_label)
 
+        """ install progress dialog """
+        install_dialog = QtWidgets.QFrame()
+        install_layout = QtWidgets.QVBoxLayout()
+        install_dialog.setLayout(install_layout)
+        install_label = QtWidgets.QLabel("Installing package files...")
+        install_progress = QtWidgets.QProgressBar()
+        # progress is tracked in tenths of a percent of the total bytes, which fits in the bar's int range.
+        install_progress.setRange(0, 1000)
+        install_status = QtWidgets.QLabel()
+        install_cancel = QtWidgets.QPushButton("Cancel")
+        install_cancel_layout = QtWidgets.QHBoxLayout()
+        install_cancel_layout.addStretch()
+        install_cancel_layout.addWidget(install_cancel)
+        install_layout.addWidget(install_label)
+        install_layout.addWidget(install_progress)
+        install_layout.addWidget(install_status)
+        install_layout.addLayout(install_cancel_layout)
+        install_layout.addStretch()
+
         """ result dialog """
         result_dialog = QtWidgets.QFrame()
         result_layout = QtWidgets.QHBoxLayout()
         result_image = QtWidgets.QLabel()
-        result_image.setPixmap(intro_map)
         result_image_layout = QtWidgets.QVBoxLayout()
         result_image_layout.addWidget(result_image)
         result_image_layout.addStretch()
         result_layout.addLayout(result_image_layout)
         result_label_layout = QtWidgets.QVBoxLayout()
         result_label = QtWidgets.QLabel(settings.SUCCESS)
-        log_label = QtWidgets.QLabel("Installation log saved to: {}".format(os.path.join(os.path.expanduser("~"), "hpackage.log")))
+        log_label = QtWidgets.QLabel("Installation log saved to: {}".format(hpackagetrace.LOG_PATH))
         result_label.setMaximumWidth(settings.LABELWIDTH)
         result_label.setWordWrap(True)
         result_label_layout.addWidget(result_label)
@@ -139,6 +246,7 @@ class HPackageUI(QtWidgets.QMainWindow):
         main_layout.addWidget(configs_dialog)
         main_layout.addWidget(dest_dialog)
         main_layout.addWidget(ok_dialog)
+        main_layout.addWidget(install_dialog)
         main_layout.addWidget(result_dialog)
         main_layout.addLayout(btns_layout)
 
@@ -151,22 +259,33 @@ class HPackageUI(QtWidgets.QMainWindow):
 
         self.setCentralWidget(main_dialog)
 
-        dialogs = [intro_dialog, configs_dialog, dest_dialog, ok_dialog, ok_dialog, result_dialog]
+        dialogs = [intro_dialog, configs_dialog, dest_dialog, ok_dialog, install_dialog, result_dialog]
 
         # persistent data
         self.data = {
             "state": 0,
             "aborted": False,
+            "worker": None,
+            "discovery": None,
+            "painted": False,
+            "payload": None,
             "dialogs": dialogs,
-            "default_path": default_path,
+            "default_path": None,
             "controls": {
                 "prev": prev_btn,
                 "next": next_btn,
                 "finish": finish_btn,
                 "configs": configs_list,
+                "packages": packages_list,
+                "configs_searching": configs_searching,
+                "images": [intro_label_image, result_image],
                 "destination": dest_chooser,
                 "confirmation": confs_list,
-                "confirmation_dest": dest_path_label
+                "confirmation_packages": pkgs_list,
+                "confirmation_dest": dest_path_label,
+                "install_progress": install_progress,
+                "install_status": install_status,
+                "install_cancel": install_cancel
             }
         }
 
@@ -175,13 +294,21 @@ class HPackageUI(QtWidgets.QMainWindow):
         prev_btn.clicked.connect(self.prev_state)
         dest_btn.clicked.connect(self.pick_install_path)
         finish_btn.clicked.connect(self.success)
+        install_cancel.clicked.connect(self.cancel_install)
+        packages_list.itemChanged.connect(self.state_changed)
 
         self.refresh()
 
     def refresh(self):
         self.state_changed()
-        self.get_configs()
         self.show()
+        self.get_configs()
+
+    def paintEvent(self, event):
+        super(HPackageUI, self).paintEvent(event)
+        if not self.data["painted"]:
+            self.data["painted"] = True
+            logging.info("Time to first paint: {:.3f} s".format(hpackagetrace.mark("first_paint", category="ui")))
 
     def next_state(self):
         self.data["state"] += 1
@@ -203,6 +330,13 @@ class HPackageUI(QtWidgets.QMainWindow):
             self.data["controls"]["prev"].setEnabled(False)
         else:
             self.data["controls"]["prev"].setEnabled(True)
+        if self.data["state"] == 1:
+            # the configuration list isn't complete until discovery has finished, and a bundle needs at least one
+            # package picked.
+            self.data["controls"]["next"].setEnabled(self.data["discovery"] is None and
+                                                     (not settings.PACKAGES or bool(self.get_selected_packages())))
+        elif self.data["state"] < 4:
+            self.data["controls"]["next"].setEnabled(True)
         if self.data["state"] == 2:
             pass
         if self.data["state"] == 3:
@@ -219,16 +353,49 @@ class HPackageUI(QtWidgets.QMainWindow):
         self.adjustSize()
 
     def get_configs(self):
-        # get all houdini config dirs.
-        configs = hpackagelib.get_houdini_prefs_paths()
-        # clear existing widget.
-        widget = self.data["controls"]["configs"]
-        widget.clear()
-        for c in configs:
-            item = QtWidgets.QListWidgetItem(str(c))
-            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
-            item.setCheckState(QtCore.Qt.Checked)
-            widget.addItem(item)
+        # find all houdini config dirs, the payload and the default install path in the background.
+        self.data["controls"]["configs"].clear()
+        self.data["controls"]["configs_searching"].setVisible(True)
+        worker = DiscoveryWorker(self)
+        worker.config_found.connect(self.add_config)
+        worker.payload_found.connect(self.payload_found)
+        worker.image_loaded.connect(self.image_loaded)
+        worker.finished.connect(self.discovery_finished)
+        self.data["discovery"] = worker
+        self.state_changed()
+        worker.start()
+
+    def add_config(self, config):
+        item = QtWidgets.QListWidgetItem(str(config))
+        item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+        item.setCheckState(QtCore.Qt.Checked)
+        self.data["controls"]["configs"].addItem(item)
+
+    def payload_found(self, payload, default_path):
+        self.data["payload"] = payload
+        self.data["default_path"] = default_path
+        # don't overwrite a path the user already typed in.
+        if not self.data["controls"]["destination"].text():
+            self.data["controls"]["destination"].setText(default_path)
+
+    def image_loaded(self, image):
+        pixmap = QtGui.QPixmap.fromImage(image)
+        for label in self.data["controls"]["images"]:
+            label.setPixmap(pixmap)
+        self.adjustSize()
+
+    def discovery_finished(self):
+        logging.info("Found {} Houdini configurations.".format(self.data["controls"]["configs"].count()))
+        self.data["discovery"] = None
+        self.data["controls"]["configs_searching"].setVisible(False)
+        self.state_changed()
+
+    def stop_discovery(self):
+        # the thread can't be torn down while it's running, so let it finish the directory it's scanning.
+        worker = self.data["discovery"]
+        if worker is not None:
+            worker.requestInterruption()
+            worker.wait()
 
     def pick_install_path(self):
         # get the path to install to from the user.
@@ -255,13 +422,26 @@ class HPackageUI(QtWidgets.QMainWindow):
                 configs.append(confs_widget.item(x).text())
         return configs
 
+    def get_selected_packages(self):
+        # get the names of all selected packages of a bundle.
+        names = list()
+        packages_widget = self.data["controls"]["packages"]
+        for x in range(packages_widget.count()):
+            if packages_widget.item(x).checkState() == QtCore.Qt.Checked:
+                names.append(packages_widget.item(x).text())
+        return names
+
     def load_confs_list(self):
-        # populate the configurations list for confirmation.
+        # populate the configurations and packages lists for confirmation.
         widget = self.data["controls"]["confirmation"]
         widget.clear()
         configs = self.get_selected_configs()
         for c in configs:
             widget.addItem(c)
+        widget = self.data["controls"]["confirmation_packages"]
+        widget.clear()
+        for name in self.get_selected_packages():
+            widget.addItem(name)
 
     def get_user_payload_path(self):
         # if we can't find the payload relative to the current directory, prompt the user.
@@ -294,12 +474,12 @@ class HPackageUI(QtWidgets.QMainWindow):
 
     def fail(self):
         # appears when installation has failed for whatever reason.
-        ret = QtWidgets.QMessageBox.critical(self, "Installation failed!", "Installation failed. Please see the log at {} for details.".format(os.path.join(os.path.expanduser("~"), "hpackage.log")))
+        ret = QtWidgets.QMessageBox.critical(self, "Installation failed!", "Installation failed. Please see the log at {} for details.".format(hpackagetrace.LOG_PATH))
         app.quit()
 
     def success(self):
         # appears when normal installation is completed.
-        # ret = QtWidgets.QMessageBox.information(self, "Installation complete", "Installation complete. See installation log at {} for details.".format(os.path.join(os.path.expanduser("~"), "hpackage.log")))
+        # ret = QtWidgets.QMessageBox.information(self, "Installation complete", "Installation complete. See installation log at {} for details.".format(hpackagetrace.LOG_PATH))
         app.quit()
 
     def do_install(self):
@@ -308,26 +488,84 @@ class HPackageUI(QtWidgets.QMainWindow):
         # if destination == self.data["default_path"]:
         #     destination = None
         package = hpackagelib.find_package_path()
-        payload = hpackagelib.find_payload_path()
+        payload = self.data["payload"]
+        specs = None
+        if settings.PACKAGES:
+            # each package of a bundle finds its own payload.
+            specs = hpackagelib.get_package_specs(self.get_selected_packages())
+            package = None
         # if we can't find the payload, we need to prompt the user.
-        if not payload:
+        elif not payload:
             logging.warning("Payload path not found. Prompting user for path.")
             while self.data["aborted"] is False and payload is None:
                 payload = self.get_user_payload_path()
-        if not payload:
+        if not payload and not specs:
             # fail the installation.
             logging.error("Installation failed!")
             self.fail()
-        try:
-            hpackagelib.install_package(configs, package=package, destination=destination, payload=payload, debug=settings.DEBUG)
-        except Exception:
-            logging.error("Unexpected error during installation!")
-            logging.error(traceback.format_exc())
-            self.fail()
+            return
+        self.data["controls"]["install_progress"].setValue(0)
+        self.data["controls"]["install_status"].setText("")
+        self.data["controls"]["install_cancel"].setEnabled(True)
+        worker = InstallWorker(configs, package, destination, payload, specs=specs, parent=self)
+        worker.progress.connect(self.install_progress)
+        worker.succeeded.connect(self.install_succeeded)
+        worker.failed.connect(self.install_failed)
+        worker.cancelled.connect(self.install_cancelled)
+        self.data["worker"] = worker
+        worker.start()
+
+    def install_progress(self, progress):
+        # update the progress bar and throughput readout from the install worker.
+        if progress["bytes_total"]:
+            self.data["controls"]["install_progress"].setValue(int(1000 * progress["bytes_done"] / progress["bytes_total"]))
+        eta = "{:.0f} s".format(progress["eta"]) if progress["eta"] is not None else "--"
+        self.data["controls"]["install_status"].setText(
+            "{} / {} files, {:.1f} / {:.1f} MB at {:.1f} MB/s, {} remaining".format(
+                progress["files_done"], progress["files_total"], progress["bytes_done"] / 1048576.0,
+                progress["bytes_total"] / 1048576.0, progress["rate"] / 1048576.0, eta))
+
+    def cancel_install(self):
+        worker = self.data["worker"]
+        if worker is not None:
+            self.data["controls"]["install_cancel"].setEnabled(False)
+            self.data["controls"]["install_status"].setText("Cancelling...")
+            worker.cancel()
+
+    def install_succeeded(self, result):
+        self.data["worker"] = None
+        self.data["controls"]["install_progress"].setValue(1000)
         self.next_state()
 
+    def install_failed(self, error):
+        self.data["worker"] = None
+        self.fail()
+
+    def install_cancelled(self):
+        # go back to the confirmation page, so the user can try again or close the installer.
+        self.data["worker"] = None
+        QtWidgets.QMessageBox.information(self, "Installation cancelled", "The installation was cancelled. Files that were already copied were left in place.")
+        self.data["state"] = 3
+        self.data["controls"]["next"].setEnabled(True)
+        self.state_changed()
+
+    def closeEvent(self, event):
+        # don't leave a copy running in the background when the window is closed.
+        worker = self.data["worker"]
+        if worker is not None:
+            worker.cancel()
+            worker.wait()
+        self.stop_discovery()
+        super(HPackageUI, self).closeEvent(event)
+
 
 if __name__ == "__main__":
+    finish_trace = hpackagetrace.start()
     app = QtWidgets.QApplication(sys.argv)
     ui = HPackageUI()
+    if os.environ.get("HPACKAGE_STARTUP_PROBE"):
+        # hpackagemaker times cold starts by launching the installer with this set; quit once the window is up.
+        QtCore.QTimer.singleShot(0, app.quit)
     app.exec()
+    ui.stop_discovery()
+    finish_trace()
@@ -0,0 +1,277 @@
+"""
+Benchmarks for the install and build hot paths.
+
+Generates a synthetic payload (many tiny files, a few large files, a deep tree) and a home directory full of fake
+Houdini configurations, times the hot paths and writes the results to JSON. A previous result file can be passed
+as a baseline to fail the run when any benchmark gets slower than the allowed threshold.
+
+Examples:
+    python hpackagebench.py --output bench.json
+    python hpackagebench.py --large-files 2 --large-size 2048 --output bench.json
+    python hpackagebench.py --baseline bench.json --threshold 0.25
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import hpackagelib
+import hpackagepack
+import settings
+
+# block of random data that large files are built from, so generating them doesn't spend all its time in urandom.
+BLOCK = os.urandom(1024 * 1024)
+
+
+def generate_payload(root, tiny_files=10000, tiny_size=2048, large_files=2, large_size=256, depth=12, fanout=8):
+    """
+    Create a synthetic payload.
+    :param root: the payload root to create.
+    :param tiny_files: the number of small files, spread over a tree of directories.
+    :param tiny_size: the size of each small file in bytes.
+    :param large_files: the number of large files.
+    :param large_size: the size of each large file in MB.
+    :param depth: the depth of the deepest directory chain.
+    :param fanout: the number of sibling directories per level for the small files.
+    :return: the total number of bytes written.
+    """
+    total = 0
+    os.makedirs(os.path.join(root, "otls"), exist_ok=True)
+    dirs = [os.path.join(root, "python3.11libs", "pkg{}".format(i)) for i in range(fanout)]
+    deep = os.path.join(root, "scripts", *["level{}".format(i) for i in range(depth)])
+    dirs.append(deep)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    for i in range(tiny_files):
+        ext = (".py", ".hda", ".png", ".json")[i % 4]
+        d = dirs[i % len(dirs)] if ext != ".hda" else os.path.join(root, "otls")
+        # vary the contents so files don't all deduplicate to one object.
+        data = ("{:08d}".format(i) * (tiny_size // 8 + 1))[:tiny_size].encode()
+        with open(os.path.join(d, "file{}{}".format(i, ext)), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    os.makedirs(os.path.join(root, "geo"), exist_ok=True)
+    for i in range(large_files):
+        with open(os.path.join(root, "geo", "large{}.bgeo.sc".format(i)), 'wb') as f:
+            for _ in range(large_size):
+                f.write(BLOCK)
+            # make each large file unique.
+            f.write("{}".format(i).encode())
+        total += large_size * len(BLOCK) + len(str(i))
+    return total
+
+
+def generate_configs(home, count=30, noise=200):
+    """
+    Create a fake home directory with Houdini configuration directories and unrelated entries.
+    """
+    for i in range(count):
+        os.makedirs(os.path.join(home, "houdini{}.{}".format(17 + i // 3, (i % 3) * 5)), exist_ok=True)
+    for i in range(noise):
+        with open(os.path.join(home, "dotfile{}".format(i)), 'w') as f:
+            f.write("x")
+    if sys.platform == "darwin":
+        # on Mac OS the configurations live in a different place.
+        prefs = os.path.join(home, "Library/Preferences/Houdini")
+        for i in range(count):
+            os.makedirs(os.path.join(prefs, "{}.{}".format(17 + i // 3, (i % 3) * 5)), exist_ok=True)
+
+
+def timed(func, repeat=1, setup=None):
+    """
+    Time func over a number of runs.
+    :param setup: called before each run, outside of the timing.
+    :return: a dict with each run's time in seconds and the median.
+    """
+    runs = list()
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(runs), "runs": runs}
+
+
+def bench_install(work, payload, configs, results, repeat):
+    dest = os.path.join(work, "dest")
+
+    def clean():
+        shutil.rmtree(dest, ignore_errors=True)
+
+    def install():
+        hpackagelib.install_package(configs, destination=dest, payload=payload)
+
+    # the first install into an empty destination. the OS page cache is whatever the payload generation left.
+    results["install_cold"] = timed(install, 1, clean)
+    # fresh destination again, but with the payload now warm in the page cache.
+    results["install_warm"] = timed(install, repeat, clean)
+    # install over an identical existing install.
+    results["reinstall"] = timed(install, repeat)
+    clean()
+
+
+def bench_packed(work, payload, configs, results, repeat):
+    archive = os.path.join(work, hpackagepack.PACK_NAME)
+    results["pack_payload"] = timed(lambda: hpackagepack.pack_payload(payload, archive), 1)
+    dest = os.path.join(work, "dest_packed")
+
+    def clean():
+        shutil.rmtree(dest, ignore_errors=True)
+
+    def install():
+        hpackagelib.install_package(configs, destination=dest, payload=archive)
+
+    results["install_packed"] = timed(install, repeat, clean)
+    results["reinstall_packed"] = timed(install, repeat)
+    clean()
+
+
+def bench_discovery(home, results, repeat):
+    def discover():
+        hpackagelib.get_houdini_prefs_paths(home, refresh=True)
+
+    results["discovery"] = timed(discover, repeat)
+    results["discovery_cached"] = timed(lambda: hpackagelib.get_houdini_prefs_paths(home), repeat)
+
+
+def bench_probe(payload, results, repeat):
+    # start from the deepest directory, which is the worst case for the upward walk.
+    deepest = max((dirpath for dirpath, _, _ in os.walk(payload)), key=lambda d: d.count(os.sep))
+    cwd = os.getcwd()
+    os.chdir(deepest)
+    try:
+        def probe():
+            hpackagelib.invalidate_cache()
+            hpackagelib.find_payload_path()
+            hpackagelib.find_package_path()
+
+        results["find_payload_and_package"] = timed(probe, repeat)
+    finally:
+        os.chdir(cwd)
+        hpackagelib.invalidate_cache()
+
+
+def bench_build(work, payload, results):
+    """
+    Time hpackagemaker.do_package and the cold start of the installer it produces. Skipped if PyInstaller isn't
+    installed.
+    """
+    try:
+        import hpackagemaker
+    except ImportError:
+        results["build"] = {"skipped": "PyInstaller is not installed"}
+        return
+    dist = os.path.join(work, "dist")
+    settings.PAYLOAD = payload
+    results["build"] = timed(lambda: hpackagemaker.do_package(path=dist), 1)
+    exe = os.path.join(dist, hpackagemaker.pkgname + (".exe" if sys.platform == "win32" else ""))
+    if not os.path.exists(exe):
+        return
+    # a headless listing exercises the onefile extraction and interpreter startup without needing a display.
+    results["installer_startup"] = timed(lambda: subprocess.run([exe, "--headless", "--list-configs", "--json"],
+                                                                capture_output=True), 3)
+
+
+def run(args):
+    work = args.workdir or tempfile.mkdtemp(prefix="hpackage_bench_")
+    os.makedirs(work, exist_ok=True)
+    payload = os.path.join(work, "payload")
+    home = os.path.join(work, "home")
+    results = dict()
+    # keep benchmark installs out of the user's installed-package registry.
+    settings.REGISTRY_PATH = os.path.join(work, "registry.json")
+    try:
+        start = time.perf_counter()
+        payload_bytes = generate_payload(payload, args.tiny_files, args.tiny_size, args.large_files,
+                                         args.large_size, args.depth)
+        generate_configs(home, args.configs)
+        generate_seconds = time.perf_counter() - start
+        configs = hpackagelib.get_houdini_prefs_paths(home)
+
+        bench_install(work, payload, configs, results, args.repeat)
+        bench_packed(work, payload, configs, results, args.repeat)
+        bench_discovery(home, results, args.repeat * 10)
+        bench_probe(payload, results, args.repeat * 10)
+        if args.build:
+            bench_build(work, payload, results)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "params": {"tiny_files": args.tiny_files, "tiny_size": args.tiny_size, "large_files": args.large_files,
+                   "large_size": args.large_size, "depth": args.depth, "configs": args.configs,
+                   "repeat": args.repeat, "payload_bytes": payload_bytes, "generate_seconds": generate_seconds},
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold, min_delta=0.005):
+    """
+    Compare two benchmark results.
+    :param threshold: the allowed slowdown as a fraction, e.g. 0.2 for 20%.
+    :param min_delta: slowdowns smaller than this many seconds are treated as noise.
+    :return: a list of (name, baseline seconds, current seconds) for every benchmark that regressed.
+    """
+    regressions = list()
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base or "seconds" not in base or "seconds" not in result:
+            continue
+        if result["seconds"] > base["seconds"] * (1.0 + threshold) and result["seconds"] - base["seconds"] > min_delta:
+            regressions.append((name, base["seconds"], result["seconds"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hpackage install and build hot paths.")
+    parser.add_argument("--tiny-files", type=int, default=10000, help="number of small payload files.")
+    parser.add_argument("--tiny-size", type=int, default=2048, help="size of each small file in bytes.")
+    parser.add_argument("--large-files", type=int, default=2, help="number of large payload files.")
+    parser.add_argument("--large-size", type=int, default=256, help="size of each large file in MB.")
+    parser.add_argument("--depth", type=int, default=12, help="depth of the deepest payload directory.")
+    parser.add_argument("--configs", type=int, default=30, help="number of fake Houdini configurations.")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per benchmark.")
+    parser.add_argument("--build", action="store_true", help="also benchmark building the installer.")
+    parser.add_argument("--workdir", help="where to generate data. defaults to a temporary directory.")
+    parser.add_argument("--keep", action="store_true", help="don't delete the generated data.")
+    parser.add_argument("--output", "-o", help="write results to this JSON file.")
+    parser.add_argument("--baseline", help="a previous results file to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown versus the baseline before a benchmark counts as a regression.")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="slowdowns smaller than this many seconds are ignored as noise.")
+    args = parser.parse_args(argv)
+
+    current = run(args)
+    for name, result in current["results"].items():
+        if "seconds" in result:
+            print("{:<28}{:>10.4f} s".format(name, result["seconds"]))
+        else:
+            print("{:<28}{:>12}".format(name, result.get("skipped", "")))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=3)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold, args.min_delta)
+        for name, before, after in regressions:
+            print("REGRESSION {}: {:.4f} s -> {:.4f} s ({:+.0%})".format(name, before, after, after / before - 1.0))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""
+Headless command line installer. This never imports PySide6, so it starts quickly and works on machines without
+a display (render nodes, deployment scripts).
+
+Examples:
+    python hpackagecli.py --list-configs --json
+    python hpackagecli.py --destination /opt/tools/MOPs --config 20.5 --config 20.0
+    python hpackagecli.py --destination /opt/tools/Bundle --select MOPs --select MOPsPlus
+    MOPs_install --headless --destination /opt/tools/MOPs --dry-run --json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+import hpackagelib
+import hpackagecopy
+import hpackagefilter
+import hpackagefleet
+import hpackageregistry
+import hpackagetrace
+import hpackageversions
+import hpackagewatch
+import settings
+
+logger = logging.getLogger(__name__)
+
+# exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_CONFIGS = 3
+EXIT_NO_PAYLOAD = 4
+EXIT_INVALID_DESTINATION = 5
+EXIT_VERIFY_FAILED = 6
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog=settings.NAME + "_install",
+                                     description="Install the {} Houdini package without a UI.".format(settings.NAME))
+    parser.add_argument("--destination", "-d", help="where to install the package files. defaults to the same "
+                                                    "location the installer UI would suggest.")
+    parser.add_argument("--config", "-c", action="append", default=[],
+                        help="a Houdini configuration to install to, either as a path or as a version "
+                             "(e.g. 20.5). can be given more than once. defaults to every detected configuration.")
+    parser.add_argument("--package", "-p", help="the package JSON to use as a template.")
+    parser.add_argument("--payload", help="the payload directory or packed payload to install, or the URL of a "
+                                          "payload manifest on an artifact server.")
+    parser.add_argument("--select", "-s", action="append", default=[],
+                        help="with a multi-package bundle (settings.PACKAGES), a package to install. can be given "
+                             "more than once. defaults to every package in the bundle.")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="don't write anything, just report what would "
+                                                                     "happen.")
+    parser.add_argument("--homes", action="append", default=[],
+                        help="fleet install: a home directory or glob (e.g. '/home/*') to install for. can be given "
+                             "more than once. the payload is copied to the destination once, and the package is "
+                             "written to the Houdini configurations found in every home.")
+    parser.add_argument("--workers", type=int, help="number of homes to process at once in a fleet install.")
+    parser.add_argument("--list-configs", action="store_true", help="list detected Houdini configurations and exit.")
+    parser.add_argument("--status", action="store_true", help="list where the package is installed, according to the "
+                                                              "registry, and exit.")
+    parser.add_argument("--all", action="store_true", help="with --status, list every package in the registry.")
+    parser.add_argument("--versions", action="store_true", help="list the versions installed in the destination "
+                                                                "(with VERSIONED_INSTALLS) and exit.")
+    parser.add_argument("--switch", metavar="VERSION", help="make an installed version in the destination the "
+                                                            "active one, without copying anything.")
+    parser.add_argument("--rollback", action="store_true", help="switch the destination back to the previously "
+                                                                "active version.")
+    parser.add_argument("--watch", action="store_true", help="after installing, keep watching the payload directory "
+                                                             "and sync every change into the destination until "
+                                                             "interrupted.")
+    parser.add_argument("--verify", action="store_true", help="check the files installed in the destination against "
+                                                              "the payload and exit, without changing anything.")
+    parser.add_argument("--force", "-f", action="store_true", help="copy and write everything even if the registry "
+                                                                   "says it's already installed.")
+    parser.add_argument("--json", action="store_true", help="print a machine-readable JSON result to stdout.")
+    parser.add_argument("--output", "-o", help="write the result to this file instead of printing it, e.g. when "
+                                               "running the windowed installer with no console to print to.")
+    parser.add_argument("--progress", action="store_true", help="print copy progress to stderr.")
+    parser.add_argument("--verbose", "-v", action="store_true", help="also log to stderr.")
+    parser.add_argument("--trace", help="write a Chrome trace of the install phases to this file.")
+    parser.add_argument("--profile", help="run under cProfile and save the stats to this file.")
+    return parser
+
+
+def select_configs(detected, requested):
+    """
+    Resolve the requested configurations against the detected ones. A request can be a path, or a Houdini version
+    that's matched against the end of each detected configuration path.
+    :return: a tuple of (selected configuration paths, requests that didn't match anything).
+    """
+    if not requested:
+        return list(detected), list()
+    selected = list()
+    unmatched = list()
+    for req in requested:
+        matches = list()
+        if os.path.isdir(req):
+            matches.append(os.path.abspath(req).replace("\\", "/"))
+        else:
+            matches = [d for d in detected if os.path.basename(d).endswith(req)]
+        if not matches:
+            unmatched.append(req)
+        for m in matches:
+            if m not in selected:
+                selected.append(m)
+    return selected, unmatched
+
+
+def payload_exists(payload):
+    """
+    Return True if payload is the URL of a payload manifest, or an existing payload directory or packed payload.
+    """
+    # imported here, so runs that don't install anything never load urllib.
+    import hpackagefetch
+    return bool(payload) and (hpackagefetch.is_url(payload) or os.path.exists(payload))
+
+
+def print_progress(p):
+    """
+    Progress callback for install_package that writes a single, continuously updated line to stderr.
+    """
+    mb_done = p["bytes_done"] / 1048576.0
+    mb_total = p["bytes_total"] / 1048576.0
+    eta = "{:.0f}s".format(p["eta"]) if p["eta"] is not None else "--"
+    sys.stderr.write("\r{}/{} files, {:.1f}/{:.1f} MB, {:.1f} MB/s, ETA {}   ".format(
+        p["files_done"], p["files_total"], mb_done, mb_total, p["rate"] / 1048576.0, eta))
+    if p["files_done"] == p["files_total"]:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def print_sync(batch):
+    """
+    Watch mode callback that writes a line to stderr for every batch of changes synced.
+    """
+    sys.stderr.write("{}  synced {} files, deleted {}, wrote {} package files ({:.0f} ms)\n".format(
+        time.strftime("%H:%M:%S"), batch["copied"], batch["deleted"], len(batch["package_files"]),
+        batch["latency"] * 1000.0))
+    sys.stderr.flush()
+
+
+def emit(result, as_json, output=None):
+    """
+    Print the result, or write it to the file output.
+    :return: the exit code.
+    """
+    out = open(output, 'w') if output else sys.stdout
+    err = out if output else sys.stderr
+    try:
+        write_result(result, as_json, out, err)
+    finally:
+        if output:
+            out.close()
+    return result["exit_code"]
+
+
+def write_result(result, as_json, out, err):
+    """
+    Write the result as JSON or plain text to out, and its error to err.
+    """
+    if as_json:
+        json.dump(result, out, indent=3)
+        out.write("\n")
+    else:
+        if result.get("error"):
+            err.write("Error: {}\n".format(result["error"]))
+        for c in result.get("configs", []):
+            out.write("{}\n".format(c))
+        for p in result.get("packages", []):
+            out.write("{} {}: {}\n".format("Already installed" if p["up_to_date"] else "Installed", p["name"],
+                                            p["destination"]))
+        for v in result.get("versions", []):
+            out.write("{} {}\n".format("*" if v["current"] else " ", v["version"]))
+        if result.get("verify"):
+            v = result["verify"]
+            for rel, reason in sorted(v["failed"].items()):
+                out.write("{}: {}\n".format(reason, rel))
+            out.write("Verified {} files ({:.1f} MB) in {} in {:.2f} s, {} don't match.\n".format(
+                v["checked"], v["bytes"] / 1048576.0, v["path"], v["elapsed"], len(v["failed"])))
+        if "status" in result:
+            out.write(hpackageregistry.format_status(result["status"]) + "\n")
+        if result.get("homes"):
+            out.write(hpackagefleet.format_summary(result["homes"], result["destination"]) + "\n")
+        elif result.get("up_to_date"):
+            out.write("Already installed to: {}\n".format(result["destination"]))
+        elif result.get("destination"):
+            out.write("Installed to: {}\n".format(result["destination"]))
+
+
+def install_bundle(args, configs, debug, result, finish):
+    """
+    Install the packages of a multi-package bundle that were picked with --select, or all of them.
+    """
+    specs = hpackagelib.get_package_specs(args.select or None)
+    missing = set(args.select) - set(spec["NAME"] for spec in specs)
+    if missing:
+        return finish(EXIT_USAGE, "The bundle has no package named: {}".format(", ".join(sorted(missing))))
+    for spec in specs:
+        payload = hpackagelib.find_bundle_payload(spec)
+        if not payload_exists(payload):
+            return finish(EXIT_NO_PAYLOAD, "Payload for package {} not found.".format(spec["NAME"]))
+
+    destination = args.destination or hpackagelib.get_default_install_path()
+    destination = os.path.abspath(destination).replace("\\", "/")
+    if not hpackagelib.is_valid_install_path(destination):
+        return finish(EXIT_INVALID_DESTINATION, "Invalid installation path: {}".format(destination))
+
+    logging.info("Headless install of {} to {} for configurations {}".format(
+        ", ".join(spec["NAME"] for spec in specs), destination, configs))
+    try:
+        installed = hpackagelib.install_packages(configs, specs, destination, debug=debug,
+                                                 progress=print_progress if args.progress else None,
+                                                 force=args.force)
+    except Exception as e:
+        logging.error("Unexpected error during installation!")
+        logging.error(traceback.format_exc())
+        return finish(EXIT_FAILED, str(e))
+    result["packages"] = [{"name": i["name"], "destination": i["install_path"], "copy": i["copy"],
+                           "verify": i["verify"], "package_files": i["package_files"],
+                           "up_to_date": i["up_to_date"]} for i in installed]
+    return finish(EXIT_OK)
+
+
+def attach_console():
+    """
+    The built installer is a windowed executable, which on Windows starts without stdout and stderr. Attach them to
+    the console of the command prompt it was started from, if there is one; otherwise discard what's printed, so the
+    install still runs and returns its exit code (use --output to get the result).
+    """
+    if sys.stdout is not None and sys.stderr is not None:
+        return
+    if sys.platform == "win32":
+        import ctypes
+        # ATTACH_PARENT_PROCESS
+        if ctypes.windll.kernel32.AttachConsole(-1):
+            try:
+                sys.stdout = sys.stdout or open("CONOUT$", 'w')
+                sys.stderr = sys.stderr or open("CONOUT$", 'w')
+            except OSError:
+                pass
+    sys.stdout = sys.stdout or open(os.devnull, 'w')
+    sys.stderr = sys.stderr or open(os.devnull, 'w')
+
+
+def main(argv=None):
+    start = time.perf_counter()
+    attach_console()
+    args = build_parser().parse_args(argv)
+    finish_trace = hpackagetrace.start(args.trace, args.profile)
+    if args.verbose:
+        hpackagetrace.add_log_handler(logging.StreamHandler(sys.stderr))
+    debug = args.dry_run or settings.DEBUG
+    result = {"package": settings.NAME, "dry_run": debug}
+
+    def finish(exit_code, error=None):
+        result["exit_code"] = exit_code
+        result["error"] = error
+        result["elapsed"] = round(time.perf_counter() - start, 4)
+        finish_trace()
+        return emit(result, args.json, args.output)
+
+    if args.status:
+        names = [spec["NAME"] for spec in hpackagelib.get_package_specs()]
+        result["status"] = hpackageregistry.get_status(None if args.all else names)
+        return finish(EXIT_OK)
+    if settings.PACKAGES and (args.homes or args.watch or args.verify or args.versions or args.switch or
+                              args.rollback or args.payload or args.package):
+        return finish(EXIT_USAGE, "A multi-package bundle can't be combined with --homes, --watch, --verify, "
+                                  "--versions, --switch, --rollback, --payload or --package.")
+    if args.select and not settings.PACKAGES:
+        return finish(EXIT_USAGE, "--select needs a multi-package bundle (settings.PACKAGES).")
+    if args.versions or args.switch or args.rollback:
+        destination = os.path.abspath(args.destination or hpackagelib.get_default_install_path()).replace("\\", "/")
+        if args.switch or args.rollback:
+            try:
+                result["install_path"] = hpackagelib.switch_version(destination, args.switch, package=args.package)
+            except (ValueError, OSError) as e:
+                logging.error(traceback.format_exc())
+                return finish(EXIT_FAILED, str(e))
+        result["versions"] = hpackageversions.list_versions(destination)
+        return finish(EXIT_OK)
+    if args.verify:
+        payload = args.payload or hpackagelib.find_payload_path()
+        if not payload_exists(payload):
+            return finish(EXIT_NO_PAYLOAD, "Payload not found.")
+        destination = os.path.abspath(args.destination or hpackagelib.get_default_install_path()).replace("\\", "/")
+        result["payload"] = payload
+        tracker = hpackagecopy.Progress(print_progress) if args.progress else None
+        try:
+            result["verify"] = hpackagelib.verify_install(hpackageversions.get_active_path(destination), payload,
+                                                          hpackagefilter.get_payload_filter(), progress=tracker)
+        except (ValueError, OSError) as e:
+            logging.error(traceback.format_exc())
+            return finish(EXIT_FAILED, str(e))
+        failed = len(result["verify"]["failed"])
+        return finish(EXIT_VERIFY_FAILED if failed else EXIT_OK,
+                      "{} files don't match the payload.".format(failed) if failed else None)
+    if args.homes and args.list_configs:
+        result["configs"] = [c for home in hpackagefleet.expand_homes(args.homes)
+                             for c in hpackagelib.get_houdini_prefs_paths(home)]
+        return finish(EXIT_OK)
+    if not args.homes:
+        detected = hpackagelib.get_houdini_prefs_paths()
+        if args.list_configs:
+            result["configs"] = detected
+            return finish(EXIT_OK)
+
+        configs, unmatched = select_configs(detected, args.config)
+        if unmatched:
+            return finish(EXIT_NO_CONFIGS, "No Houdini configuration matches: {}".format(", ".join(unmatched)))
+        if not configs:
+            return finish(EXIT_NO_CONFIGS, "No Houdini configurations found.")
+        result["configs"] = configs
+
+    if settings.PACKAGES:
+        return install_bundle(args, configs, debug, result, finish)
+
+    payload = args.payload or hpackagelib.find_payload_path()
+    if not payload_exists(payload):
+        return finish(EXIT_NO_PAYLOAD, "Payload not found.")
+    result["payload"] = payload
+    if args.watch and (args.homes or debug or not os.path.isdir(payload)):
+        return finish(EXIT_USAGE, "--watch needs a payload directory, and can't be combined with --homes or "
+                                  "--dry-run.")
+
+    destination = args.destination or hpackagelib.get_default_install_path()
+    destination = os.path.abspath(destination).replace("\\", "/")
+    if not hpackagelib.is_valid_install_path(destination):
+        return finish(EXIT_INVALID_DESTINATION, "Invalid installation path: {}".format(destination))
+
+    package = args.package or hpackagelib.find_package_path()
+    if args.homes:
+        if not args.destination:
+            return finish(EXIT_INVALID_DESTINATION, "A fleet install needs a shared --destination.")
+        try:
+            fleet = hpackagefleet.install_fleet(args.homes, package=package, destination=destination,
+                                                payload=payload, workers=args.workers, debug=debug)
+        except Exception as e:
+            logging.error("Unexpected error during fleet installation!")
+            logging.error(traceback.format_exc())
+            return finish(EXIT_FAILED, str(e))
+        if not fleet:
+            return finish(EXIT_FAILED, "Nothing was installed.")
+        result["destination"] = fleet["install_path"]
+        result["copy"] = fleet["copy"]
+        result["homes"] = fleet["homes"]
+        failed = [h for h in fleet["homes"] if h["status"] == "error"]
+        return finish(EXIT_FAILED if failed else EXIT_OK, "{} homes failed.".format(len(failed)) if failed else None)
+
+    logging.info("Headless install of {} to {} for configurations {}".format(settings.NAME, destination, configs))
+    try:
+        installed = hpackagelib.install_package(configs, package=package, destination=destination, payload=payload,
+                                                debug=debug, progress=print_progress if args.progress else None,
+                                                force=args.force)
+    except Exception as e:
+        logging.error("Unexpected error during installation!")
+        logging.error(traceback.format_exc())
+        return finish(EXIT_FAILED, str(e))
+    if not installed:
+        return finish(EXIT_FAILED, "Nothing was installed.")
+    result["destination"] = installed["install_path"]
+    result["copy"] = installed["copy"]
+    result["verify"] = installed["verify"]
+    result["package_files"] = installed["package_files"]
+    result["up_to_date"] = installed["up_to_date"]
+    if args.watch:
+        sys.stderr.write("Watching {} for changes, press Ctrl+C to stop.\n".format(payload))
+        try:
+            hpackagewatch.watch(payload, destination, configs, package, callback=print_sync)
+        except KeyboardInterrupt:
+            pass
+    return finish(EXIT_OK)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os
+import re
+import sys
+import glob
+import time
+import logging
+import py_compile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import hpackagecopy
+import settings
+
+logger = logging.getLogger(__name__)
+
+# the major.minor version in a Houdini installation directory name, e.g. "Houdini 20.5.370" or "hfs20.5.370".
+INSTALL_VERSION_PATTERN = re.compile(r"(\d{1,2}\.\d{1,2})\.\d+")
+
+# where each platform keeps the Python interpreters that ship with Houdini.
+HOUDINI_PYTHON_GLOBS = {
+    "win32": ["C:/Program Files/Side Effects Software/Houdini */python3*/python.exe"],
+    "darwin": ["/Applications/Houdini/Houdini*/Frameworks/Python.framework/Versions/*/bin/python3"],
+    "linux": ["/opt/hfs*/python/bin/python3"],
+}
+
+
+def find_houdini_pythons(versions=None):
+    """
+    Find the Python interpreters of installed Houdini versions. settings.HOUDINI_PYTHONS, if set, is used instead.
+    The $HFS of the current environment is searched too.
+    :param versions: only return interpreters for these Houdini major.minor versions, e.g. ["20.5"]. all if None.
+    :return: a dict of {Houdini major.minor version: interpreter path}, using the newest build of each version.
+    """
+    if settings.HOUDINI_PYTHONS:
+        return {v: p for v, p in settings.HOUDINI_PYTHONS.items() if (not versions or v in versions)
+                and os.path.isfile(p)}
+    platform_key = "linux" if sys.platform.startswith("linux") else sys.platform
+    patterns = list(HOUDINI_PYTHON_GLOBS.get(platform_key, []))
+    hfs = os.environ.get("HFS")
+    if hfs:
+        patterns += [os.path.join(hfs, "python", "bin", "python3"), os.path.join(hfs, "python3*", "python.exe")]
+    found = dict()
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            match = INSTALL_VERSION_PATTERN.search(path.replace("\\", "/"))
+            if not match:
+                continue
+            version = match.group(1)
+            if versions and version not in versions:
+                continue
+            # a later build of the same version sorts after an earlier one.
+            build = [int(x) for x in match.group(0).split(".")]
+            if version not in found or build > found[version][0]:
+                found[version] = (build, path)
+    return {version: path for version, (build, path) in found.items()}
+
+
+def compile_with(interpreter, path):
+    """
+    Precompile every .py file below path with a Houdini interpreter, using all cores (compileall -j 0).
+    :return: True if every file compiled.
+    """
+    cmd = [interpreter, "-m", "compileall", "-q", "-j", "0", "--invalidation-mode", "checked-hash", path]
+    logging.debug("Precompiling: {}".format(" ".join(cmd)))
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=3600)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning("Could not run {}: {}".format(interpreter, e))
+        return False
+    if result.returncode != 0:
+        logging.warning("Some files didn't compile with {}:\n{}".format(interpreter, result.stdout + result.stderr))
+    return result.returncode == 0
+
+
+def compile_file(path):
+    """
+    Compile a single file to a hash-based pyc.
+    :return: the error message if it didn't compile, otherwise None.
+    """
+    try:
+        py_compile.compile(path, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+    except (py_compile.PyCompileError, OSError) as e:
+        return str(e)
+    return None
+
+
+def compile_in_process(path):
+    """
+    Precompile every .py file below path with the installer's own interpreter, on a process pool. Frozen
+    installers start the workers through the multiprocessing.freeze_support call in hpackage_ui.py.
+    :return: True if every file compiled.
+    """
+    files = [os.path.join(path, rel) for rel in hpackagecopy.scan_tree(path)[1] if rel.endswith(".py")]
+    if len(files) < 2:
+        errors = [compile_file(f) for f in files]
+    else:
+        with ProcessPoolExecutor() as pool:
+            errors = list(pool.map(compile_file, files, chunksize=max(1, len(files) // (os.cpu_count() or 1) // 4)))
+    errors = [e for e in errors if e]
+    for e in errors:
+        logging.warning("Could not precompile: {}".format(e.strip()))
+    return not errors
+
+
+def precompile(path, versions=None):
+    """
+    Write bytecode for all Python files in an installed payload, so Houdini doesn't compile them on every launch.
+    The pycs are hash-based (checked against the source, not its mtime), so they stay valid after copying.
+    Each Houdini interpreter found for versions compiles the files for its own Python version; if none is found,
+    the installer's interpreter is used.
+    :param path: the installed payload.
+    :param versions: the Houdini major.minor versions being installed to.
+    :return: a dict with the interpreters used, whether everything compiled and the time it took.
+    """
+    start = time.perf_counter()
+    pythons = find_houdini_pythons(versions)
+    ok = True
+    if pythons:
+        for version, interpreter in sorted(pythons.items()):
+            logging.info("Precompiling {} for Houdini {} with {}".format(path, version, interpreter))
+            ok = compile_with(interpreter, path) and ok
+        used = sorted(pythons.values())
+    else:
+        logging.info("No Houdini Python found, precompiling {} with Python {}.{}".format(
+            path, sys.version_info[0], sys.version_info[1]))
+        ok = compile_in_process(path)
+        used = [sys.executable]
+    elapsed = time.perf_counter() - start
+    logging.info("Precompiled {} in {:.2f} s.".format(path, elapsed))
+    return {"interpreters": used, "ok": ok, "elapsed": elapsed}
@@ -0,0 +1,586 @@
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# read size used when hashing files.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# buffer size for the plain user space copy.
+COPY_BUFSIZE = 1024 * 1024
+
+# the copy journal kept in the destination while an install is in progress. see Journal.
+JOURNAL_NAME = ".hpackage_journal"
+
+# the install lock and completion marker kept in the destination. see hpackagelock.
+LOCK_NAME = ".hpackage_lock"
+MARKER_NAME = ".hpackage_complete"
+
+# hpackage's own files in a destination, which are never removed as extraneous.
+RESERVED_NAMES = (JOURNAL_NAME, LOCK_NAME, MARKER_NAME)
+
+# files are written under this suffix and renamed into place once they're complete.
+PARTIAL_SUFFIX = ".hpkpart"
+
+# ioctl request for a copy-on-write clone of a whole file (FICLONE from linux/fs.h).
+FICLONE = 0x40049409
+
+# errors that mean "this copy method doesn't work here", as opposed to a real I/O failure.
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF,
+                      errno.EPERM, errno.ETXTBSY}
+
+# (method, source device, destination device) combinations that already failed, so they aren't retried per file.
+_unsupported = set()
+
+
+def file_digest(path):
+    """
+    Return a content hash (blake2b, hex) of the file at path.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_tree(root, path_filter=None, skipped=None):
+    """
+    Walk a directory tree once using os.scandir.
+    :param root: the directory to walk.
+    :param path_filter: an optional hpackagefilter.PathFilter. excluded directories aren't descended into.
+    :param skipped: an optional dict with "files" and "bytes" counts, incremented for everything the filter excluded.
+    :return: a tuple of (dirs, files). dirs is a list of relative directory paths, parents first.
+             files is a dict of relative file path: os.stat_result. relative paths always use forward slashes.
+    """
+    dirs = list()
+    files = dict()
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            for entry in it:
+                entry_rel = "{}/{}".format(rel, entry.name) if rel else entry.name
+                if entry.is_dir():
+                    if path_filter and path_filter.excluded(entry_rel, True):
+                        if skipped is not None:
+                            sub_files = scan_tree(entry.path)[1]
+                            skipped["files"] += len(sub_files)
+                            skipped["bytes"] += sum(st.st_size for st in sub_files.values())
+                        continue
+                    dirs.append(entry_rel)
+                    stack.append(entry_rel)
+                else:
+                    st = entry.stat()
+                    if path_filter and path_filter.excluded(entry_rel):
+                        if skipped is not None:
+                            skipped["files"] += 1
+                            skipped["bytes"] += st.st_size
+                        continue
+                    files[entry_rel] = st
+    dirs.sort()
+    return dirs, files
+
+
+def needs_copy(src, src_stat, dst):
+    """
+    Decide whether the file at src has to be copied over dst.
+    Size and modification time settle most cases; if the sizes match but the times don't, the contents are hashed.
+    If the contents turn out to be identical, the destination's timestamps are updated so the next comparison is cheap.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return True
+    # compare at whole-second resolution, like rsync does, so coarse filesystems don't force a hash every time.
+    if int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+        return False
+    if file_digest(src) != file_digest(dst):
+        return True
+    logging.debug("Contents unchanged, updating timestamps only: {}".format(dst))
+    shutil.copystat(src, dst)
+    return False
+
+
+class ShortCopy(Exception):
+    """
+    Raised by a kernel-side copy method that stopped before the whole file was copied, e.g. because the source
+    shrank or a network filesystem returned a short read.
+    """
+    pass
+
+
+def _reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        sent = os.copy_file_range(src_fd, dst_fd, size - offset)
+        if sent == 0:
+            raise ShortCopy("copy_file_range stopped after {} of {} bytes".format(offset, size))
+        offset += sent
+
+
+def _sendfile(src_fd, dst_fd, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if sent == 0:
+            raise ShortCopy("sendfile stopped after {} of {} bytes".format(offset, size))
+        offset += sent
+
+
+def get_fast_copy_methods():
+    """
+    Return the kernel-side copy methods available on this platform, fastest first, as (name, function) pairs.
+    """
+    methods = list()
+    if not sys.platform.startswith("linux"):
+        return methods
+    if fcntl is not None:
+        methods.append(("reflink", _reflink))
+    if hasattr(os, "copy_file_range"):
+        methods.append(("copy_file_range", _copy_file_range))
+    if hasattr(os, "sendfile"):
+        methods.append(("sendfile", _sendfile))
+    return methods
+
+
+FAST_COPY_METHODS = get_fast_copy_methods()
+
+
+def copy_file(src, dst):
+    """
+    Copy a single file, including its timestamps and permission bits.
+    Where the platform allows it, the data is cloned or copied inside the kernel (reflink, then copy_file_range,
+    then sendfile) before falling back to a buffered copy through user space.
+    :return: the name of the method that copied the data.
+    """
+    method = "empty"
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        src_stat = os.fstat(src_fd)
+        size = src_stat.st_size
+        if size:
+            devices = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+            for name, func in FAST_COPY_METHODS:
+                if (name,) + devices in _unsupported:
+                    continue
+                try:
+                    func(src_fd, dst_fd, size)
+                    method = name
+                    break
+                except ShortCopy as e:
+                    # don't trust any kernel-side method with this file. the buffered copy reads until the end.
+                    logging.warning("Short copy of {} ({}), copying it through user space instead.".format(src, e))
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+                    shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+                    method = "buffered"
+                    break
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+                    logging.debug("Copy method {} unsupported for {} ({}), trying the next one.".format(name, dst, e))
+                    _unsupported.add((name,) + devices)
+                    # start over in case the failed method got partway through.
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+            else:
+                shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+                method = "buffered"
+    shutil.copystat(src, dst)
+    return method
+
+
+def atomic_copy(src, dst):
+    """
+    Copy src to a temporary name next to dst and rename it into place, so a partial file never looks complete.
+    :return: the name of the method that copied the data.
+    """
+    tmp = dst + PARTIAL_SUFFIX
+    method = copy_file(src, tmp)
+    os.replace(tmp, dst)
+    return method
+
+
+class Journal(object):
+    """
+    On-disk record of the files an install has finished, kept in the destination while the install runs.
+    If the install is interrupted, the next run skips every file the journal lists as long as neither the source
+    nor the destination changed since, without having to compare or hash them again.
+    The journal is removed once an install completes.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.entries = dict()
+        if os.path.exists(self.path):
+            self.load()
+            logging.info("Resuming interrupted install, {} files already done.".format(len(self.entries)))
+        self.handle = open(self.path, 'a')
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line can be cut short if the previous run was killed mid-write.
+                    continue
+                self.entries[entry["path"]] = entry
+
+    def is_done(self, rel, source_key):
+        entry = self.entries.get(rel)
+        if entry is None or entry["source"] != source_key:
+            return False
+        try:
+            st = os.stat(os.path.join(self.root, rel))
+        except OSError:
+            return False
+        return entry["dest"] == [st.st_size, st.st_mtime_ns]
+
+    def record(self, rel, source_key):
+        st = os.stat(os.path.join(self.root, rel))
+        line = json.dumps({"path": rel, "source": source_key, "dest": [st.st_size, st.st_mtime_ns]})
+        with self.lock:
+            self.handle.write(line + "\n")
+            self.handle.flush()
+
+    def track(self, func, source_keys):
+        """
+        Wrap a copy job so files the journal already lists are skipped, and finished files are recorded.
+        :param func: the job function, called with a relative path.
+        :param source_keys: a dict of relative path: a JSON-compatible value that identifies the source file's
+                            contents (e.g. its size and mtime, or its hash).
+        """
+        def journaled(rel):
+            key = source_keys[rel]
+            if self.is_done(rel, key):
+                return None
+            result = func(rel)
+            self.record(rel, key)
+            return result
+        return journaled
+
+    def close(self, complete=False):
+        """
+        Close the journal. If the install completed, the journal is deleted; otherwise it's kept for the next run.
+        """
+        self.handle.close()
+        if complete:
+            os.remove(self.path)
+
+
+def run_serial(jobs, func, workers=None):
+    """
+    Copy engine that runs every job one after the other on the calling thread.
+    :param jobs: an iterable of job arguments.
+    :param func: the function to call with each job.
+    :param workers: unused.
+    :return: a list of results, in job order.
+    """
+    return [func(job) for job in jobs]
+
+
+def run_parallel(jobs, func, workers=None):
+    """
+    Copy engine that runs jobs on a bounded thread pool. File copies spend most of their time waiting on the
+    filesystem, so threads hide per-file latency on network shares and SSDs alike.
+    :param jobs: an iterable of job arguments.
+    :param func: the function to call with each job.
+    :param workers: the number of worker threads. if None or 0, a default based on the CPU count is used.
+    :return: a list of results, in job order.
+    """
+    if not workers:
+        workers = default_workers()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hpackage_copy") as pool:
+            return list(pool.map(func, jobs))
+    except RuntimeError:
+        # the interpreter couldn't start threads (or is shutting down), so just do it the slow way.
+        logging.warning("Parallel copy unavailable, falling back to serial copy.")
+        return run_serial(jobs, func)
+
+
+# available copy engines, by name. each is called as engine(jobs, func, workers).
+ENGINES = {
+    "serial": run_serial,
+    "parallel": run_parallel,
+}
+
+
+def default_workers():
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+def get_engine(name):
+    """
+    Return the copy engine registered under name, or the serial engine if there isn't one.
+    """
+    engine = ENGINES.get(name)
+    if engine is None:
+        logging.warning("Unknown copy engine {}, using serial copy.".format(name))
+        engine = run_serial
+    return engine
+
+
+class InstallCancelled(Exception):
+    """
+    Raised when an install is cancelled while files are being copied.
+    """
+    pass
+
+
+class Progress(object):
+    """
+    Thread-safe progress tracker for copies. Copy engines report each finished file, and the tracker calls back with
+    a dict of files and bytes done versus total, the current throughput (bytes per second) and an ETA in seconds.
+    Setting the cancel event stops the copy before the next file starts.
+    """
+    def __init__(self, callback=None, cancel=None, interval=0.1):
+        """
+        :param callback: called with a progress dict. may be called from worker threads.
+        :param cancel: a threading.Event that cancels the copy when set.
+        :param interval: the minimum time in seconds between two callbacks, except for the final one.
+        """
+        self.callback = callback
+        self.cancel = cancel
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files_total = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.current = None
+        self.start_time = None
+        self.last_report = 0.0
+
+    def start(self, files_total, bytes_total):
+        with self.lock:
+            self.files_total = files_total
+            self.bytes_total = bytes_total
+            self.files_done = 0
+            self.bytes_done = 0
+            self.start_time = time.perf_counter()
+        self.report(force=True)
+
+    def is_cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise InstallCancelled("Installation was cancelled.")
+
+    def advance(self, size, current=None):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += size
+            self.current = current
+        self.report(force=self.files_done == self.files_total)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+            rate = self.bytes_done / elapsed if elapsed > 0 else 0.0
+            remaining = self.bytes_total - self.bytes_done
+            eta = remaining / rate if rate > 0 else None
+            return {"files_done": self.files_done, "files_total": self.files_total, "bytes_done": self.bytes_done,
+                    "bytes_total": self.bytes_total, "rate": rate, "eta": eta, "elapsed": elapsed,
+                    "current": self.current}
+
+    def report(self, force=False):
+        if self.callback is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        self.callback(self.snapshot())
+
+    def track(self, func, sizes):
+        """
+        Wrap a copy job so it honours cancellation and reports progress when it's done.
+        :param func: the job function, called with a relative path.
+        :param sizes: a dict of relative path: size in bytes.
+        """
+        def tracked(rel):
+            self.check_cancelled()
+            result = func(rel)
+            self.advance(sizes[rel], rel)
+            return result
+        return tracked
+
+
+def new_stats():
+    """
+    Return an empty statistics dict for a copy or extraction.
+    """
+    return {"copied": 0, "skipped": 0, "deleted": 0, "bytes": 0, "methods": dict(), "excluded": 0,
+            "excluded_bytes": 0, "copied_files": list()}
+
+
+def make_dirs(dst, dirs, debug=False):
+    """
+    Create dst and every relative directory in dirs below it.
+    """
+    if debug:
+        return
+    os.makedirs(dst, exist_ok=True)
+    for d in dirs:
+        os.makedirs(os.path.join(dst, d), exist_ok=True)
+
+
+def tally(stats, jobs, sizes, results):
+    """
+    Add the results of a copy engine run to stats.
+    :param stats: the statistics dict to update.
+    :param jobs: the relative path of each job's file.
+    :param sizes: the size in bytes of each job's file, in job order.
+    :param results: the method name each job copied its file with, or None if it was skipped.
+    """
+    for rel, size, method in zip(jobs, sizes, results):
+        if method:
+            stats["copied_files"].append(rel)
+            stats["copied"] += 1
+            stats["bytes"] += size
+            stats["methods"][method] = stats["methods"].get(method, 0) + 1
+        else:
+            stats["skipped"] += 1
+
+
+def delete_extraneous(dst, keep_dirs, keep_files, stats, debug=False, path_filter=None):
+    """
+    Remove files and directories from dst that aren't part of the payload anymore.
+    :param dst: the destination directory.
+    :param keep_dirs: the relative directories that belong to the payload.
+    :param keep_files: the relative files that belong to the payload.
+    :param stats: the statistics dict to update.
+    :param debug: doesn't actually delete anything.
+    :param path_filter: an optional hpackagefilter.PathFilter. paths it excludes are left alone in dst too.
+    """
+    if not os.path.isdir(dst):
+        return
+    dst_dirs, dst_files = scan_tree(dst, path_filter)
+    for rel in dst_files:
+        if rel not in keep_files and rel not in RESERVED_NAMES:
+            logging.debug("Removing file deleted upstream: {}".format(rel))
+            if not debug:
+                os.remove(os.path.join(dst, rel))
+            stats["deleted"] += 1
+    keep_dirs = set(keep_dirs)
+    # deepest first, so children are gone before their parents.
+    for rel in reversed(dst_dirs):
+        if rel not in keep_dirs:
+            logging.debug("Removing directory deleted upstream: {}".format(rel))
+            if not debug:
+                shutil.rmtree(os.path.join(dst, rel), ignore_errors=True)
+            stats["deleted"] += 1
+
+
+def run_jobs(stats, sizes, func, engine="parallel", workers=None, progress=None, journal=None, source_keys=None):
+    """
+    Run one copy job per file on the selected copy engine and add the results to stats.
+    :param stats: the statistics dict to update.
+    :param sizes: a dict of relative path: size in bytes, one entry per job.
+    :param func: the job function. it's called with a relative path and returns the copy method name, or None if
+                 the file was skipped.
+    :param engine: the name of the copy engine in ENGINES to use.
+    :param workers: the number of workers for engines that support them.
+    :param progress: an optional Progress tracker.
+    :param journal: an optional Journal. files it lists as done are skipped, and finished files are recorded.
+    :param source_keys: a dict of relative path: source identity for the journal.
+    """
+    jobs = list(sizes)
+    if journal is not None:
+        func = journal.track(func, source_keys)
+    if progress is not None:
+        progress.start(len(jobs), sum(sizes.values()))
+        func = progress.track(func, sizes)
+    results = get_engine(engine)(jobs, func, workers)
+    tally(stats, jobs, [sizes[rel] for rel in jobs], results)
+
+
+def log_stats(stats):
+    logging.info("Copy complete: {copied} copied, {skipped} unchanged, {deleted} deleted, {bytes} bytes written.".format(**stats))
+    logging.info("Copy methods used: {}".format(stats["methods"]))
+    if stats["excluded"]:
+        logging.info("Payload rules excluded {excluded} files ({excluded_bytes} bytes).".format(**stats))
+
+
+def copy_tree(src, dst, sync=True, delete=False, engine="parallel", workers=None, debug=False, progress=None,
+              path_filter=None):
+    """
+    Copy the payload at src to dst. The tree is walked once, all directories are created up front,
+    and the file copies are handed to the selected copy engine.
+    :param src: the source directory (the payload).
+    :param dst: the destination directory.
+    :param sync: if True, only new or changed files are copied.
+    :param delete: if True (and syncing), files and directories in dst that no longer exist in src are removed.
+    :param engine: the name of the copy engine in ENGINES to use.
+    :param workers: the number of workers for engines that support them.
+    :param debug: doesn't actually copy or delete anything and logs a dry run instead.
+    :param progress: an optional Progress tracker.
+    :param path_filter: an optional hpackagefilter.PathFilter for payload files to leave out.
+    :return: a dict of statistics for the copy.
+    """
+    stats = new_stats()
+    skipped = {"files": 0, "bytes": 0}
+    src_dirs, src_files = scan_tree(src, path_filter, skipped)
+    stats["excluded"], stats["excluded_bytes"] = skipped["files"], skipped["bytes"]
+    make_dirs(dst, src_dirs, debug)
+
+    def copy_job(rel):
+        src_path = os.path.join(src, rel)
+        dst_path = os.path.join(dst, rel)
+        if sync and not needs_copy(src_path, src_files[rel], dst_path):
+            return None
+        if debug:
+            logging.debug("File would be copied: {}".format(rel))
+            return "debug"
+        method = atomic_copy(src_path, dst_path)
+        logging.debug("Copied file ({}): {}".format(method, rel))
+        return method
+
+    sizes = {rel: st.st_size for rel, st in src_files.items()}
+    if debug:
+        run_jobs(stats, sizes, copy_job, engine, workers, progress)
+    else:
+        keys = {rel: [st.st_size, st.st_mtime_ns] for rel, st in src_files.items()}
+        journal = Journal(dst)
+        try:
+            run_jobs(stats, sizes, copy_job, engine, workers, progress, journal, keys)
+        except BaseException:
+            journal.close()
+            raise
+        journal.close(complete=True)
+
+    if sync and delete:
+        delete_extraneous(dst, src_dirs, src_files, stats, debug, path_filter)
+
+    log_stats(stats)
+    return stats
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import hpackagecopy
+import hpackagepack
+import settings
+
+logger = logging.getLogger(__name__)
+
+# the manifest published next to a packed payload on an artifact server.
+MANIFEST_NAME = "manifest.json"
+
+# ranged downloads split the archive into parts of at least this size.
+MIN_PART_SIZE = 8 * 1024 * 1024
+
+# how often a failed request is retried, and how long to wait before the first retry (doubled after each one).
+RETRIES = 3
+RETRY_DELAY = 1.0
+
+# seconds to wait for a server to respond.
+TIMEOUT = 60
+
+
+def is_url(payload):
+    """
+    Return True if payload is an HTTP(S) URL rather than a local path.
+    """
+    return isinstance(payload, str) and payload.lower().startswith(("http://", "https://"))
+
+
+def get_cache_root():
+    """
+    Return the download cache: settings.DOWNLOAD_CACHE, or a directory shared by every user on this machine.
+    Falls back to a per-user cache if the shared one can't be written to.
+    """
+    if settings.DOWNLOAD_CACHE:
+        return settings.DOWNLOAD_CACHE
+    if sys.platform == "win32":
+        shared = os.path.join(os.environ.get("PROGRAMDATA", "C:/ProgramData"), "hpackage", "cache")
+    elif sys.platform == "darwin":
+        shared = "/Users/Shared/hpackage/cache"
+    else:
+        shared = "/var/tmp/hpackage/cache"
+    try:
+        if not os.path.isdir(shared):
+            os.makedirs(shared)
+            # anyone can add to the cache, but only remove their own files.
+            os.chmod(shared, 0o1777)
+        if os.access(shared, os.W_OK):
+            return shared
+    except OSError:
+        pass
+    return get_user_cache_root()
+
+
+def get_user_cache_root():
+    """
+    Return the cache directory of the current user, for when the shared cache can't be used.
+    """
+    return os.path.join(os.path.expanduser("~"), ".hpackage", "cache")
+
+
+def write_manifest(archive, url=None):
+    """
+    Write the manifest for publishing a packed payload on an artifact server, next to the archive.
+    :param archive: the packed payload.
+    :param url: the archive's URL, if it isn't published in the same directory as the manifest.
+    :return: the path of the manifest.
+    """
+    manifest = {"archive": url or os.path.basename(archive), "size": os.path.getsize(archive),
+                "hash": hpackagecopy.file_digest(archive)}
+    path = os.path.join(os.path.dirname(os.path.abspath(archive)), MANIFEST_NAME)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=3)
+    return path
+
+
+def _open(url, headers=None):
+    """
+    Open a URL, retrying on connection errors and server errors.
+    """
+    delay = RETRY_DELAY
+    for attempt in range(RETRIES + 1):
+        try:
+            return urllib.request.urlopen(urllib.request.Request(url, headers=headers or dict()), timeout=TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == RETRIES:
+                raise
+            error = e
+        except (urllib.error.URLError, OSError) as e:
+            if attempt == RETRIES:
+                raise
+            error = e
+        logging.warning("Request for {} failed ({}), retrying in {:.0f} s.".format(url, error, delay))
+        time.sleep(delay)
+        delay *= 2
+
+
+def read_manifest(url):
+    """
+    Download a payload manifest. The archive URL in it is resolved relative to the manifest's URL.
+    :return: a dict with the archive URL, its size and its hash.
+    """
+    with _open(url) as response:
+        manifest = json.loads(response.read().decode("utf-8"))
+    manifest["archive"] = urllib.parse.urljoin(url, manifest["archive"])
+    return manifest
+
+
+def supports_ranges(url):
+    """
+    Ask the server for the first byte of url, to see if it honors Range requests.
+    """
+    try:
+        with _open(url, {"Range": "bytes=0-0"}) as response:
+            return response.status == 206
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def download_range(url, path, start, end):
+    """
+    Download bytes start to end (inclusive) of url into the same offsets of the file at path.
+    """
+    with _open(url, {"Range": "bytes={}-{}".format(start, end)}) as response:
+        if response.status != 206:
+            raise IOError("Server ignored the range request for {}".format(url))
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = response.read(min(hpackagecopy.COPY_BUFSIZE, remaining))
+                if not chunk:
+                    raise IOError("Download of {} ended early".format(url))
+                f.write(chunk)
+                remaining -= len(chunk)
+
+
+def download(url, path, size, workers=None):
+    """
+    Download url to path. If the server supports Range requests, the file is fetched in parts on a thread pool,
+    which fills the link much better than one stream over a high latency connection; otherwise with a single GET.
+    :param size: the expected size in bytes.
+    :param workers: the number of parts downloaded at once. defaults to settings.DOWNLOAD_WORKERS.
+    :return: "ranged" or "single", depending on how the file was downloaded.
+    """
+    workers = workers or settings.DOWNLOAD_WORKERS
+    parts = min(workers, size // MIN_PART_SIZE)
+    if parts > 1 and supports_ranges(url):
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        part_size = -(-size // parts)
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        logging.info("Downloading {} in {} parts.".format(url, len(ranges)))
+        with ThreadPoolExecutor(max_workers=parts) as pool:
+            list(pool.map(lambda r: download_range(url, path, r[0], r[1]), ranges))
+        return "ranged"
+    logging.info("Downloading {}.".format(url))
+    with _open(url) as response, open(path, 'wb') as f:
+        shutil.copyfileobj(response, f, hpackagecopy.COPY_BUFSIZE)
+    return "single"
+
+
+def is_valid_archive(path, manifest):
+    """
+    Return True if a downloaded archive matches its manifest, by size and content hash. Every user on the machine
+    can write to the shared cache, so a cached archive is hashed every time it's used rather than trusted by its
+    name and size.
+    """
+    try:
+        return os.path.getsize(path) == manifest["size"] and hpackagecopy.file_digest(path) == manifest["hash"]
+    except OSError:
+        return False
+
+
+def fetch_payload(url, cache_root=None, workers=None):
+    """
+    Fetch a packed payload from an artifact server into the machine's download cache. Artifacts are cached under
+    their content hash, so installing the same payload again, or as another user on the same machine, doesn't
+    download anything.
+    :param url: the URL of the payload manifest.
+    :param cache_root: the cache directory. defaults to get_cache_root().
+    :param workers: the number of parts to download at once.
+    :return: the path of the cached archive.
+    """
+    manifest = read_manifest(url)
+    cache_root = cache_root or get_cache_root()
+    os.makedirs(cache_root, exist_ok=True)
+    cached = os.path.join(cache_root, manifest["hash"] + hpackagepack.PACK_EXTENSION)
+    if os.path.lexists(cached):
+        if is_valid_archive(cached, manifest):
+            logging.info("Using cached payload: {}".format(cached))
+            return cached
+        logging.warning("Cached payload {} doesn't match its manifest, downloading it again.".format(cached))
+        try:
+            os.remove(cached)
+        except OSError:
+            # another user's file in the shared cache can't be removed. download into this user's own cache.
+            cache_root = get_user_cache_root()
+            os.makedirs(cache_root, exist_ok=True)
+            cached = os.path.join(cache_root, manifest["hash"] + hpackagepack.PACK_EXTENSION)
+            if is_valid_archive(cached, manifest):
+                logging.info("Using cached payload: {}".format(cached))
+                return cached
+
+    fd, tmp = tempfile.mkstemp(suffix=hpackagecopy.PARTIAL_SUFFIX, dir=cache_root)
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        method = download(manifest["archive"], tmp, manifest["size"], workers)
+        elapsed = time.perf_counter() - start
+        if not is_valid_archive(tmp, manifest):
+            raise IOError("Downloaded payload {} doesn't match its manifest".format(manifest["archive"]))
+        os.chmod(tmp, 0o644)
+        if is_valid_archive(cached, manifest):
+            # another installer finished the same download first.
+            os.remove(tmp)
+        else:
+            try:
+                os.replace(tmp, cached)
+            except PermissionError:
+                # another user's copy appeared in the shared cache meanwhile, and only they can replace it.
+                if not is_valid_archive(cached, manifest):
+                    raise
+                os.remove(tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    logging.info("Downloaded {} bytes ({}) in {:.2f} s to {}".format(manifest["size"], method, elapsed, cached))
+    return cached
@@ -0,0 +1,120 @@
+import re
+import logging
+import settings
+
+logger = logging.getLogger(__name__)
+
+# compiled filters for the settings they were built from. see get_payload_filter.
+_filters = dict()
+
+
+def translate(pattern):
+    """
+    Translate a gitignore-style glob into a regular expression for relative paths with forward slashes.
+    A pattern without a slash matches a name at any depth; one with a slash is relative to the payload root.
+    "*" and "?" don't match "/", "**" matches across directories, and a trailing "/" only matches directories.
+    :return: a tuple of (regex, whether the pattern only matches directories).
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = ["^" if anchored else "^(?:.*/)?"]
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[{}]".format(body.replace("\\", "\\\\")))
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out), dir_only
+
+
+def _compile(patterns):
+    """
+    Compile a list of patterns into as few regular expressions as possible. Consecutive patterns with the same sign
+    ("!" re-includes, like in .gitignore) are merged into one alternation, so matching a path costs one or two
+    regex matches no matter how many rules there are.
+    :return: a list of (negated, regex for any path, regex for directories only) groups, in rule order.
+    """
+    groups = list()
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        negated = pattern.startswith("!")
+        regex, dir_only = translate(pattern[1:] if negated else pattern)
+        if not groups or groups[-1][0] != negated:
+            groups.append((negated, list(), list()))
+        if dir_only:
+            # anything below a matching directory matches, but the name itself only if it's a directory.
+            groups[-1][1].append(regex + "/.*$")
+            groups[-1][2].append(regex + "$")
+        else:
+            groups[-1][1].append(regex + "(?:/.*)?$")
+    compiled = list()
+    for negated, any_path, dirs in groups:
+        compiled.append((negated, re.compile("|".join(any_path)) if any_path else None,
+                         re.compile("|".join(dirs)) if dirs else None))
+    return compiled
+
+
+def _match(groups, rel, is_dir):
+    # the last matching rule wins.
+    for negated, any_path, dirs in reversed(groups):
+        if (any_path is not None and any_path.match(rel)) or (is_dir and dirs is not None and dirs.match(rel)):
+            return not negated
+    return False
+
+
+class PathFilter(object):
+    """
+    Include and exclude rules for payload paths, compiled once. A path is left out if it matches an exclude
+    rule, or if there are include rules and a file matches none of them. Directories are only left out by exclude
+    rules, and everything below an excluded directory is left out with it.
+    """
+    def __init__(self, include=(), exclude=()):
+        self.include = _compile(include)
+        self.exclude = _compile(exclude)
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def excluded(self, rel, is_dir=False):
+        """
+        Return True if the relative path rel (with forward slashes) should be left out of the payload.
+        """
+        if _match(self.exclude, rel, is_dir):
+            return True
+        if self.include and not is_dir and not _match(self.include, rel, False):
+            return True
+        return False
+
+
+def get_payload_filter(include=None, exclude=None):
+    """
+    Return the PathFilter for settings.PAYLOAD_INCLUDE and settings.PAYLOAD_EXCLUDE, or for the given rules.
+    """
+    key = (tuple(settings.PAYLOAD_INCLUDE if include is None else include),
+           tuple(settings.PAYLOAD_EXCLUDE if exclude is None else exclude))
+    if key not in _filters:
+        _filters[key] = PathFilter(*key)
+    return _filters[key]
@@ -0,0 +1,116 @@
+import os
+import glob
+import time
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import hpackagelib
+import hpackageregistry
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def expand_homes(patterns):
+    """
+    Expand a list of home directories and glob patterns (e.g. /home/*) into a sorted list of unique directories.
+    """
+    homes = list()
+    seen = set()
+    for pattern in patterns:
+        matches = glob.glob(os.path.expanduser(pattern)) if glob.has_magic(pattern) else [os.path.expanduser(pattern)]
+        for m in matches:
+            m = os.path.abspath(m).replace("\\", "/")
+            if m not in seen and os.path.isdir(m):
+                seen.add(m)
+                homes.append(m)
+    homes.sort()
+    return homes
+
+
+def _match_owner(path, reference):
+    """
+    Give path the same owner as reference. When the installer runs as root, files written into other users'
+    homes would otherwise belong to root.
+    """
+    if not hasattr(os, "geteuid") or os.geteuid() != 0:
+        return
+    st = os.stat(reference)
+    os.chown(path, st.st_uid, st.st_gid)
+
+
+def install_home(home, data, debug=False):
+    """
+    Write the package JSON into every Houdini configuration found in a single home directory.
+    :return: a dict with the result for this home.
+    """
+    start = time.perf_counter()
+    result = {"home": home, "configs": list(), "package_files": list(), "status": "ok", "error": None}
+    try:
+        configs = hpackagelib.get_houdini_prefs_paths(home)
+        result["configs"] = configs
+        result["package_files"] = hpackagelib.write_package_files(configs, data, debug=debug)
+        if not debug:
+            for config, package_file in zip(configs, result["package_files"]):
+                _match_owner(os.path.dirname(package_file), config)
+                _match_owner(package_file, config)
+        if not configs:
+            result["status"] = "no configs"
+    except Exception as e:
+        logging.error("Install failed for home {}".format(home))
+        logging.error(traceback.format_exc())
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["elapsed"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def install_fleet(homes, package=None, destination=None, payload=None, workers=None, debug=False):
+    """
+    Install the package for many users at once. The payload is copied to the shared destination once,
+    then the package JSONs are written into every home directory in parallel.
+    :param homes: home directories or glob patterns, e.g. ["/home/*"].
+    :param package: the JSON file to configure, if one exists.
+    :param destination: the shared location to copy the payload to.
+    :param payload: the location of the source files.
+    :param workers: the number of homes to process at once. defaults to settings.FLEET_WORKERS.
+    :param debug: doesn't actually save or copy any files and prints a dry run instead.
+    :return: a dict with the install path, copy statistics and a list of per-home results.
+    """
+    homes = expand_homes(homes)
+    logging.info("Fleet install to {} home directories.".format(len(homes)))
+    # copy the payload once, without writing any package files yet.
+    installed = hpackagelib.install_package([], package=package, destination=destination, payload=payload,
+                                            debug=debug)
+    if not installed:
+        return None
+    data = installed["data"]
+    workers = workers or settings.FLEET_WORKERS
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(homes) or 1))) as pool:
+        results = list(pool.map(lambda h: install_home(h, data, debug), homes))
+    if not debug:
+        # record every home's configs with a single registry write.
+        registry = hpackageregistry.load()
+        package_hash = hpackageregistry.data_hash(data)
+        for r in results:
+            if r["status"] == "ok":
+                hpackageregistry.record_configs(registry, settings.NAME, settings.VERSION, installed["install_path"],
+                                                installed["hash"], package_hash, r["configs"], r["package_files"])
+        hpackageregistry.save(registry)
+    return {"install_path": installed["install_path"], "copy": installed["copy"], "homes": results}
+
+
+def format_summary(homes, install_path):
+    """
+    Format the per-home results of install_fleet as a plain text table.
+    """
+    rows = [("HOME", "STATUS", "CONFIGS", "SECONDS")]
+    for r in homes:
+        rows.append((r["home"], r["status"] if not r["error"] else "error: {}".format(r["error"]),
+                     str(len(r["configs"])), "{:.3f}".format(r["elapsed"])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ["  ".join(col.ljust(w) for col, w in zip(row, widths)).rstrip() for row in rows]
+    ok = len([r for r in homes if r["status"] == "ok"])
+    lines.append("")
+    lines.append("{} of {} homes installed to {}".format(ok, len(homes), install_path))
+    return "\n".join(lines)
@@ -3,14 +3,24 @@ import sys
 import json
 import re
 import settings
-import shutil
 import logging
+import threading
+import hpackagecopy
+import hpackagefilter
+import hpackagelock
+import hpackagepack
+import hpackageregistry
+import hpackagestore
+import hpackagetrace
+import hpackageverify
+import hpackageversions
+from concurrent.futures import ThreadPoolExecutor
+from hpackagecopy import InstallCancelled
 from pathlib import Path
 
 #TODO: safeguard against installing to existing houdini config or install directories
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s -- %(levelname)s: %(message)s', level=logging.DEBUG, filename=os.path.join(os.path.expanduser("~"), "hpackage.log"), filemode="w", datefmt="%Y/%m/%d %H:%M:%S")
 
 # insane windows things to fetch user's My Documents folder. this isn't always the same as the home folder!!
 CSIDL_PERSONAL = 5       # My Documents
@@ -18,6 +28,31 @@ SHGFP_TYPE_CURRENT = 0   # Get current, not default value
 
 # regex for parsing houdini major/minor versions from home folders
 HOUDINI_VERSION_REGEX = r"(?P<major>[\d]{1,2})\.(?P<minor>[\d]{1,2})"
+HOUDINI_VERSION_PATTERN = re.compile(HOUDINI_VERSION_REGEX)
+
+# how many parent directories to search for the payload and package file.
+MAX_SEARCH_DEPTH = 50
+
+# the settings that describe a single package. with a multi-package bundle, each entry of settings.PACKAGES sets
+# these for one package; VERSION defaults to the bundle's.
+PACKAGE_KEYS = ("NAME", "VERSION", "PAYLOAD", "PAYLOAD_URL", "PATH_VARS", "OTHER_VARS")
+
+# where the payloads of a bundle are embedded into the installer, one per package.
+BUNDLE_DIR = "payloads"
+
+# memoized results of config discovery and upward path probing. these only change if the user creates or removes
+# directories while the installer is running; call invalidate_cache() if that happens.
+_discovery_cache = dict()
+_probe_cache = dict()
+
+
+def invalidate_cache():
+    """
+    Forget all memoized Houdini configuration and payload/package lookups.
+    """
+    _discovery_cache.clear()
+    _probe_cache.clear()
+
 
 def get_windows_docs_path():
     import ctypes.wintypes
@@ -26,139 +61,189 @@ def get_windows_docs_path():
     return buf.value
 
 
-def get_windows_houdini_paths():
+def scan_houdini_configs(root, prefix="", found=None):
     """
-    Return all detected Houdini configuration paths on Windows.
+    List the Houdini configuration directories directly inside root in a single os.scandir pass.
+    :param root: the directory that holds the configuration directories.
+    :param prefix: the text in front of the version in each directory name ("houdini" on Windows and Linux).
+    :param found: optional callable, called with each configuration path as soon as it's found.
+    :return: a list of configuration paths that match settings.SUPPORTED_VERSIONS, if any are specified.
     """
-    root = get_windows_docs_path()
-    logging.debug("Windows home path: {}".format(root))
     out_dirs = list()
-    if os.path.exists(root):
-        houdini_dirs = [f for f in os.listdir(root) if f.startswith("houdini")]
-        if houdini_dirs:
-            for f in houdini_dirs:
-                if settings.SUPPORTED_VERSIONS:
-                    logging.debug("Testing Houdini configuration path: {}".format(f))
-                    # make sure this detected directory fits one of these versions.
-                    match = re.match(HOUDINI_VERSION_REGEX, f)
-                    version = match.group("major") + "." + match.group("minor")
-                    logging.debug("Version parsed: {}".format(version))
-                    if version not in settings.SUPPORTED_VERSIONS:
-                        logging.debug("\tVersion not compatible.")
-                        continue
-                full_path = os.path.join(root, f)
-                if os.path.isdir(full_path):
-                    out_dirs.append(full_path.replace("\\", "/"))
+    supported = set(settings.SUPPORTED_VERSIONS)
+    try:
+        it = os.scandir(root)
+    except OSError:
+        logging.debug("Houdini configuration root not found: {}".format(root))
+        return out_dirs
+    with it:
+        for entry in it:
+            name = entry.name
+            if not name.startswith(prefix):
+                continue
+            match = HOUDINI_VERSION_PATTERN.match(name, len(prefix))
+            if not match:
+                continue
+            if supported:
+                # make sure this detected directory fits one of these versions.
+                version = match.group("major") + "." + match.group("minor")
+                logging.debug("Testing Houdini configuration path: {} (version {})".format(name, version))
+                if version not in supported:
+                    logging.debug("\tVersion not compatible.")
+                    continue
+            if entry.is_dir():
+                out_dirs.append(entry.path.replace("\\", "/"))
+                if found:
+                    found(out_dirs[-1])
     logging.debug("Houdini configurations found: {}".format(out_dirs))
     return out_dirs
 
 
-def get_macos_houdini_paths():
+def get_windows_houdini_paths(home=None, found=None):
+    """
+    Return all detected Houdini configuration paths on Windows.
+    :param home: a user's home directory to look in. defaults to the current user's Documents folder.
+    :param found: optional callable, called with each configuration path as soon as it's found.
+    """
+    root = os.path.join(home, "Documents") if home else get_windows_docs_path()
+    logging.debug("Windows home path: {}".format(root))
+    return scan_houdini_configs(root, "houdini", found)
+
+
+def get_macos_houdini_paths(home=None, found=None):
     """
     Return all detected Houdini configuration paths on Mac OS.
+    :param home: a user's home directory to look in. defaults to the current user's home.
+    :param found: optional callable, called with each configuration path as soon as it's found.
     """
-    home = os.path.expanduser("~/Library/Preferences/Houdini")
-    logging.debug("Mac OS home path: {}".format(home))
-    out_dirs = list()
-    if os.path.exists(home):
-        houdini_dirs = [f for f in os.listdir(home) if re.match(HOUDINI_VERSION_REGEX, f)]
-        if houdini_dirs:
-            for f in houdini_dirs:
-                if settings.SUPPORTED_VERSIONS:
-                    logging.debug("Testing Houdini configuration path: {}".format(f))
-                    # make sure this detected directory fits one of these versions.
-                    match = re.match(HOUDINI_VERSION_REGEX, f)
-                    version = match.group("major") + "." + match.group("minor")
-                    logging.debug("Version parsed: {}".format(version))
-                    if version not in settings.SUPPORTED_VERSIONS:
-                        logging.debug("\tVersion not compatible.")
-                        continue
-                full_path = os.path.join(home, f)
-                if os.path.isdir(full_path):
-                    out_dirs.append(full_path)
-    logging.debug("Houdini configurations found: {}".format(out_dirs))
-    return out_dirs
+    root = os.path.join(home or os.path.expanduser("~"), "Library/Preferences/Houdini")
+    logging.debug("Mac OS home path: {}".format(root))
+    return scan_houdini_configs(root, found=found)
 
 
-def get_linux_houdini_paths():
+def get_linux_houdini_paths(home=None, found=None):
     """
     Return all detected Houdini configuration paths on Linux.
+    :param home: a user's home directory to look in. defaults to the current user's home.
+    :param found: optional callable, called with each configuration path as soon as it's found.
     """
-    home = os.path.expanduser("~")
-    logging.debug("Linux home path: {}".format(home))
-    out_dirs = list()
-    houdini_dirs = [f for f in os.listdir(home) if f.startswith("houdini")]
-    if houdini_dirs:
-        for f in houdini_dirs:
-            if settings.SUPPORTED_VERSIONS:
-                # make sure this detected directory fits one of these versions.
-                logging.debug("Testing Houdini configuration path: {}".format(f))
-                match = re.match(HOUDINI_VERSION_REGEX, f)
-                version = match.group("major") + "." + match.group("minor")
-                logging.debug("Version parsed: {}".format(version))
-                if version not in settings.SUPPORTED_VERSIONS:
-                    continue
-            full_path = os.path.join(home, f)
-            if os.path.isdir(full_path):
-                out_dirs.append(full_path)
-    logging.debug("Houdini configurations found: {}".format(out_dirs))
-    return out_dirs
+    root = home or os.path.expanduser("~")
+    logging.debug("Linux home path: {}".format(root))
+    return scan_houdini_configs(root, "houdini", found)
 
 
-def get_houdini_prefs_paths():
-    if sys.platform == "win32":
-        return get_windows_houdini_paths()
-    elif sys.platform.lower() == "darwin":
-        return get_macos_houdini_paths()
-    else:
-        return get_linux_houdini_paths()
+def get_houdini_versions(path_list):
+    """
+    Return the Houdini major.minor versions of a list of configuration paths, e.g. ["20.5", "20.0"].
+    """
+    versions = list()
+    for path in path_list:
+        match = HOUDINI_VERSION_PATTERN.search(os.path.basename(path.rstrip("/\\")))
+        if match and match.group(0) not in versions:
+            versions.append(match.group(0))
+    return versions
+
+
+def get_houdini_prefs_paths(home=None, refresh=False, found=None):
+    """
+    Return all detected Houdini configuration paths for this platform. Results are memoized per home directory.
+    :param home: a user's home directory to look in. defaults to the current user's.
+    :param refresh: ignore any memoized result and scan again.
+    :param found: optional callable, called with each configuration path as soon as it's found, so a UI can list
+                  them while a slow (e.g. network) home directory is still being scanned.
+    """
+    key = (sys.platform, home, tuple(settings.SUPPORTED_VERSIONS))
+    if refresh or key not in _discovery_cache:
+        with hpackagetrace.span("discovery", home=home) as info:
+            if sys.platform == "win32":
+                _discovery_cache[key] = get_windows_houdini_paths(home, found)
+            elif sys.platform.lower() == "darwin":
+                _discovery_cache[key] = get_macos_houdini_paths(home, found)
+            else:
+                _discovery_cache[key] = get_linux_houdini_paths(home, found)
+            info["configs"] = len(_discovery_cache[key])
+    elif found:
+        for config in _discovery_cache[key]:
+            found(config)
+    return list(_discovery_cache[key])
+
+
+def _list_names(path):
+    """
+    Return the set of entry names in a directory, memoized. Names are lowercased on case-insensitive platforms.
+    """
+    names = _probe_cache.get(path)
+    if names is None:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = list()
+        if sys.platform in ("win32", "darwin"):
+            names = [n.lower() for n in names]
+        names = frozenset(names)
+        _probe_cache[path] = names
+    return names
+
+
+def probe_upwards(start=None):
+    """
+    Walk up from start (the current directory by default) looking for both the payload root (a directory containing
+    /otls/) and the package JSON. Each parent directory is listed once, and both lookups share the same walk.
+    :return: a tuple of (payload path, package path). either can be None if it wasn't found.
+    """
+    this_path = os.path.abspath(start or ".")
+    key = ("probe", this_path, settings.NAME)
+    if key in _probe_cache:
+        return _probe_cache[key]
+    logging.debug("Finding payload and package JSON starting from path: {}".format(this_path))
+    package_name = "{}.json".format(settings.NAME)
+    payload_key, package_key = "otls", package_name
+    if sys.platform in ("win32", "darwin"):
+        package_key = package_key.lower()
+    payload = None
+    package = None
+    with hpackagetrace.span("probe", start=this_path) as info:
+        for depth in range(MAX_SEARCH_DEPTH):
+            logging.debug("Testing path: {}".format(this_path))
+            names = _list_names(this_path)
+            if payload is None and payload_key in names:
+                payload = this_path
+                logging.info("Found payload path: {}".format(payload))
+            if package is None and package_key in names:
+                package = os.path.join(this_path, package_name)
+                logging.info("Found package path: {}".format(package))
+            if payload is not None and package is not None:
+                break
+            parent = os.path.dirname(this_path)
+            if parent == this_path:
+                break
+            this_path = parent
+        info["depth"] = depth
+    _probe_cache[key] = (payload, package)
+    return payload, package
 
 
 def find_payload_path():
     """
     Locate the payload. If this is a sidecar file, we can just look in the same directory.
-    If this has an embedded payload, we can get it from /payload/.
+    If this has an embedded payload, we can get it from /payload.hpk (packed) or /payload/ (loose).
+    Otherwise, if settings.PAYLOAD_URL is set, the payload is downloaded from there at install time.
     """
     try:
-        payload_path = os.path.join(sys._MEIPASS, 'payload')
-        if os.path.exists(payload_path):
-            return payload_path
+        for name in (hpackagepack.PACK_NAME, 'payload'):
+            payload_path = os.path.join(sys._MEIPASS, name)
+            if os.path.exists(payload_path):
+                return payload_path
         raise FileNotFoundError
     except Exception:
         pass
-    this_path = os.path.abspath(".")
-    logging.debug("Finding payload starting from path: {}".format(this_path))
-    iter = 50
-    while iter > 0:
-        prev_path = this_path
-        test = os.path.join(this_path, "otls")
-        logging.debug("Testing path: {}".format(test))
-        if os.path.exists(test):
-            logging.info("Found payload path: {}".format(os.path.dirname(test)))
-            return os.path.dirname(test)
-        this_path = os.path.dirname(this_path)
-        if prev_path == this_path:
-            return None
-        iter -= 1
-    return None
+    if settings.PAYLOAD_URL:
+        return settings.PAYLOAD_URL
+    return probe_upwards()[0]
 
 
 def find_package_path():
-    this_path = os.path.abspath(".")
-    logging.debug("Finding package JSON starting from path: {}".format(this_path))
-    iter = 50
-    while iter > 0:
-        prev_path = this_path
-        test = os.path.join(this_path, settings.NAME) + ".json"
-        logging.debug("Testing path: {}".format(test))
-        if os.path.exists(test):
-            logging.info("Found package path: {}".format(test))
-            return test
-        this_path = os.path.dirname(this_path)
-        if prev_path == this_path:
-            return None
-        iter -= 1
-    return None
+    return probe_upwards()[1]
 
 
 def is_valid_install_path(testpath):
@@ -180,6 +265,59 @@ def is_valid_install_path(testpath):
 
     return True
 
+def get_default_install_path():
+    """
+    Return the default installation path. An embedded payload is extracted to a folder named after the package in
+    the user's home directory; a sidecar payload is used where it already is. A bundle installs each of its packages
+    into a folder below the one named after the bundle.
+    """
+    home_path = os.path.join(os.path.expanduser("~"), settings.NAME)
+    if hasattr(sys, "_MEIPASS") or settings.PAYLOAD_URL or settings.PACKAGES:
+        return home_path
+    return find_payload_path() or home_path
+
+
+def get_package_specs(names=None):
+    """
+    Return the packages this installer carries. Without settings.PACKAGES, that's the one package described by the
+    top-level settings.
+    :param names: only return the packages with these names. all of them if None.
+    :return: a list of dicts with the PACKAGE_KEYS of each package.
+    """
+    if not settings.PACKAGES:
+        return [{k: getattr(settings, k) for k in PACKAGE_KEYS}]
+    specs = list()
+    for entry in settings.PACKAGES:
+        unknown = set(entry) - set(PACKAGE_KEYS)
+        if unknown or "NAME" not in entry:
+            raise ValueError("Invalid package in PACKAGES: {}".format(entry))
+        spec = {"VERSION": settings.VERSION, "PAYLOAD": "", "PAYLOAD_URL": "", "PATH_VARS": list(),
+                "OTHER_VARS": dict()}
+        spec.update(entry)
+        if names is None or spec["NAME"] in names:
+            specs.append(spec)
+    return specs
+
+
+def find_bundle_payload(spec):
+    """
+    Locate the payload of one package of a bundle: embedded in the installer under payloads/<NAME>.hpk (or a
+    payloads/<NAME> directory), downloaded from its PAYLOAD_URL, or its PAYLOAD directory when running from source.
+    """
+    try:
+        for name in (spec["NAME"] + hpackagepack.PACK_EXTENSION, spec["NAME"]):
+            payload_path = os.path.join(sys._MEIPASS, BUNDLE_DIR, name)
+            if os.path.exists(payload_path):
+                return payload_path
+    except AttributeError:
+        pass
+    if spec["PAYLOAD_URL"]:
+        return spec["PAYLOAD_URL"]
+    if spec["PAYLOAD"] and os.path.exists(spec["PAYLOAD"]):
+        return spec["PAYLOAD"]
+    return None
+
+
 def get_resource(relative_path):
     """
     Get the relative path of a resource. This path can change if PyInstaller is used to create a single file.
@@ -193,7 +331,56 @@ def get_resource(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-def install_package(path_list, package=None, destination=None, payload=None, debug=False):
+def get_content_manifest(payload, path_filter=None, changed=None):
+    """
+    Get the content manifest to verify an install of payload against. An installer with an embedded loose payload
+    carries the manifest built by hpackagemaker; anything else is read from the packed index or hashed.
+    :param changed: when the payload has to be hashed, only hash these relative paths.
+    """
+    embedded = None
+    if hasattr(sys, "_MEIPASS") and os.path.abspath(payload) == os.path.join(sys._MEIPASS, "payload"):
+        embedded = os.path.join(sys._MEIPASS, hpackageverify.CONTENT_NAME)
+    with hpackagetrace.span("content_manifest", payload=payload):
+        return hpackageverify.get_manifest(payload, path_filter, embedded, settings.COPY_WORKERS, changed)
+
+
+def verify_install(path, payload, path_filter=None, repair=False, progress=None, changed=None):
+    """
+    Check an installed payload against the payload's content manifest.
+    :param path: the installed payload. for a versioned install, the version directory.
+    :param payload: the payload directory, packed payload or payload URL it was installed from.
+    :param repair: copy the files that don't match again, and check them once more.
+    :param progress: an optional hpackagecopy.Progress tracker.
+    :param changed: only hash these files, e.g. the ones just copied, and check the rest by size. everything is
+                    hashed if None.
+    :return: the result of hpackageverify.verify, with a "repaired" count. after a repair, "failed" only lists the
+             files that still don't match.
+    """
+    # imported here, so a headless run that doesn't install anything never loads urllib.
+    import hpackagefetch
+    if hpackagefetch.is_url(payload):
+        with hpackagetrace.span("download", url=payload):
+            payload = hpackagefetch.fetch_payload(payload)
+    files = get_content_manifest(payload, path_filter, changed)
+    with hpackagetrace.span("verify", path=path) as info:
+        result = hpackageverify.verify(path, files, settings.COPY_WORKERS, progress, changed)
+        result["repaired"] = 0
+        if repair and result["failed"]:
+            failed = list(result["failed"])
+            hpackageverify.repair(payload, path, files, failed)
+            for rel in failed:
+                # files that were only checked by size are hashed now that they've been copied again.
+                if files[rel]["hash"] is None:
+                    files[rel] = dict(files[rel], hash=hpackageverify.hash_file(os.path.join(payload, rel)))
+            recheck = hpackageverify.verify(path, {rel: files[rel] for rel in failed}, settings.COPY_WORKERS)
+            result["repaired"] = len(failed) - len(recheck["failed"])
+            result["failed"] = recheck["failed"]
+        info.update(checked=result["checked"], failed=len(result["failed"]), repaired=result["repaired"])
+    return result
+
+
+def install_package(path_list, package=None, destination=None, payload=None, debug=False, sync=None, delete=None,
+                    progress=None, cancel=None, force=False, spec=None, registry=None, write=True):
     """
     Configure the specified package file and copy it to the package path
     in each directory in path_list.
@@ -201,25 +388,135 @@ def install_package(path_list, package=None, destination=None, payload=None, deb
     :param package: the JSON file to configure, if one exists.
     :param destination: the location to copy files to. if not specified, uses the existing package path without copying.
     :param payload: the location of the source files. this is typically the same directory or a parent of this script.
+                    it can also be the HTTP(S) URL of a payload manifest, see hpackagefetch.
     :param debug: doesn't actually save or copy any files and prints a dry run instead.
+    :param sync: only copy new or changed payload files. defaults to settings.SYNC.
+    :param delete: when syncing, remove files from the destination that are no longer in the payload. defaults to settings.SYNC_DELETE.
+    :param progress: a callback that receives progress dicts while files are copied (files and bytes done versus
+                     total, throughput in bytes per second and ETA in seconds). it may be called from worker threads.
+    :param cancel: a threading.Event. setting it stops the copy before the next file, raising
+                   hpackagecopy.InstallCancelled.
+    :param force: copy the payload and write the package files even if the registry says they're already installed.
+    :param spec: the package to install, as returned by get_package_specs. defaults to the top-level settings.
+    :param registry: a registry loaded by the caller, who saves it afterwards. loaded and saved here if None.
+    :param write: write the package files. if False, the configurations that still need one are returned as
+                  "pending" for the caller to write, and the caller records them in the registry once it has.
+    :return: a dict describing the install (package name, install path, copy and verification statistics, package
+             files, the package data and whether the install was already up to date), or None if there was nothing
+             to install.
     """
-    data = None
+    if sync is None:
+        sync = settings.SYNC
+    if delete is None:
+        delete = settings.SYNC_DELETE
     install_path = None
+    copy_stats = None
+    compile_stats = None
+    verify_stats = None
+    content_hash = None
+    up_to_date = False
+    spec = spec or get_package_specs()[0]
+    name = spec["NAME"]
+    tracker = hpackagecopy.Progress(progress, cancel) if (progress or cancel) else None
+    save_registry = registry is None
+    if save_registry:
+        with hpackagetrace.span("registry"):
+            registry = hpackageregistry.load()
 
     if destination:
         install_path = destination
+        copy_path = destination
         # copy the contents of the package to this destination.
         if payload is None:
             payload = find_payload_path()
+        import hpackagefetch
+        if hpackagefetch.is_url(payload):
+            with hpackagetrace.span("download", url=payload):
+                payload = hpackagefetch.fetch_payload(payload)
         payload_is_destination = False
         if os.path.exists(destination):
             if os.path.samefile(payload, destination):
                 logging.info("Using existing payload location as package install path: {}".format(payload))
                 payload_is_destination = True
-        if not payload_is_destination:
-            logging.info("Copying payload at {} to install path: {}".format(payload, destination))
-            if not debug:
-                shutil.copytree(payload, install_path, dirs_exist_ok=True)
+        path_filter = hpackagefilter.get_payload_filter()
+        with hpackagetrace.span("payload_hash", payload=payload):
+            content_hash = hpackageregistry.payload_hash(payload, path_filter)
+        versioned = settings.VERSIONED_INSTALLS and not payload_is_destination
+        if versioned:
+            # each payload goes into its own version directory. the live version is never written to; it's
+            # switched over once the copy is complete.
+            version = hpackageversions.version_name(spec["VERSION"], content_hash)
+            copy_path = hpackageversions.version_path(destination, version)
+        lock = None
+        waited = False
+        if not payload_is_destination and not debug:
+            # installers writing to the same destination at once take turns, and only the first one copies.
+            lock = hpackagelock.InstallLock(destination, cancel=tracker)
+            with hpackagetrace.span("lock", destination=destination) as info:
+                waited = info["waited"] = lock.acquire()
+        try:
+            if not payload_is_destination and not force and \
+                    hpackageregistry.is_installed(registry, name, copy_path, content_hash, path_filter):
+                logging.info("Payload {} is already installed to {}, skipping copy.".format(content_hash, copy_path))
+                up_to_date = True
+            elif not payload_is_destination and not force and waited and \
+                    hpackagelock.read_marker(copy_path) == content_hash:
+                # another installer copied this payload while we were waiting for the lock. the marker is only
+                # trusted then; otherwise the destination is synced and verified as usual.
+                logging.info("Payload {} was already installed to {} by another installer, skipping copy.".format(
+                    content_hash, copy_path))
+                up_to_date = True
+            elif not payload_is_destination:
+                logging.info("Copying payload at {} to install path: {}".format(payload, copy_path))
+                if not debug:
+                    hpackagelock.clear_marker(copy_path)
+                with hpackagetrace.span("copy", payload=payload, destination=copy_path) as info:
+                    if settings.STORE_ROOT:
+                        copy_stats = hpackagestore.install_from_store(payload, copy_path, settings.STORE_ROOT,
+                                                                      delete=delete, engine=settings.COPY_ENGINE,
+                                                                      workers=settings.COPY_WORKERS, debug=debug,
+                                                                      progress=tracker, path_filter=path_filter,
+                                                                      force=force)
+                    elif hpackagepack.is_packed_payload(payload):
+                        copy_stats = hpackagepack.unpack_payload(payload, copy_path, sync=sync, delete=delete,
+                                                                 engine=settings.COPY_ENGINE,
+                                                                 workers=settings.COPY_WORKERS, debug=debug,
+                                                                 progress=tracker, path_filter=path_filter)
+                    else:
+                        copy_stats = hpackagecopy.copy_tree(payload, copy_path, sync=sync, delete=delete,
+                                                            engine=settings.COPY_ENGINE, workers=settings.COPY_WORKERS,
+                                                            debug=debug, progress=tracker, path_filter=path_filter)
+                    copied_files = copy_stats.pop("copied_files")
+                    info.update(copy_stats)
+                if settings.VERIFY_INSTALL and not debug:
+                    if tracker is not None:
+                        tracker.check_cancelled()
+                    # only the files copied in this run are hashed. the sync compared the rest with the payload.
+                    verify_stats = verify_install(copy_path, payload, path_filter, repair=True, progress=tracker,
+                                                  changed=copied_files)
+                    if verify_stats["failed"]:
+                        raise IOError("{} files in {} still don't match the payload after copying them again.".format(
+                            len(verify_stats["failed"]), copy_path))
+                if settings.PRECOMPILE and not debug:
+                    if tracker is not None:
+                        tracker.check_cancelled()
+                    # imported here, since it loads multiprocessing.
+                    import hpackagecompile
+                    with hpackagetrace.span("precompile", path=copy_path):
+                        compile_stats = hpackagecompile.precompile(copy_path, get_houdini_versions(path_list))
+                if not debug:
+                    hpackagelock.write_marker(copy_path, content_hash)
+            if versioned:
+                if tracker is not None:
+                    tracker.check_cancelled()
+                if debug:
+                    install_path = hpackageversions.current_path(destination)
+                else:
+                    install_path = hpackageversions.activate(destination, version)
+                    hpackageversions.prune(destination, settings.KEEP_VERSIONS)
+        finally:
+            if lock is not None:
+                lock.release()
 
     else:
         if package:
@@ -229,6 +526,160 @@ def install_package(path_list, package=None, destination=None, payload=None, deb
             # without an install path or a package defined, we have no idea what we're doing
             logging.error("No package path or installation path is defined! Aborting.")
             return
+    if tracker is not None:
+        tracker.check_cancelled()
+    with hpackagetrace.span("package_data", package=package):
+        data = build_package_data(package, install_path, spec)
+    package_hash = hpackageregistry.data_hash(data)
+    if force:
+        pending = list(path_list)
+    else:
+        pending = [p for p in path_list if not hpackageregistry.is_configured(registry, name, p, install_path,
+                                                                              content_hash, package_hash)]
+    if len(pending) < len(path_list):
+        logging.info("Package is already installed in {} of {} configurations.".format(
+            len(path_list) - len(pending), len(path_list)))
+    if write:
+        write_package_files(pending, data, debug, name)
+    package_files = [get_package_file(p, name) for p in path_list]
+    if not debug:
+        with hpackagetrace.span("registry_write"):
+            if destination:
+                hpackageregistry.record_destination(registry, name, spec["VERSION"], copy_path, content_hash,
+                                                    path_filter)
+            if write:
+                hpackageregistry.record_configs(registry, name, spec["VERSION"], install_path, content_hash,
+                                                package_hash, path_list, package_files)
+            if save_registry:
+                hpackageregistry.save(registry)
+    return {"name": name, "install_path": install_path.replace("\\", "/"), "copy": copy_stats,
+            "verify": verify_stats, "precompile": compile_stats, "package_files": package_files, "data": data,
+            "hash": content_hash, "pending": pending, "up_to_date": up_to_date and len(pending) == 0}
+
+
+def combine_progress(callback):
+    """
+    Merge the progress of several concurrent installs into one progress callback.
+    :return: a function that returns the progress callback for the install of a given package.
+    """
+    latest = dict()
+    lock = threading.Lock()
+
+    def for_package(name):
+        def report(p):
+            with lock:
+                latest[name] = p
+                total = {k: sum(s[k] for s in latest.values())
+                         for k in ("files_done", "files_total", "bytes_done", "bytes_total", "rate")}
+                total["elapsed"] = max(s["elapsed"] for s in latest.values())
+                remaining = total["bytes_total"] - total["bytes_done"]
+                total["eta"] = remaining / total["rate"] if total["rate"] > 0 else None
+                total["current"] = p["current"]
+                total["package"] = name
+            callback(total)
+        return report
+    return for_package
+
+
+def install_packages(path_list, specs, destination, debug=False, progress=None, cancel=None, force=False):
+    """
+    Install several packages of a bundle at once. The payloads are copied concurrently, each into
+    <destination>/<NAME>, and the package JSONs are written afterwards, one configuration at a time. The registry is
+    read and written once for all of them. If a package fails, the others still finish and are recorded in the
+    registry before the first error is raised.
+    :param path_list: the Houdini configurations to install to, discovered once for every package.
+    :param specs: the packages to install, as returned by get_package_specs.
+    :param destination: the directory the packages are installed into.
+    :param progress: a callback that receives the combined progress of every package.
+    :param cancel: a threading.Event that cancels all of the installs.
+    :return: a list of install_package results, in the order of specs.
+    """
+    with hpackagetrace.span("registry"):
+        registry = hpackageregistry.load()
+    package_progress = combine_progress(progress) if progress else None
+
+    def install_one(spec):
+        payload = find_bundle_payload(spec)
+        if not payload:
+            raise IOError("Payload for package {} not found.".format(spec["NAME"]))
+        # a package template can live in a payload directory, like for a single package.
+        template = os.path.join(payload, "{}.json".format(spec["NAME"]))
+        with hpackagetrace.span("package", package=spec["NAME"]):
+            return install_package(path_list, package=template if os.path.isfile(template) else None,
+                                   destination=os.path.join(destination, spec["NAME"]).replace("\\", "/"),
+                                   payload=payload, debug=debug,
+                                   progress=package_progress(spec["NAME"]) if package_progress else None,
+                                   cancel=cancel, force=force, spec=spec, registry=registry, write=False)
+
+    results = list()
+    errors = list()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(specs)), thread_name_prefix="hpackage_package") as pool:
+            futures = [pool.submit(install_one, spec) for spec in specs]
+            for spec, future in zip(specs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logging.error("Installing package {} failed: {}".format(spec["NAME"], e))
+                    errors.append(e)
+                    results.append(None)
+        installed = [(spec, result) for spec, result in zip(specs, results) if result]
+        with hpackagetrace.span("write_packages"):
+            for config in path_list:
+                for spec, result in installed:
+                    if config in result["pending"]:
+                        write_package_files([config], result["data"], debug, result["name"])
+        if not debug:
+            for spec, result in installed:
+                hpackageregistry.record_configs(registry, result["name"], spec["VERSION"], result["install_path"],
+                                                result["hash"], hpackageregistry.data_hash(result["data"]),
+                                                path_list, result["package_files"])
+    finally:
+        if not debug:
+            with hpackagetrace.span("registry_write"):
+                hpackageregistry.save(registry)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def switch_version(destination, version=None, package=None):
+    """
+    Switch a versioned install to another installed version without copying anything. If symlinks aren't
+    available, the package JSONs of every configuration using this install are rewritten to point at the version.
+    :param destination: the install root that holds the versions.
+    :param version: the version directory name to switch to. defaults to the previously active version (a rollback).
+    :param package: the JSON file to use as a template when package JSONs have to be rewritten.
+    :return: the path package JSONs reference.
+    """
+    version = version or hpackageversions.get_previous(destination)
+    if not version:
+        raise ValueError("There is no previous version to roll back to in {}".format(destination))
+    install_path = hpackageversions.activate(destination, version)
+    if hpackageversions.supports_symlinks(destination):
+        return install_path
+    registry = hpackageregistry.load()
+    entry = registry["packages"].get(settings.NAME, dict())
+    root = os.path.abspath(destination).replace("\\", "/")
+    configs = [c for c, e in entry.get("configs", dict()).items() if e["destination"].startswith(root + "/")]
+    content_hash = entry.get("destinations", dict()).get(install_path, dict()).get("hash")
+    data = build_package_data(package or find_package_path(), install_path)
+    package_files = write_package_files(configs, data)
+    hpackageregistry.record_configs(registry, settings.NAME, settings.VERSION, install_path, content_hash,
+                                    hpackageregistry.data_hash(data), configs, package_files)
+    hpackageregistry.save(registry)
+    return install_path
+
+
+def build_package_data(package, install_path, spec=None):
+    """
+    Build the contents of the package JSON for a given install path.
+    :param package: the JSON file to use as a template, if one exists.
+    :param install_path: the location the package files were installed to.
+    :param spec: the package, as returned by get_package_specs. defaults to the top-level settings.
+    :return: the package data, ready to be written to each Houdini configuration.
+    """
+    spec = spec or get_package_specs()[0]
     # handle path-based vars (for HOUDINI_PATH or other generic env stuff)
     install_path = install_path.replace("\\", "/")
     try:
@@ -248,8 +699,8 @@ def install_package(path_list, package=None, destination=None, payload=None, deb
         data.pop("path")
 
     found_path_var = False
-    if settings.PATH_VARS:
-        for var in settings.PATH_VARS:
+    if spec["PATH_VARS"]:
+        for var in spec["PATH_VARS"]:
             if data["env"]:
                 if var in data["env"][0].keys():
                     data["env"][0][var] = install_path
@@ -267,35 +718,54 @@ def install_package(path_list, package=None, destination=None, payload=None, deb
         data["hpath"] = install_path
 
     # handle any other specified vars in the settings file
-    if settings.OTHER_VARS.keys():
-        for k, v in settings.OTHER_VARS.items():
+    if spec["OTHER_VARS"].keys():
+        for k, v in spec["OTHER_VARS"].items():
             d = dict()
             d[k] = v
             data["env"].append(d)
 
     logging.debug("Package contents: {}".format(json.dumps(data, indent=3)))
+    return data
 
+
+def get_package_file(config, name=None):
+    """
+    Return the path of the package JSON inside a Houdini configuration.
+    :param name: the package name. defaults to settings.NAME.
+    """
+    return os.path.join(config, "packages", "{}.json".format(name or settings.NAME)).replace("\\", "/")
+
+
+def write_package_files(path_list, data, debug=False, name=None):
+    """
+    Write the package JSON into the packages directory of each Houdini configuration in path_list.
+    :param name: the package name. defaults to settings.NAME.
+    :return: the list of package files written.
+    """
+    package_files = list()
     for path in path_list:
         # create the package directory and get ready to write the modified JSON file
-        # print(path)
         packages_path = os.path.join(path, "packages").replace("\\", "/")
         if not os.path.exists(packages_path):
             logging.info("Created Houdini packages directory: {}".format(packages_path))
-            os.makedirs(packages_path)
+            if not debug:
+                os.makedirs(packages_path)
         else:
             logging.info("Writing package to existing Houdini packages directory: {}".format(packages_path))
-        out_path = os.path.join(packages_path, "{}.json".format(settings.NAME)).replace("\\", "/")
-        # print(json.dumps(data, indent=3))
+        out_path = get_package_file(path, name)
 
         if not debug:
-            with open(out_path, 'w') as f:
+            with hpackagetrace.span("write_package", path=out_path):
+                # write to a temporary file and rename it over the old one, so Houdini never reads a partial file.
+                tmp_path = "{}.{}.tmp".format(out_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f, indent=3)
+                os.replace(tmp_path, out_path)
                 logging.info("Wrote Houdini package file: {}".format(out_path))
-                json.dump(data, f, indent=3)
         else:
             logging.debug("Package file would be written to: {}".format(out_path))
-
-
-
+        package_files.append(out_path)
+    return package_files
 
 
 # install_mops(["D:/Documents/houdini18.5"], "D:/Projects/VFX/MOPS/MOPs.json")
\ No newline at end of file
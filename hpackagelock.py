@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import getpass
+import logging
+import threading
+import hpackagecopy
+import settings
+
+logger = logging.getLogger(__name__)
+
+# the lock owner touches the lock file this often, and a lock that hasn't been touched for STALE_AFTER seconds is
+# assumed to belong to a crashed or disconnected installer.
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0
+
+# how long to wait between attempts to take a held lock, at first and at most.
+POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 2.0
+
+
+class LockTimeout(Exception):
+    """
+    Raised when an install lock couldn't be taken within settings.LOCK_TIMEOUT.
+    """
+    pass
+
+
+def _owner_info():
+    user = None
+    try:
+        user = getpass.getuser()
+    except Exception:
+        pass
+    return {"host": socket.gethostname(), "pid": os.getpid(), "user": user, "time": time.time(),
+            "token": uuid.uuid4().hex}
+
+
+def read_owner(path):
+    """
+    Read the owner of a lock file.
+    :return: the owner dict, with the lock file's last heartbeat as "heartbeat", or None if there's no lock.
+    """
+    try:
+        with open(path, 'r') as f:
+            owner = json.load(f)
+        owner["heartbeat"] = os.stat(path).st_mtime
+        return owner
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # the owner is still writing it, or crashed before it could. either way the file's mtime tells how long
+        # ago it was last touched, so an empty or corrupt lock goes stale like any other.
+        try:
+            heartbeat = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        except OSError:
+            heartbeat = time.time()
+        return {"host": None, "pid": None, "token": None, "heartbeat": heartbeat}
+
+
+def _pid_alive(pid):
+    if sys.platform == "win32":
+        # os.kill would terminate the process on Windows. rely on the heartbeat there.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def is_stale(owner):
+    """
+    Decide whether a lock was abandoned: its heartbeat stopped, or it belongs to a process on this machine that
+    doesn't exist anymore.
+    """
+    if time.time() - owner["heartbeat"] > STALE_AFTER:
+        return True
+    return owner.get("host") == socket.gethostname() and owner.get("pid") and not _pid_alive(owner["pid"])
+
+
+class InstallLock(object):
+    """
+    Advisory lock on an install destination, shared by every machine that can see it. The lock is a file created
+    exclusively in the destination, holding the owner's host, pid and user; while it's held, a background thread
+    touches it as a heartbeat. Installers that find the lock held wait for it, and take over a lock whose owner
+    died. Plain files are used rather than fcntl or msvcrt locks, which aren't reliable on network shares.
+    """
+    def __init__(self, root, timeout=None, cancel=None):
+        """
+        :param root: the install destination.
+        :param timeout: seconds to wait for the lock before raising LockTimeout. defaults to settings.LOCK_TIMEOUT.
+                        0 waits as long as it takes.
+        :param cancel: an optional hpackagecopy.Progress tracker, checked for cancellation while waiting.
+        """
+        self.root = root
+        self.path = os.path.join(root, hpackagecopy.LOCK_NAME)
+        self.timeout = settings.LOCK_TIMEOUT if timeout is None else timeout
+        self.cancel = cancel
+        self.owner = None
+        self.waited = 0.0
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _try_create(self):
+        owner = _owner_info()
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(owner, f)
+        self.owner = owner
+        return True
+
+    def _break(self, owner):
+        """
+        Remove a stale lock. It's renamed away first, so if two installers try to break the same lock at once,
+        only one of them removes it; if the renamed lock turns out to be a new one, it's put back.
+        """
+        stale = "{}.stale-{}".format(self.path, uuid.uuid4().hex[:8])
+        try:
+            os.rename(self.path, stale)
+        except OSError:
+            return
+        renamed = read_owner(stale)
+        if renamed is not None and renamed.get("token") != owner.get("token"):
+            self._restore(stale, renamed)
+            return
+        logging.warning("Removed stale install lock in {} held by {} (pid {}) on {}".format(
+            self.root, owner.get("user"), owner.get("pid"), owner.get("host")))
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+    def _restore(self, stale, renamed):
+        """
+        Put back a live lock that _break renamed away. Unlike a rename, linking it back fails if a third installer
+        created a lock in the meantime, instead of replacing that installer's lock.
+        """
+        try:
+            os.link(stale, self.path)
+        except FileExistsError:
+            logging.warning("Could not restore the install lock in {} held by {} (pid {}) on {}, another installer "
+                            "took it in the meantime.".format(self.root, renamed.get("user"), renamed.get("pid"),
+                                                              renamed.get("host")))
+        except OSError:
+            # no hard links on this filesystem. recreate the lock exclusively instead, the owner's next heartbeat
+            # touches it like before.
+            try:
+                with open(stale, 'rb') as f:
+                    contents = f.read()
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(contents)
+            except OSError:
+                pass
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+
+    def acquire(self):
+        """
+        Take the lock, waiting for the current owner to finish if there is one.
+        :return: True if another installer held the lock while this one waited.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        start = time.perf_counter()
+        delay = POLL_INTERVAL
+        announced = None
+        while not self._try_create():
+            owner = read_owner(self.path)
+            if owner is None:
+                continue
+            if is_stale(owner):
+                self._break(owner)
+                continue
+            if announced != owner.get("token"):
+                logging.info("Waiting for the install by {} (pid {}) on {} to finish: {}".format(
+                    owner.get("user"), owner.get("pid"), owner.get("host"), self.root))
+                announced = owner.get("token")
+            if self.cancel is not None:
+                self.cancel.check_cancelled()
+            if self.timeout and time.perf_counter() - start > self.timeout:
+                raise LockTimeout("Timed out waiting for the install lock in {}".format(self.root))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+        self.waited = time.perf_counter() - start
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, name="hpackage-lock-heartbeat", daemon=True)
+        self._heartbeat.start()
+        logging.debug("Took install lock in {} after {:.2f} s".format(self.root, self.waited))
+        return announced is not None
+
+    def _beat(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                os.utime(self.path)
+            except OSError:
+                logging.warning("Install lock in {} disappeared while it was held.".format(self.root))
+                return
+
+    def release(self):
+        if self.owner is None:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        owner = read_owner(self.path)
+        if owner is not None and owner.get("token") == self.owner["token"]:
+            os.remove(self.path)
+        self.owner = None
+        logging.debug("Released install lock in {}".format(self.root))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def read_marker(path):
+    """
+    Return the content hash recorded in a destination's completion marker, or None.
+    """
+    try:
+        with open(os.path.join(path, hpackagecopy.MARKER_NAME), 'r') as f:
+            return json.load(f)["hash"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_marker(path, content_hash):
+    """
+    Mark a destination as a complete install of the payload with content_hash, for other installers to find.
+    """
+    marker = os.path.join(path, hpackagecopy.MARKER_NAME)
+    tmp = "{}.{}.tmp".format(marker, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({"hash": content_hash, "host": socket.gethostname(), "time": time.time()}, f)
+    os.replace(tmp, marker)
+
+
+def clear_marker(path):
+    """
+    Remove a destination's completion marker before its contents change.
+    """
+    try:
+        os.remove(os.path.join(path, hpackagecopy.MARKER_NAME))
+    except FileNotFoundError:
+        pass
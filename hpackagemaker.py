@@ -1,47 +1,547 @@
 import sys, os
+import json
+import argparse
+import glob
+import time
+import hashlib
+import string
+import statistics
+import PyInstaller
 import PyInstaller.__main__ as PI
 import hpackagelib
+import hpackagecopy
+import hpackagefetch
+import hpackagepack
+import hpackageverify
+import hpackagefilter
 import settings
 import platform
 import subprocess
-
-# TODO: find a way to generate and patch spec file with DLL exclusion list prior to building
-# TODO: exclusion list doesn't seem to do anything at all with onefile enabled?
+from concurrent.futures import ThreadPoolExecutor
 
 pkgname = "{}_install".format(settings.NAME)
 
-"""
+# the directory this script lives in. the generated spec references the UI script and modules from here.
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# environment variable that makes the built installer quit as soon as its window is up. used to time cold starts.
+STARTUP_PROBE_ENV = "HPACKAGE_STARTUP_PROBE"
+
+# how many of the largest bundled binaries to list in the build report.
+REPORT_TOP = 15
+
+# the settings module generated into each build's work directory.
+SETTINGS_NAME = "settings.py"
+
+# records the input hashes of the last successful build, in the work directory.
+BUILD_CACHE_NAME = "build_cache.json"
+
+# spec file template. binaries matching the exclude patterns are dropped from the analysis before anything is
+# collected, which is the only way to keep them out of a --onefile build, and the kept binaries are written to a
+# report for hpackagemaker to summarize.
+SPEC_TEMPLATE = string.Template('''# -*- mode: python ; coding: utf-8 -*-
+# generated by hpackagemaker.py -- edit settings.py instead of this file, it's overwritten on every build.
+import os
+import json
+import fnmatch
+
+EXCLUDE_BINARIES = $exclude_binaries
+REPORT_PATH = $report_path
+
+
+def excluded(dest):
+    dest = dest.replace(os.sep, "/")
+    name = os.path.basename(dest)
+    for pattern in EXCLUDE_BINARIES:
+        if "/" in pattern:
+            if fnmatch.fnmatch(dest, "*" + pattern) or fnmatch.fnmatch(dest, pattern):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+a = Analysis(
+    [$script],
+    pathex=$pathex,
+    binaries=[],
+    datas=$datas,
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=$exclude_modules,
+    noarchive=False,
+    optimize=0,
+)
+
 # HPACKAGE OPTIMIZATION
-WINDOWS_EXCLUDE_LIST = ['opengl32sw.dll', 'Qt5Network.dll', 'Qt5Pdf.dll', 'Qt5Qml.dll', 'Qt5QmlModels.dll', 'Qt5Quick.dll', 'Qt5Svg.dll', 'Qt5VirtualKeyboard.dll', 'Qt5WebSockets.dll']
-keep_list = list()
-for (dest, source, kind) in a.binaries:
-    if os.path.basename(dest) in WINDOWS_EXCLUDE_LIST:
-        continue
-    keep_list.append((dest, source, kind))
-# a.binaries = keep_list
+removed = [b for b in a.binaries if excluded(b[0])]
+a.binaries = [b for b in a.binaries if not excluded(b[0])]
+a.datas = [d for d in a.datas if not excluded(d[0])]
+with open(REPORT_PATH, "w") as f:
+    json.dump({
+        "binaries": [[dest, src, os.path.getsize(src)] for dest, src, kind in a.binaries if os.path.isfile(src)],
+        "removed": [[dest, src, os.path.getsize(src)] for dest, src, kind in removed if os.path.isfile(src)],
+    }, f)
 # END HPACKAGE OPTIMIZATION
-"""
 
+# bundle the settings generated for this build instead of the settings.py next to the installer scripts.
+SETTINGS = $settings
+a.pure = [(n, SETTINGS if n == "settings" else p, t) for n, p, t in a.pure]
+
+# the payload is added after the analysis, so changing it only repacks the executable instead of invalidating
+# PyInstaller's cached analysis in the work directory.
+# the files are listed in a separate file, so the spec itself doesn't change with the payload.
+PAYLOAD_FILES = $payload_files
+if PAYLOAD_FILES:
+    with open(PAYLOAD_FILES, "r") as f:
+        a.datas += [(dest, src, "DATA") for dest, src in json.load(f)]
+
+pyz = PYZ(a.pure)
+$collect
+''')
+
+ONEFILE_COLLECT = '''exe = EXE(
+    pyz,
+    a.scripts,
+    a.binaries,
+    a.datas,
+    [],
+    name=$name,
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=True,
+    upx_exclude=[],
+    runtime_tmpdir=None,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+'''
 
-def do_package(name=pkgname, path=settings.OUTPUT, embedpayload=True, onefile=True):
-    options = ['hpackage_ui.py', '--windowed', '-y', '--name', name]
-    if platform.system() == "Windows":
-        sep = ';'
+ONEDIR_COLLECT = '''exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name=$name,
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=True,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=True,
+    upx_exclude=[],
+    name=$name,
+)
+'''
+
+MACOS_BUNDLE = '''app = BUNDLE(
+    $target,
+    name=$name + ".app",
+    icon=None,
+    bundle_identifier=None,
+)
+'''
+
+
+def get_settings():
+    """
+    Return the settings from settings.py as a dict, e.g. {"NAME": "MOPs", ...}.
+    """
+    return {k: getattr(settings, k) for k in dir(settings) if k.isupper()}
+
+
+def write_settings(path, config):
+    """
+    Write a settings dict out as a settings module to bundle into an installer.
+    """
+    lines = ["# generated by hpackagemaker.py for this build.\n"]
+    for k, v in config.items():
+        lines.append("{} = {!r}\n".format(k, v))
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def get_exclude_list(config):
+    """
+    Return the binary exclusion patterns for the current platform, including CUSTOM_EXCLUDE_LIST.
+    """
+    system = platform.system()
+    if system == "Windows":
+        patterns = list(config["WINDOWS_EXCLUDE_LIST"])
+    elif system == "Darwin":
+        patterns = list(config["MACOS_EXCLUDE_LIST"])
     else:
-        sep = ':'
+        patterns = list(config["LINUX_EXCLUDE_LIST"])
+    return patterns + list(config["CUSTOM_EXCLUDE_LIST"])
+
+
+def write_spec(name, workpath, config, datas, payload=None, onefile=True):
+    """
+    Generate the PyInstaller spec file for the installer, and the settings module it bundles.
+    :param name: the name of the installer.
+    :param workpath: the PyInstaller work directory. the spec, settings and binary report are written here.
+    :param config: the settings for this build, as returned by get_settings.
+    :param datas: a list of (source, destination) data files to embed.
+    :param payload: an optional list of (source, destination file) pairs for the payload archive or files.
+    :param onefile: build a single executable instead of a directory.
+    :return: the paths of the spec file and the binary report it will write.
+    """
+    os.makedirs(workpath, exist_ok=True)
+    settings_path = os.path.join(workpath, SETTINGS_NAME)
+    write_settings(settings_path, config)
+    payload_list = os.path.join(workpath, "payload_files.json")
+    if payload:
+        with open(payload_list, 'w') as f:
+            json.dump([[dest, os.path.abspath(src)] for src, dest in payload], f)
+    spec_path = os.path.join(workpath, "{}.spec".format(name))
+    report_path = os.path.join(workpath, "binaries.json")
+    collect = string.Template(ONEFILE_COLLECT if onefile else ONEDIR_COLLECT).substitute(name=repr(name))
+    if platform.system() == "Darwin":
+        collect += string.Template(MACOS_BUNDLE).substitute(name=repr(name), target="exe" if onefile else "coll")
+    spec = SPEC_TEMPLATE.substitute(
+        exclude_binaries=repr(get_exclude_list(config)),
+        report_path=repr(os.path.abspath(report_path)),
+        script=repr(os.path.join(HERE, "hpackage_ui.py")),
+        pathex=repr([HERE]),
+        datas=repr([(os.path.abspath(src), dest) for src, dest in datas]),
+        payload_files=repr(os.path.abspath(payload_list) if payload else None),
+        exclude_modules=repr(list(config["EXCLUDE_MODULES"])),
+        settings=repr(os.path.abspath(settings_path)),
+        collect=collect,
+    )
+    with open(spec_path, 'w') as f:
+        f.write(spec)
+    return spec_path, report_path
+
+
+def hash_build_inputs(spec_path, datas):
+    """
+    Hash everything that goes into the installer except the payload: the generated spec and settings, the
+    installer's Python modules, the embedded data files and the PyInstaller and Python versions.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update("{} {}\n".format(PyInstaller.__version__, sys.version).encode("utf-8"))
+    paths = [spec_path, os.path.join(os.path.dirname(spec_path), SETTINGS_NAME)]
+    paths += sorted(glob.glob(os.path.join(HERE, "*.py"))) + [src for src, dest in datas]
+    for path in paths:
+        h.update(os.path.basename(path).encode("utf-8"))
+        with open(path, 'rb') as f:
+            h.update(hashlib.blake2b(f.read(), digest_size=16).digest())
+    return h.hexdigest()
+
+
+def load_build_cache(workpath):
+    try:
+        with open(os.path.join(workpath, BUILD_CACHE_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_build_cache(workpath, cache):
+    path = os.path.join(workpath, BUILD_CACHE_NAME)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + ".tmp", path)
+
+
+def get_executable_path(name, distpath, onefile=True):
+    exe = name + (".exe" if platform.system() == "Windows" else "")
+    if onefile:
+        return os.path.join(distpath, exe)
+    return os.path.join(distpath, name, exe)
+
+
+def measure_startup(exe, runs=3):
+    """
+    Launch the built installer a few times and time how long it takes until its window is up. The first launch
+    is the cold start; a --onefile build unpacks itself on every launch, so later ones aren't much faster.
+    :return: a list of wall clock times in seconds, or an empty list if the installer couldn't be run or exited
+             with an error, since the time it took to fail says nothing about its startup.
+    """
+    env = dict(os.environ)
+    env[STARTUP_PROBE_ENV] = "1"
+    # don't need a display just to time the startup.
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([exe], env=env, timeout=120, capture_output=True, text=True)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print("Could not time installer startup: {}".format(e))
+            return list()
+        if result.returncode != 0:
+            print("Could not time installer startup, it exited with code {}.".format(result.returncode))
+            output = (result.stdout + result.stderr).strip()
+            if output:
+                print(output)
+            return list()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def print_report(report_path, exe):
+    """
+    Summarize the build: the largest bundled binaries, what the exclude lists removed, the executable size
+    and the measured startup time.
+    """
+    if os.path.exists(report_path):
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+        binaries = sorted(report["binaries"], key=lambda b: b[2], reverse=True)
+        print("\nLargest bundled binaries:")
+        for dest, src, size in binaries[:REPORT_TOP]:
+            print("  {:>10.2f} MB  {}".format(size / 1048576.0, dest))
+        print("  {:>10.2f} MB  total in {} binaries".format(sum(b[2] for b in binaries) / 1048576.0, len(binaries)))
+        removed = report["removed"]
+        print("Excluded {} binaries ({:.2f} MB).".format(len(removed), sum(b[2] for b in removed) / 1048576.0))
+    if os.path.exists(exe):
+        print("Installer size: {:.2f} MB ({})".format(os.path.getsize(exe) / 1048576.0, exe))
+        times = measure_startup(exe)
+        if times:
+            print("Startup time: {:.2f} s cold, {:.2f} s median".format(times[0], statistics.median(times)))
+
+
+def do_package(name=None, path=None, embedpayload=True, onefile=True, report=True, force=False, config=None):
+    """
+    Build the installer. Builds are incremental: if the code, settings and payload are unchanged since the last
+    build the build is skipped, and PyInstaller's work directory is kept so that a payload-only change just
+    repacks the executable instead of re-analyzing every import.
+    :param name: the name of the installer. defaults to "<NAME>_install".
+    :param path: where to put the installer. defaults to OUTPUT, or "dist".
+    :param force: rebuild even if nothing changed.
+    :param config: the settings to build with, as returned by get_settings. defaults to settings.py.
+    :return: the path to the built installer.
+    """
+    config = config or get_settings()
+    name = name or "{}_install".format(config["NAME"])
+    datas = list()
+    payload = None
+    workpath = os.path.join('build', name)
+    distpath = path or config["OUTPUT"] or 'dist'
+    cache = dict() if force else load_build_cache(workpath)
+    payload_hash = None
+    payload_files = dict()
     if embedpayload:
-        if settings.PAYLOAD:
-            options.extend(['--add-data', '{}{}payload'.format(settings.PAYLOAD, sep)])
-    if path:
-        options.extend(['--distpath', path])
+        if config["PACKAGES"]:
+            payload_hash, payload_files, payload = pack_bundle(name, config, cache.get("payload_files"))
+        elif config["PAYLOAD"]:
+            path_filter = hpackagefilter.get_payload_filter(config["PAYLOAD_INCLUDE"], config["PAYLOAD_EXCLUDE"])
+            payload_hash, payload_files = hpackagepack.hash_payload(config["PAYLOAD"], cache.get("payload_files"),
+                                                                    path_filter)
+            if config["PACK_PAYLOAD"]:
+                # pack the payload into one compressed archive, so a onefile build doesn't have to unpack
+                # thousands of loose files every time it launches.
+                archive = os.path.join('build', '{}_payload'.format(name), hpackagepack.PACK_NAME)
+                if payload_hash != cache.get("payload") or not os.path.exists(archive):
+                    index = hpackagepack.pack_payload(config["PAYLOAD"], archive, payload_files, path_filter)
+                    print("Payload rules excluded {} files ({:.2f} MB).".format(
+                        index["excluded"]["files"], index["excluded"]["bytes"] / 1048576.0))
+                payload = [(archive, hpackagepack.PACK_NAME)]
+            else:
+                skipped = {"files": 0, "bytes": 0}
+                files = hpackagecopy.scan_tree(config["PAYLOAD"], path_filter, skipped)[1]
+                payload = [(os.path.join(config["PAYLOAD"], rel), "payload/" + rel) for rel in sorted(files)]
+                # the installer verifies what it copied against this. a packed payload's index already has it.
+                content = hpackageverify.write_manifest(os.path.join(workpath, hpackageverify.CONTENT_NAME),
+                                                        payload_files)
+                payload.append((content, hpackageverify.CONTENT_NAME))
+                print("Payload rules excluded {} files ({:.2f} MB).".format(skipped["files"],
+                                                                          skipped["bytes"] / 1048576.0))
     # embed the splash image
-    options.extend(['--add-data', '{}{}.'.format(settings.IMAGE, sep)])
-    if onefile:
-        options.append('--onefile')
+    if config["IMAGE"]:
+        datas.append((config["IMAGE"], '.'))
+
+    spec_path, report_path = write_spec(name, workpath, config, datas, payload, onefile)
+    code_hash = hash_build_inputs(spec_path, datas)
+    exe = get_executable_path(name, distpath, onefile)
+    if (cache.get("code") == code_hash and cache.get("payload") == payload_hash
+            and cache.get("exe") == os.path.abspath(exe) and os.path.exists(exe)):
+        print("Installer is up to date: {}".format(exe))
+        return exe
+    if cache.get("code") == code_hash:
+        print("Only the payload changed, reusing the cached analysis.")
+
+    PI.run([spec_path, '-y', '--distpath', distpath, '--workpath', workpath])
+    save_build_cache(workpath, {"code": code_hash, "payload": payload_hash, "payload_files": payload_files,
+                                "exe": os.path.abspath(exe)})
+    if report:
+        print_report(report_path, exe)
+    return exe
+
+
+def pack_bundle(name, config, cache=None):
+    """
+    Pack the payload of every package in PACKAGES, for embedding as payloads/<NAME>.hpk. Only the payloads that
+    changed since the last build are repacked.
+    :param cache: the payload_files of the last build, {package name: {relative path: [size, mtime, hash]}}.
+    :return: a tuple of (the combined payload hash, payload_files for the next build, the payload list for write_spec).
+    """
+    cache = cache or dict()
+    path_filter = hpackagefilter.get_payload_filter(config["PAYLOAD_INCLUDE"], config["PAYLOAD_EXCLUDE"])
+    h = hashlib.blake2b(digest_size=16)
+    payload_files = dict()
+    payload = list()
+    for package in config["PACKAGES"]:
+        if not package.get("PAYLOAD"):
+            # this package is downloaded from its PAYLOAD_URL at install time.
+            continue
+        package_name = package["NAME"]
+        cached = cache.get(package_name)
+        cached = cached if isinstance(cached, dict) else None
+        package_hash, payload_files[package_name] = hpackagepack.hash_payload(package["PAYLOAD"], cached, path_filter)
+        h.update("{} {}\n".format(package_name, package_hash).encode("utf-8"))
+        archive = os.path.join('build', '{}_payload'.format(name), hpackagelib.BUNDLE_DIR,
+                               package_name + hpackagepack.PACK_EXTENSION)
+        if payload_files[package_name] != cached or not os.path.exists(archive):
+            hpackagepack.pack_payload(package["PAYLOAD"], archive, payload_files[package_name], path_filter)
+            print("Packed payload for {}.".format(package_name))
+        payload.append((archive, "{}/{}{}".format(hpackagelib.BUNDLE_DIR, package_name, hpackagepack.PACK_EXTENSION)))
+    return h.hexdigest(), payload_files, payload
+
+
+def publish_payload(directory, config=None):
+    """
+    Pack the payload for an artifact server: writes the packed payload and the manifest that PAYLOAD_URL points to
+    into directory. Upload both to the same location.
+    :return: the path of the manifest.
+    """
+    config = config or get_settings()
+    path_filter = hpackagefilter.get_payload_filter(config["PAYLOAD_INCLUDE"], config["PAYLOAD_EXCLUDE"])
+    archive = os.path.join(directory, hpackagepack.PACK_NAME)
+    hpackagepack.pack_payload(config["PAYLOAD"], archive, path_filter=path_filter)
+    manifest = hpackagefetch.write_manifest(archive)
+    print("Published payload: {} ({:.2f} MB)".format(manifest, os.path.getsize(archive) / 1048576.0))
+    return manifest
+
+
+def load_manifest(path):
+    """
+    Read a build manifest: a JSON file with optional "defaults" and a "builds" dict mapping installer names to
+    settings overrides, e.g.
+
+        {
+            "defaults": {"PAYLOAD": "D:/Projects/MOPS"},
+            "builds": {
+                "MOPs_studioA_install": {"TITLE": "MOPs for Studio A", "SUPPORTED_VERSIONS": ["20.5"]},
+                "MOPs_studioB_install": {"TITLE": "MOPs for Studio B", "PATH_VARS": ["MOPS"]}
+            }
+        }
+
+    Relative PAYLOAD, IMAGE and OUTPUT paths are resolved against the manifest's directory, and relative paths
+    taken from settings.py against the directory settings.py is in.
+    :return: a dict of {installer name: settings dict}.
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    base = get_settings()
+    for k in ("PAYLOAD", "IMAGE"):
+        if base[k] and not os.path.isabs(base[k]):
+            base[k] = os.path.join(HERE, base[k])
+    root = os.path.dirname(os.path.abspath(path))
+    builds = dict()
+    for name, overrides in manifest["builds"].items():
+        config = dict(base)
+        for k, v in list(manifest.get("defaults", dict()).items()) + list(overrides.items()):
+            if k not in base:
+                raise ValueError("Unknown setting {} in build {}".format(k, name))
+            if k in ("PAYLOAD", "IMAGE", "OUTPUT") and v and not os.path.isabs(v):
+                v = os.path.join(root, v)
+            config[k] = v
+        builds[name] = config
+    return builds
+
+
+def build_one(name, config, force=False):
+    """
+    Build one installer of a manifest in its own process, with its own work directory and PyInstaller cache.
+    :return: a dict with the installer path, status, build time and size.
+    """
+    workpath = os.path.join('build', name)
+    os.makedirs(workpath, exist_ok=True)
+    config_path = os.path.join(workpath, "config.json")
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    cmd = [sys.executable, os.path.join(HERE, "hpackagemaker.py"), name, "--config", config_path]
+    if force:
+        cmd.append("--force")
+    env = dict(os.environ)
+    env["PYINSTALLER_CONFIG_DIR"] = os.path.abspath(os.path.join(workpath, "pyinstaller"))
+    start = time.perf_counter()
+    with open(os.path.join(workpath, "build.log"), 'w') as log:
+        code = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+    exe = get_executable_path(name, config["OUTPUT"] or 'dist')
+    return {"name": name, "exe": exe, "status": "ok" if code == 0 else "failed (exit {})".format(code),
+            "seconds": time.perf_counter() - start, "size": os.path.getsize(exe) if os.path.exists(exe) else 0,
+            "log": os.path.join(workpath, "build.log")}
+
+
+def build_manifest(path, jobs=None, force=False):
+    """
+    Build every installer in a manifest, several at once.
+    :param jobs: the number of builds to run at once. defaults to the number of CPUs.
+    :return: a list of build results, see build_one.
+    """
+    builds = load_manifest(path)
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(builds)))) as pool:
+        results = list(pool.map(lambda b: build_one(b[0], b[1], force), builds.items()))
+    return results
+
+
+def format_build_summary(results):
+    rows = [("INSTALLER", "STATUS", "SECONDS", "MB")]
+    for r in results:
+        rows.append((r["name"], r["status"], "{:.1f}".format(r["seconds"]), "{:.2f}".format(r["size"] / 1048576.0)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(col.ljust(w) for col, w in zip(row, widths)).rstrip() for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the hpackage installer.")
+    parser.add_argument("name", nargs="?", help="the installer name. defaults to <NAME>_install.")
+    parser.add_argument("path", nargs="?", help="where to put the installer. defaults to OUTPUT in settings.py.")
+    parser.add_argument("--manifest", "-m", help="build every installer in this manifest file.")
+    parser.add_argument("--jobs", "-j", type=int, help="number of manifest builds to run at once.")
+    parser.add_argument("--config", help="build with the settings in this JSON file instead of settings.py.")
+    parser.add_argument("--force", "-f", action="store_true", help="rebuild even if nothing changed.")
+    parser.add_argument("--publish", metavar="DIR", help="instead of building an installer, pack the payload and "
+                                                         "write it with its manifest to DIR for an artifact server.")
+    args = parser.parse_args(argv)
 
-    PI.run(options)
+    if args.manifest:
+        results = build_manifest(args.manifest, args.jobs, args.force)
+        print(format_build_summary(results))
+        return 0 if all(r["status"] == "ok" for r in results) else 1
+    config = None
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    if args.publish:
+        publish_payload(args.publish, config)
+        return 0
+    do_package(args.name, args.path, force=args.force, config=config)
+    return 0
 
 
 if __name__ == "__main__":
-    do_package(*sys.argv[1:])
-    # subprocess.run(["pyinstaller", "MOPs_install.spec"], env=os.environ)
+    sys.exit(main())
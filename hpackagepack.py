@@ -0,0 +1,236 @@
+import os
+import json
+import zlib
+import hashlib
+import shutil
+import zipfile
+import logging
+import hpackagecopy
+
+logger = logging.getLogger(__name__)
+
+# file extension for packed payloads.
+PACK_EXTENSION = ".hpk"
+
+# the name of a packed payload when it's embedded into an installer.
+PACK_NAME = "payload" + PACK_EXTENSION
+
+# the index describing every file in a packed payload.
+INDEX_NAME = "index.json"
+
+# packed payload format version, bumped whenever the index layout changes.
+PACK_VERSION = 1
+
+# formats that are already compressed. these are stored as-is instead of being deflated again.
+STORED_EXTENSIONS = (".sc", ".gz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".whl", ".png", ".jpg", ".jpeg",
+                     ".exr", ".rat", ".tx", ".mp4", ".mov", ".hdanc", ".hdalc")
+
+# files with other extensions are stored as-is if deflating their first block doesn't save at least this much.
+MIN_COMPRESSION_RATIO = 0.9
+PROBE_SIZE = 64 * 1024
+
+
+def is_packed_payload(path):
+    """
+    Return True if path is a packed payload archive rather than a payload directory.
+    """
+    return bool(path) and os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+def object_name(digest):
+    return "objects/{}".format(digest)
+
+
+def should_compress(path):
+    """
+    Decide whether a file is worth deflating. Known compressed formats never are; anything else is probed.
+    """
+    if path.lower().endswith(STORED_EXTENSIONS):
+        return False
+    with open(path, 'rb') as f:
+        probe = f.read(PROBE_SIZE)
+    if not probe:
+        return False
+    return len(zlib.compress(probe, 1)) < len(probe) * MIN_COMPRESSION_RATIO
+
+
+def hash_payload(src, cache=None, path_filter=None):
+    """
+    Compute a content hash for a whole payload directory. Files whose size and mtime match an entry in cache
+    aren't read again, so re-hashing a payload where little has changed is cheap.
+    :param src: the payload directory.
+    :param cache: the files dict returned by a previous call, if any.
+    :param path_filter: an optional hpackagefilter.PathFilter for payload files to leave out.
+    :return: a tuple of the payload hash and a dict of {relative path: [size, mtime, hash]} for the next call.
+    """
+    cache = cache or dict()
+    dirs, files = hpackagecopy.scan_tree(src, path_filter)
+    hashed = dict()
+    h = hashlib.blake2b(digest_size=16)
+    for d in dirs:
+        h.update("d {}\n".format(d).encode("utf-8"))
+    for rel in sorted(files):
+        st = files[rel]
+        cached = cache.get(rel)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            digest = cached[2]
+        else:
+            digest = hpackagecopy.file_digest(os.path.join(src, rel))
+        hashed[rel] = [st.st_size, st.st_mtime_ns, digest]
+        h.update("f {} {} {:o}\n".format(rel, digest, st.st_mode & 0o777).encode("utf-8"))
+    return h.hexdigest(), hashed
+
+
+def pack_payload(src, archive, digests=None, path_filter=None):
+    """
+    Pack a payload directory into a single archive. Every file is stored once per unique content,
+    under its content hash, and an index maps relative paths to those objects.
+    :param src: the payload directory.
+    :param archive: the archive file to write.
+    :param digests: optional {relative path: [size, mtime, hash]} from hash_payload, to avoid hashing files twice.
+    :param path_filter: an optional hpackagefilter.PathFilter for payload files to leave out.
+    :return: the index that was written. its "excluded" entry counts the files and bytes the filter left out.
+    """
+    digests = digests or dict()
+    skipped = {"files": 0, "bytes": 0}
+    dirs, files = hpackagecopy.scan_tree(src, path_filter, skipped)
+    index = {"version": PACK_VERSION, "dirs": dirs, "files": dict(), "excluded": skipped}
+    written = set()
+    os.makedirs(os.path.dirname(os.path.abspath(archive)), exist_ok=True)
+    tmp_archive = archive + ".tmp"
+    with zipfile.ZipFile(tmp_archive, 'w', allowZip64=True) as zf:
+        for rel in sorted(files):
+            st = files[rel]
+            path = os.path.join(src, rel)
+            known = digests.get(rel)
+            if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+                digest = known[2]
+            else:
+                digest = hpackagecopy.file_digest(path)
+            index["files"][rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "mode": st.st_mode & 0o777,
+                                   "hash": digest}
+            if digest in written:
+                logging.debug("Deduplicated payload file: {}".format(rel))
+                continue
+            compress_type = zipfile.ZIP_DEFLATED if should_compress(path) else zipfile.ZIP_STORED
+            zf.write(path, object_name(digest), compress_type=compress_type)
+            written.add(digest)
+        zf.writestr(INDEX_NAME, json.dumps(index), compress_type=zipfile.ZIP_DEFLATED)
+    os.replace(tmp_archive, archive)
+    logging.info("Packed {} files ({} unique) from {} into {} ({} bytes).".format(
+        len(files), len(written), src, archive, os.path.getsize(archive)))
+    if skipped["files"]:
+        logging.info("Payload rules excluded {} files ({} bytes).".format(skipped["files"], skipped["bytes"]))
+    return index
+
+
+def read_index(archive):
+    """
+    Return the index of a packed payload.
+    """
+    with zipfile.ZipFile(archive) as zf:
+        return json.loads(zf.read(INDEX_NAME))
+
+
+def filter_index(index, path_filter, stats=None):
+    """
+    Apply a PathFilter to a packed payload's index.
+    :param stats: an optional statistics dict whose "excluded" and "excluded_bytes" counts are updated.
+    :return: a tuple of (dirs, files) like hpackagecopy.scan_tree, with files mapping to index entries.
+    """
+    if not path_filter:
+        return index["dirs"], index["files"]
+    dirs = [d for d in index["dirs"] if not path_filter.excluded(d, True)]
+    files = dict()
+    for rel, info in index["files"].items():
+        if path_filter.excluded(rel):
+            if stats is not None:
+                stats["excluded"] += 1
+                stats["excluded_bytes"] += info["size"]
+        else:
+            files[rel] = info
+    return dirs, files
+
+
+def needs_extract(info, dst):
+    """
+    Decide whether a packed file has to be extracted over dst, the same way hpackagecopy.needs_copy does for
+    loose files. The archive already knows the content hash, so only the destination needs to be hashed.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return True
+    if info["size"] != dst_stat.st_size:
+        return True
+    if info["mtime"] // 1000000000 == int(dst_stat.st_mtime):
+        return False
+    if hpackagecopy.file_digest(dst) != info["hash"]:
+        return True
+    os.utime(dst, ns=(info["mtime"], info["mtime"]))
+    return False
+
+
+def extract_file(zf, info, dst):
+    """
+    Stream a single file out of an open archive straight into its destination.
+    """
+    with zf.open(object_name(info["hash"])) as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, hpackagecopy.COPY_BUFSIZE)
+    os.chmod(dst, info["mode"])
+    os.utime(dst, ns=(info["mtime"], info["mtime"]))
+
+
+def unpack_payload(archive, dst, sync=True, delete=False, engine="parallel", workers=None, debug=False,
+                   progress=None, path_filter=None):
+    """
+    Extract a packed payload into dst. Files are decompressed directly into place without any intermediate copy.
+    :param archive: the packed payload.
+    :param dst: the destination directory.
+    :param sync: if True, only new or changed files are extracted.
+    :param delete: if True (and syncing), files and directories in dst that aren't in the payload are removed.
+    :param engine: the name of the copy engine in hpackagecopy.ENGINES to use.
+    :param workers: the number of workers for engines that support them.
+    :param debug: doesn't actually write or delete anything and logs a dry run instead.
+    :param progress: an optional hpackagecopy.Progress tracker.
+    :param path_filter: an optional hpackagefilter.PathFilter for payload files to leave out.
+    :return: a dict of statistics for the extraction.
+    """
+    stats = hpackagecopy.new_stats()
+    with zipfile.ZipFile(archive) as zf:
+        index = json.loads(zf.read(INDEX_NAME))
+        dirs, files = filter_index(index, path_filter, stats)
+        hpackagecopy.make_dirs(dst, dirs, debug)
+
+        def extract_job(rel):
+            dst_path = os.path.join(dst, rel)
+            if sync and not needs_extract(files[rel], dst_path):
+                return None
+            if debug:
+                logging.debug("File would be extracted: {}".format(rel))
+                return "debug"
+            # extract under a temporary name, so a partial file never looks complete.
+            tmp = dst_path + hpackagecopy.PARTIAL_SUFFIX
+            extract_file(zf, files[rel], tmp)
+            os.replace(tmp, dst_path)
+            logging.debug("Extracted file: {}".format(rel))
+            return "extracted"
+
+        sizes = {rel: info["size"] for rel, info in files.items()}
+        if debug:
+            hpackagecopy.run_jobs(stats, sizes, extract_job, engine, workers, progress)
+        else:
+            keys = {rel: info["hash"] for rel, info in files.items()}
+            journal = hpackagecopy.Journal(dst)
+            try:
+                hpackagecopy.run_jobs(stats, sizes, extract_job, engine, workers, progress, journal, keys)
+            except BaseException:
+                journal.close()
+                raise
+            journal.close(complete=True)
+
+    if sync and delete:
+        hpackagecopy.delete_extraneous(dst, dirs, files, stats, debug, path_filter)
+
+    hpackagecopy.log_stats(stats)
+    return stats
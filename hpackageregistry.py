@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import hashlib
+import zipfile
+import logging
+import hpackagecopy
+import hpackagelock
+import hpackagepack
+import settings
+
+logger = logging.getLogger(__name__)
+
+# registry format version, bumped whenever the layout changes.
+REGISTRY_VERSION = 1
+
+
+def get_registry_path():
+    """
+    Return the path of the installed-package registry: settings.REGISTRY_PATH, or ~/.hpackage/registry.json.
+    """
+    return settings.REGISTRY_PATH or os.path.join(os.path.expanduser("~"), ".hpackage", "registry.json")
+
+
+def load(path=None):
+    """
+    Read the registry. A missing or unreadable registry is treated as empty.
+    :return: a dict of {"version": REGISTRY_VERSION, "packages": {name: {"destinations": ..., "configs": ...}}}.
+    """
+    path = path or get_registry_path()
+    try:
+        with open(path, 'r') as f:
+            registry = json.load(f)
+        if registry.get("version") == REGISTRY_VERSION:
+            return registry
+        logging.warning("Ignoring registry with unknown version: {}".format(path))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        logging.warning("Ignoring unreadable registry: {}".format(path))
+    return {"version": REGISTRY_VERSION, "packages": dict()}
+
+
+def save(registry, path=None):
+    """
+    Write the registry atomically, so a reader never sees a half-written file.
+    """
+    path = path or get_registry_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(registry, f, indent=3)
+    os.replace(tmp, path)
+
+
+def payload_hash(payload, path_filter=None):
+    """
+    Identify the contents of a payload. For a packed payload this is the hash of its index, which lists the content
+    hash of every file. For a payload directory it's a hash of every file's path, size, mtime and mode, which is
+    the same test a sync install uses to decide a file is unchanged, and doesn't read any file contents.
+    Files left out by path_filter don't count.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if hpackagepack.is_packed_payload(payload):
+        with zipfile.ZipFile(payload) as zf:
+            index = zf.read(hpackagepack.INDEX_NAME)
+        h.update(index)
+        # the same archive installed with different rules is a different install.
+        if path_filter:
+            files = hpackagepack.filter_index(json.loads(index), path_filter)[1]
+            h.update(repr(sorted(files)).encode("utf-8"))
+        return h.hexdigest()
+    dirs, files = hpackagecopy.scan_tree(payload, path_filter)
+    for d in dirs:
+        h.update("d {}\n".format(d).encode("utf-8"))
+    for rel in sorted(files):
+        st = files[rel]
+        h.update("f {} {} {} {:o}\n".format(rel, st.st_size, st.st_mtime_ns, st.st_mode & 0o777).encode("utf-8"))
+    return h.hexdigest()
+
+
+def data_hash(data):
+    """
+    Hash the contents of a package JSON.
+    """
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _normalize(path):
+    return os.path.abspath(path).replace("\\", "/")
+
+
+def get_package(registry, name):
+    return registry["packages"].setdefault(name, {"destinations": dict(), "configs": dict()})
+
+
+def summarize(destination, path_filter=None):
+    """
+    Count the files in an install and their total size, without reading them, to notice files that went missing or
+    changed size since it was recorded.
+    :return: a dict with the number of "files" and their total "bytes".
+    """
+    files = hpackagecopy.scan_tree(destination, path_filter)[1]
+    files = [st for rel, st in files.items() if rel not in hpackagecopy.RESERVED_NAMES]
+    return {"files": len(files), "bytes": sum(st.st_size for st in files)}
+
+
+def is_installed(registry, name, destination, content_hash, path_filter=None):
+    """
+    Return True if the registry says this exact payload was already installed to destination, and it's still there:
+    the destination has the completion marker for the payload, and the same number of files and bytes as when it was
+    installed. Damage that keeps every file's size is only caught by a sync with --force, or by --verify.
+    """
+    entry = registry["packages"].get(name, dict()).get("destinations", dict()).get(_normalize(destination))
+    if not entry or entry["hash"] != content_hash or "files" not in entry:
+        return False
+    if hpackagelock.read_marker(destination) != content_hash:
+        return False
+    summary = summarize(destination, path_filter)
+    if summary["files"] != entry["files"] or summary["bytes"] != entry["bytes"]:
+        logging.info("Install in {} changed since it was recorded ({} files, {} bytes; was {} files, {} bytes).".format(
+            destination, summary["files"], summary["bytes"], entry["files"], entry["bytes"]))
+        return False
+    return True
+
+
+def is_configured(registry, name, config, destination, content_hash, package_hash):
+    """
+    Return True if the registry says config already has this package JSON pointing at this install.
+    """
+    entry = registry["packages"].get(name, dict()).get("configs", dict()).get(_normalize(config))
+    if not entry:
+        return False
+    return (entry["destination"] == _normalize(destination) and entry["hash"] == content_hash
+            and entry["data_hash"] == package_hash and os.path.isfile(entry["package_file"]))
+
+
+def record_destination(registry, name, version, destination, content_hash, path_filter=None):
+    """
+    Record that the payload with content_hash is installed to destination, with the number and size of its files.
+    """
+    entry = {"version": version, "hash": content_hash, "time": time.time()}
+    entry.update(summarize(destination, path_filter))
+    get_package(registry, name)["destinations"][_normalize(destination)] = entry
+
+
+def record_configs(registry, name, version, destination, content_hash, package_hash, configs, package_files):
+    """
+    Record that each config in configs has a package file pointing at destination.
+    """
+    package = get_package(registry, name)
+    now = time.time()
+    for config, package_file in zip(configs, package_files):
+        package["configs"][_normalize(config)] = {
+            "version": version, "destination": _normalize(destination), "hash": content_hash,
+            "data_hash": package_hash, "package_file": package_file, "time": now}
+
+
+def get_status(name=None, path=None):
+    """
+    List what's installed where, from a single read of the registry.
+    :param name: only list this package, or the packages in a list of names. lists every package if None.
+    :return: a list of dicts with the package name, version, destination, content hash, config, package file and
+             install time, one per configuration the package was installed to.
+    """
+    registry = load(path)
+    names = [name] if isinstance(name, str) else name
+    status = list()
+    for package_name, package in sorted(registry["packages"].items()):
+        if names and package_name not in names:
+            continue
+        for config, entry in sorted(package["configs"].items()):
+            status.append({"name": package_name, "version": entry["version"], "destination": entry["destination"],
+                           "hash": entry["hash"], "config": config, "package_file": entry["package_file"],
+                           "time": entry["time"]})
+    return status
+
+
+def format_status(status):
+    """
+    Format the result of get_status as a plain text table.
+    """
+    rows = [("PACKAGE", "VERSION", "CONFIG", "DESTINATION", "INSTALLED")]
+    for s in status:
+        rows.append((s["name"], s["version"] or "-", s["config"], s["destination"],
+                     time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(s["time"]))))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(col.ljust(w) for col, w in zip(row, widths)).rstrip() for row in rows)
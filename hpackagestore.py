@@ -0,0 +1,235 @@
+import os
+import sys
+import stat
+import uuid
+import errno
+import zipfile
+import logging
+import hpackagecopy
+import hpackagepack
+
+logger = logging.getLogger(__name__)
+
+# link methods, in order of preference. hardlinks need the store and the destination on the same device.
+LINK_METHODS = ("hardlink", "symlink", "copy")
+
+
+def object_path(root, digest):
+    """
+    Return the path of the object with the given content hash in the store at root.
+    Objects are fanned out into subdirectories by the first two characters of their hash.
+    """
+    return os.path.join(root, "objects", digest[:2], digest)
+
+
+def _temp_name(path):
+    return "{}.{}.tmp".format(path, uuid.uuid4().hex)
+
+
+def is_valid_object(obj, digest, size):
+    """
+    Return True if the object at obj exists and still has the size and content hash it's stored under. Installs
+    link to objects, so one that was edited in place through an install would otherwise spread to every other one.
+    """
+    try:
+        if os.path.getsize(obj) != size:
+            return False
+    except OSError:
+        return False
+    return hpackagecopy.file_digest(obj) == digest
+
+
+def _seal(path):
+    """
+    Make an object read-only, so an installed file linked to it can't be edited in place.
+    """
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _replace_object(tmp, obj):
+    _seal(tmp)
+    if os.path.exists(obj):
+        logging.warning("Store object doesn't match its hash, replacing it: {}".format(obj))
+        # a read-only file can't be replaced on Windows.
+        os.chmod(obj, stat.S_IMODE(os.stat(obj).st_mode) | stat.S_IWUSR)
+    os.replace(tmp, obj)
+
+
+def add_file(root, src, digest, size):
+    """
+    Add the file at src to the store under digest, unless a valid object with that hash already exists. An object
+    that doesn't match its hash anymore is replaced.
+    :return: the object path, and True if a new object was written.
+    """
+    obj = object_path(root, digest)
+    if is_valid_object(obj, digest, size):
+        return obj, False
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    tmp = _temp_name(obj)
+    hpackagecopy.copy_file(src, tmp)
+    _replace_object(tmp, obj)
+    return obj, True
+
+
+def add_packed_file(root, zf, info):
+    """
+    Add a file from an open packed payload to the store, unless a valid object with its hash already exists. An
+    object that doesn't match its hash anymore is replaced.
+    :return: the object path, and True if a new object was written.
+    """
+    obj = object_path(root, info["hash"])
+    if is_valid_object(obj, info["hash"], info["size"]):
+        return obj, False
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    tmp = _temp_name(obj)
+    hpackagepack.extract_file(zf, info, tmp)
+    _replace_object(tmp, obj)
+    return obj, True
+
+
+def get_link_method(root, dst):
+    """
+    Pick the cheapest way to reference store objects from dst: a hardlink if both live on the same device,
+    a symlink otherwise, and a plain copy where symlinks aren't available.
+    """
+    try:
+        if os.stat(root).st_dev == os.stat(dst).st_dev:
+            return "hardlink"
+    except OSError:
+        pass
+    if sys.platform == "win32":
+        # creating symlinks on Windows needs developer mode or admin rights, so don't count on it.
+        return "copy"
+    return "symlink"
+
+
+def link_object(obj, dst, method):
+    """
+    Point dst at a store object. The link is created under a temporary name and renamed into place,
+    so dst is never missing or half-written.
+    :return: the method that was actually used.
+    """
+    tmp = _temp_name(dst)
+    for m in LINK_METHODS[LINK_METHODS.index(method):]:
+        try:
+            if m == "hardlink":
+                os.link(obj, tmp)
+            elif m == "symlink":
+                os.symlink(obj, tmp)
+            else:
+                hpackagecopy.copy_file(obj, tmp)
+                # a copy is independent of the store, so it doesn't have to stay read-only.
+                os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) | stat.S_IWUSR)
+        except OSError as e:
+            if e.errno not in hpackagecopy.UNSUPPORTED_ERRNOS and e.errno != errno.EMLINK:
+                raise
+            logging.debug("Could not {} {} ({}), trying the next method.".format(m, dst, e))
+            continue
+        os.replace(tmp, dst)
+        return m
+    raise OSError("Unable to link {} to {}".format(dst, obj))
+
+
+def is_linked(obj, dst):
+    try:
+        return os.path.samefile(obj, dst)
+    except OSError:
+        return False
+
+
+def _is_unchanged_link(src_stat, dst):
+    """
+    Cheap check for loose payloads: if dst is already a link into the store with the same size and
+    modification time as the source file, skip hashing the source.
+    """
+    try:
+        dst_stat = os.stat(dst)
+        if not (dst_stat.st_nlink > 1 or os.path.islink(dst)):
+            return False
+    except OSError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def install_from_store(payload, dst, root, delete=False, engine="parallel", workers=None, debug=False,
+                       progress=None, path_filter=None, force=False):
+    """
+    Install a payload by adding its files to the content-addressed store at root and building dst out of
+    links into the store. Only objects the store doesn't already have are written, so installing another
+    version of a package only costs the files that changed.
+    :param payload: the payload directory or packed payload.
+    :param dst: the destination directory.
+    :param root: the root of the content-addressed store.
+    :param delete: if True, files and directories in dst that aren't in the payload are removed.
+    :param engine: the name of the copy engine in hpackagecopy.ENGINES to use.
+    :param workers: the number of workers for engines that support them.
+    :param debug: doesn't actually write or delete anything and logs a dry run instead.
+    :param progress: an optional hpackagecopy.Progress tracker.
+    :param path_filter: an optional hpackagefilter.PathFilter for payload files to leave out.
+    :param force: also check the objects of files that are already linked, and replace and relink the ones that
+                  don't match their hash.
+    :return: a dict of statistics for the install.
+    """
+    stats = hpackagecopy.new_stats()
+    added_objects = list()
+    if not debug:
+        os.makedirs(root, exist_ok=True)
+
+    packed = hpackagepack.is_packed_payload(payload)
+    zf = None
+    if packed:
+        zf = zipfile.ZipFile(payload)
+        index = hpackagepack.read_index(payload)
+        dirs, files = hpackagepack.filter_index(index, path_filter, stats)
+        sizes = {rel: info["size"] for rel, info in files.items()}
+    else:
+        skipped = {"files": 0, "bytes": 0}
+        dirs, files = hpackagecopy.scan_tree(payload, path_filter, skipped)
+        stats["excluded"], stats["excluded_bytes"] = skipped["files"], skipped["bytes"]
+        sizes = {rel: st.st_size for rel, st in files.items()}
+
+    hpackagecopy.make_dirs(dst, dirs, debug)
+    method = get_link_method(root, dst) if not debug else "hardlink"
+    logging.info("Installing from object store {} using {}s.".format(root, method))
+
+    def store_job(rel):
+        dst_path = os.path.join(dst, rel)
+        if packed:
+            digest = files[rel]["hash"]
+        else:
+            src_path = os.path.join(payload, rel)
+            if not force and _is_unchanged_link(files[rel], dst_path):
+                return None
+            digest = hpackagecopy.file_digest(src_path)
+        obj = object_path(root, digest)
+        if not force and is_linked(obj, dst_path):
+            return None
+        if debug:
+            logging.debug("File would be linked from the store: {}".format(rel))
+            return "debug"
+        if packed:
+            obj, added = add_packed_file(root, zf, files[rel])
+        else:
+            obj, added = add_file(root, src_path, digest, files[rel].st_size)
+        if added:
+            added_objects.append(digest)
+        elif is_linked(obj, dst_path):
+            # with force: already linked to an object that checked out.
+            return None
+        used = link_object(obj, dst_path, method)
+        logging.debug("Linked file ({}): {}".format(used, rel))
+        return used
+
+    try:
+        hpackagecopy.run_jobs(stats, sizes, store_job, engine, workers, progress)
+    finally:
+        if zf is not None:
+            zf.close()
+
+    if delete:
+        hpackagecopy.delete_extraneous(dst, dirs, files, stats, debug, path_filter)
+
+    stats["objects"] = len(added_objects)
+    hpackagecopy.log_stats(stats)
+    logging.info("New objects written to the store: {}".format(stats["objects"]))
+    return stats
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextlib
+import logging.handlers
+import settings
+
+logger = logging.getLogger(__name__)
+
+# where the installer log goes.
+LOG_PATH = os.path.join(os.path.expanduser("~"), "hpackage.log")
+LOG_FORMAT = '%(asctime)s -- %(levelname)s: %(message)s'
+LOG_DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+# environment variables that turn on trace export and profiling without touching settings.py.
+TRACE_ENV = "HPACKAGE_TRACE"
+PROFILE_ENV = "HPACKAGE_PROFILE"
+
+# recorded spans, as Chrome trace events.
+_events = list()
+_events_lock = threading.Lock()
+_epoch = time.perf_counter()
+
+_listener = None
+_profiler = None
+
+
+def configure_logging(path=LOG_PATH, level=logging.DEBUG):
+    """
+    Send log records to the installer log through a queue. Callers only pay for putting a record on the queue;
+    a background listener thread does the formatting and the file writes, so logging never blocks a copy.
+    Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(path, mode="w")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Flush any queued log records and stop the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def add_log_handler(handler):
+    """
+    Attach another handler (e.g. a console handler) behind the log queue.
+    """
+    if _listener is None:
+        logging.getLogger().addHandler(handler)
+        return
+    handler.setFormatter(handler.formatter or logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    _listener.handlers = _listener.handlers + (handler,)
+
+
+def _now_us():
+    return (time.perf_counter() - _epoch) * 1000000.0
+
+
+@contextlib.contextmanager
+def span(name, category="install", **args):
+    """
+    Time a phase of the install. The span is recorded as a Chrome trace event and its duration is logged.
+    The yielded dict holds the span's arguments; add to it inside the block to record results such as byte or file
+    counts.
+
+        with hpackagetrace.span("copy", payload=payload) as info:
+            info["bytes"] = copy_stats["bytes"]
+    """
+    start = _now_us()
+    try:
+        yield args
+    finally:
+        duration = _now_us() - start
+        event = {"name": name, "cat": category, "ph": "X", "ts": start, "dur": duration, "pid": os.getpid(),
+                 "tid": threading.get_ident(), "args": args}
+        with _events_lock:
+            _events.append(event)
+        logging.debug("Phase {} took {:.3f} s {}".format(name, duration / 1000000.0, args if args else ""))
+
+
+def mark(name, category="install", **args):
+    """
+    Record an instant event, e.g. the window's first paint.
+    :return: the time of the event in seconds since the installer started.
+    """
+    event = {"name": name, "cat": category, "ph": "i", "s": "p", "ts": _now_us(), "pid": os.getpid(),
+             "tid": threading.get_ident(), "args": args}
+    with _events_lock:
+        _events.append(event)
+    return event["ts"] / 1000000.0
+
+
+def get_events():
+    with _events_lock:
+        return list(_events)
+
+
+def export_trace(path):
+    """
+    Write every recorded span as a Chrome trace file (load it in chrome://tracing or https://ui.perfetto.dev).
+    """
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": get_events(), "displayTimeUnit": "ms"}, f, default=str)
+    logging.info("Wrote install trace: {}".format(path))
+
+
+def start_profile():
+    """
+    Start profiling the main thread with cProfile.
+    """
+    global _profiler
+    import cProfile
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def stop_profile(path):
+    """
+    Stop the profiler and save its stats to path, for pstats or snakeviz.
+    """
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.disable()
+    _profiler.dump_stats(path)
+    _profiler = None
+    logging.info("Wrote install profile: {}".format(path))
+
+
+def start(trace_path=None, profile_path=None):
+    """
+    Set up logging and, if asked to, profiling for an installer entry point. Paths default to the HPACKAGE_TRACE and
+    HPACKAGE_PROFILE environment variables, then to settings.TRACE_PATH and settings.PROFILE_PATH.
+    :return: a function to call when the installer is done. it writes the trace and profile, if enabled.
+    """
+    configure_logging()
+    trace_path = trace_path or os.environ.get(TRACE_ENV) or settings.TRACE_PATH
+    profile_path = profile_path or os.environ.get(PROFILE_ENV) or settings.PROFILE_PATH
+    if profile_path:
+        start_profile()
+
+    def finish():
+        if profile_path:
+            stop_profile(profile_path)
+        if trace_path:
+            export_trace(trace_path)
+
+    return finish
@@ -0,0 +1,166 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import zipfile
+import logging
+import hpackagecopy
+import hpackagepack
+
+logger = logging.getLogger(__name__)
+
+# the content manifest embedded into installers with a loose payload. packed payloads use their index instead.
+CONTENT_NAME = "content.json"
+
+# content manifest format version, bumped whenever the layout changes.
+CONTENT_VERSION = 1
+
+
+def hash_file(path):
+    """
+    Return the same content hash as hpackagecopy.file_digest, reading the file through a memory map. The whole file
+    is hashed in a single call that releases the GIL, so several files hash in parallel on a thread pool.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # some network filesystems can't be memory mapped.
+            return hpackagecopy.file_digest(path)
+        with m:
+            h.update(m)
+    return h.hexdigest()
+
+
+def write_manifest(path, digests):
+    """
+    Write a content manifest for a loose payload.
+    :param digests: {relative path: [size, mtime, hash]}, as returned by hpackagepack.hash_payload.
+    """
+    files = {rel: {"size": d[0], "hash": d[2]} for rel, d in digests.items()}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"version": CONTENT_VERSION, "files": files}, f)
+    return path
+
+
+def read_manifest(path):
+    """
+    Read a content manifest.
+    :return: a dict of {relative path: {"size": bytes, "hash": content hash}}.
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get("version") != CONTENT_VERSION:
+        raise ValueError("Unknown content manifest version: {}".format(path))
+    return manifest["files"]
+
+
+def build_manifest(payload, path_filter=None, workers=None, changed=None):
+    """
+    Hash a payload directory in parallel, for payloads that don't come with a content manifest.
+    :param changed: only hash these relative paths. the others get a hash of None. all files are hashed if None.
+    :return: a dict of {relative path: {"size": bytes, "hash": content hash}}.
+    """
+    files = hpackagecopy.scan_tree(payload, path_filter)[1]
+    jobs = sorted(files) if changed is None else sorted(set(changed) & set(files))
+    digests = hpackagecopy.run_parallel(jobs, lambda rel: hash_file(os.path.join(payload, rel)), workers)
+    digests = dict(zip(jobs, digests))
+    return {rel: {"size": st.st_size, "hash": digests.get(rel)} for rel, st in files.items()}
+
+
+def get_manifest(payload, path_filter=None, embedded=None, workers=None, changed=None):
+    """
+    Return the content manifest for a payload: the index of a packed payload, the manifest embedded next to a loose
+    payload at build time, or the hashes of the payload directory itself.
+    :param embedded: the path of a content manifest that was built from this payload, if there is one.
+    :param changed: when the payload directory has to be hashed, only hash these relative paths. see build_manifest.
+    :return: a dict of {relative path: {"size": bytes, "hash": content hash}}, without the files path_filter leaves out.
+    """
+    if hpackagepack.is_packed_payload(payload):
+        return hpackagepack.filter_index(hpackagepack.read_index(payload), path_filter)[1]
+    if embedded and os.path.isfile(embedded):
+        files = read_manifest(embedded)
+        if path_filter:
+            files = {rel: info for rel, info in files.items() if not path_filter.excluded(rel)}
+        return files
+    logging.info("No content manifest for {}, hashing the payload.".format(payload))
+    return build_manifest(payload, path_filter, workers, changed)
+
+
+def verify(root, files, workers=None, progress=None, changed=None):
+    """
+    Check that every file in a content manifest exists in root with the right size and contents. Sizes are checked
+    first, so a truncated file is caught without reading it; the rest are hashed in parallel.
+    :param root: the installed payload.
+    :param files: the content manifest, as returned by get_manifest.
+    :param workers: the number of files to hash at once.
+    :param progress: an optional hpackagecopy.Progress tracker.
+    :param changed: only hash these relative paths, e.g. the files a sync just copied. the others are only checked
+                    for their size, since the sync already compared them with the payload by size and mtime. all
+                    files are hashed if None.
+    :return: a dict with the path, the number of files checked, hashed and their bytes, the time it took, and a
+             "failed" dict of {relative path: "missing", "size" or "hash"} for every file that doesn't match.
+    """
+    start = time.perf_counter()
+    hashed = set(files) if changed is None else set(changed) & set(files)
+    hashed = set(rel for rel in hashed if files[rel]["hash"] is not None)
+
+    def check(rel):
+        path = os.path.join(root, rel)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return "missing"
+        if size != files[rel]["size"]:
+            return "size"
+        if rel in hashed and hash_file(path) != files[rel]["hash"]:
+            return "hash"
+        return None
+
+    jobs = sorted(files)
+    func = check
+    if progress is not None:
+        sizes = {rel: files[rel]["size"] if rel in hashed else 0 for rel in jobs}
+        progress.start(len(jobs), sum(sizes.values()))
+        func = progress.track(check, sizes)
+    results = hpackagecopy.run_parallel(jobs, func, workers)
+    failed = {rel: reason for rel, reason in zip(jobs, results) if reason}
+    elapsed = time.perf_counter() - start
+    total = sum(info["size"] for info in files.values())
+    logging.info("Verified {} files ({} bytes, {} files hashed) in {} in {:.2f} s: {} failed.".format(
+        len(jobs), total, len(hashed), root, elapsed, len(failed)))
+    for rel, reason in sorted(failed.items()):
+        logging.warning("File doesn't match the payload ({}): {}".format(reason, rel))
+    return {"path": root, "checked": len(jobs), "hashed": len(hashed), "bytes": total, "elapsed": elapsed,
+            "failed": failed}
+
+
+def repair(payload, root, files, failed):
+    """
+    Copy the files that failed verification from the payload again, leaving everything else alone.
+    :param payload: the payload directory or packed payload.
+    :param root: the installed payload.
+    :param files: the content manifest. for a packed payload, this is its (filtered) index.
+    :param failed: the relative paths to copy.
+    """
+    packed = hpackagepack.is_packed_payload(payload)
+    zf = zipfile.ZipFile(payload) if packed else None
+    try:
+        for rel in sorted(failed):
+            dst = os.path.join(root, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if packed:
+                tmp = dst + hpackagecopy.PARTIAL_SUFFIX
+                hpackagepack.extract_file(zf, files[rel], tmp)
+                os.replace(tmp, dst)
+            else:
+                hpackagecopy.atomic_copy(os.path.join(payload, rel), dst)
+            logging.info("Re-copied file that failed verification: {}".format(rel))
+    finally:
+        if zf is not None:
+            zf.close()
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# layout of a versioned install:
+#   <destination>/versions/<version>/   one directory per installed payload
+#   <destination>/current               symlink to the active version, referenced by every package JSON
+#   <destination>/versions.json         the active version and the activation history
+VERSIONS_DIR = "versions"
+CURRENT_NAME = "current"
+STATE_NAME = "versions.json"
+
+# pruned versions are renamed to this prefix first, so they disappear at once and are deleted in the background.
+TRASH_PREFIX = ".trash-"
+
+# whether symlinks can be created in a destination, keyed by destination.
+_symlink_support = dict()
+
+
+def version_name(version, content_hash):
+    """
+    Name the directory for a payload. The content hash keeps two different payloads with the same VERSION apart.
+    """
+    if version:
+        return "{}-{}".format(version, content_hash[:8])
+    return content_hash[:12]
+
+
+def version_path(root, name):
+    return os.path.join(root, VERSIONS_DIR, name).replace("\\", "/")
+
+
+def current_path(root):
+    return os.path.join(root, CURRENT_NAME).replace("\\", "/")
+
+
+def load_state(root):
+    try:
+        with open(os.path.join(root, STATE_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"current": None, "history": list()}
+
+
+def save_state(root, state):
+    path = os.path.join(root, STATE_NAME)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=3)
+    os.replace(tmp, path)
+
+
+def supports_symlinks(root):
+    """
+    Return True if a "current" symlink can be created in root. Creating symlinks on Windows needs developer mode
+    or admin rights; without them, package JSONs point at the version directory directly and are rewritten to switch.
+    """
+    if root not in _symlink_support:
+        test = os.path.join(root, ".hpackage_symlink_test{}".format(os.getpid()))
+        try:
+            os.symlink(VERSIONS_DIR, test, target_is_directory=True)
+            os.remove(test)
+            _symlink_support[root] = True
+        except (OSError, NotImplementedError, AttributeError):
+            _symlink_support[root] = False
+        logging.debug("Symlinks supported in {}: {}".format(root, _symlink_support[root]))
+    return _symlink_support[root]
+
+
+def get_install_path(root, name):
+    """
+    Return the path package JSONs should reference for version name: the "current" symlink if symlinks work,
+    otherwise the version directory itself.
+    """
+    if supports_symlinks(root):
+        return current_path(root)
+    return version_path(root, name)
+
+
+def get_active_path(root):
+    """
+    Return the directory holding the active payload: the current version of a versioned install, or root itself.
+    """
+    current = load_state(root)["current"]
+    if current and os.path.isdir(version_path(root, current)):
+        return version_path(root, current)
+    return root
+
+
+def activate(root, name):
+    """
+    Make a version the active one. With symlinks this is a single atomic rename of a new "current" link over the
+    old one, so Houdini sessions starting at any moment see either the old or the new version, never a mix.
+    :return: the path package JSONs should reference.
+    """
+    if not os.path.isdir(version_path(root, name)):
+        raise ValueError("Version {} is not installed in {}".format(name, root))
+    if supports_symlinks(root):
+        tmp = "{}.{}.tmp".format(current_path(root), os.getpid())
+        os.symlink(os.path.join(VERSIONS_DIR, name), tmp, target_is_directory=True)
+        os.replace(tmp, current_path(root))
+    state = load_state(root)
+    state["history"] = [h for h in state["history"] if h["version"] != name]
+    state["history"].append({"version": name, "time": time.time()})
+    state["current"] = name
+    save_state(root, state)
+    logging.info("Activated version {} in {}".format(name, root))
+    return get_install_path(root, name)
+
+
+def list_versions(root):
+    """
+    List the installed versions, most recently activated first.
+    :return: a list of dicts with each version's name, path, whether it's current, and when it was last activated.
+    """
+    state = load_state(root)
+    activated = {h["version"]: h["time"] for h in state["history"]}
+    versions = list()
+    try:
+        entries = list(os.scandir(os.path.join(root, VERSIONS_DIR)))
+    except FileNotFoundError:
+        entries = list()
+    for entry in entries:
+        if entry.name.startswith(TRASH_PREFIX) or not entry.is_dir(follow_symlinks=False):
+            continue
+        versions.append({"version": entry.name, "path": version_path(root, entry.name),
+                         "current": entry.name == state["current"],
+                         "time": activated.get(entry.name, entry.stat().st_mtime)})
+    versions.sort(key=lambda v: v["time"], reverse=True)
+    return versions
+
+
+def get_previous(root):
+    """
+    Return the version that was active before the current one, or None.
+    """
+    state = load_state(root)
+    installed = set(v["version"] for v in list_versions(root))
+    for h in reversed(state["history"]):
+        if h["version"] != state["current"] and h["version"] in installed:
+            return h["version"]
+    return None
+
+
+def prune(root, keep, background=True):
+    """
+    Remove all but the keep most recently activated versions. The current version is always kept. Old versions are
+    renamed out of the way immediately and deleted on a background thread, so the install doesn't wait for it.
+    :param keep: the number of versions to keep. 0 keeps everything.
+    :param background: delete on a background thread and return it, instead of deleting before returning.
+    :return: the deleting thread, or None.
+    """
+    if not keep:
+        return None
+    versions = list_versions(root)
+    kept = [v for v in versions if v["current"]]
+    kept += [v for v in versions if not v["current"]][:max(0, keep - len(kept))]
+    kept_names = set(v["version"] for v in kept)
+    versions_dir = os.path.join(root, VERSIONS_DIR)
+    # pick up anything left over from a prune that was interrupted.
+    trash = [e.path for e in os.scandir(versions_dir) if e.name.startswith(TRASH_PREFIX)]
+    for v in versions:
+        if v["version"] not in kept_names:
+            # unique, so a leftover from an earlier prune of the same version is never in the way.
+            path = os.path.join(versions_dir, "{}{}.{}".format(TRASH_PREFIX, v["version"], uuid.uuid4().hex[:8]))
+            os.replace(v["path"], path)
+            trash.append(path)
+            logging.info("Pruning old version {} in {}".format(v["version"], root))
+    state = load_state(root)
+    state["history"] = [h for h in state["history"] if h["version"] in kept_names]
+    save_state(root, state)
+    if not trash:
+        return None
+
+    def delete():
+        for path in trash:
+            shutil.rmtree(path, ignore_errors=True)
+            logging.debug("Deleted pruned version: {}".format(path))
+
+    if not background:
+        delete()
+        return None
+    thread = threading.Thread(target=delete, name="hpackage-prune")
+    thread.start()
+    return thread
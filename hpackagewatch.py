@@ -0,0 +1,353 @@
+import os
+import sys
+import time
+import errno
+import select
+import shutil
+import struct
+import logging
+import importlib
+import threading
+import hpackagecopy
+import hpackagefilter
+import hpackagelib
+import hpackagelock
+import hpackageregistry
+import hpackageversions
+import settings
+
+logger = logging.getLogger(__name__)
+
+# inotify flags, from linux/inotify.h.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+# a batch of changes is applied once no new change arrived for settings.WATCH_DEBOUNCE seconds, but never later
+# than this after its first change, so a tool that writes constantly doesn't hold everything back.
+MAX_BATCH_DELAY = 0.5
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+def _join(base, name):
+    return "{}/{}".format(base, name) if base else name
+
+
+class SubtreeFilter(object):
+    """
+    Applies a payload filter to a scan of a directory below the payload root, where scan_tree reports paths
+    relative to that directory rather than to the payload.
+    """
+    def __init__(self, path_filter, prefix):
+        self.path_filter = path_filter
+        self.prefix = prefix
+
+    def excluded(self, rel, is_dir=False):
+        return self.path_filter.excluded(_join(self.prefix, rel), is_dir)
+
+
+def is_excluded(path_filter, rel, is_dir=False):
+    """
+    Return True if the payload filter leaves out rel, or any of the directories it's in.
+    """
+    if not path_filter:
+        return False
+    if path_filter.excluded(rel, is_dir):
+        return True
+    parts = rel.split("/")
+    return any(path_filter.excluded("/".join(parts[:i]), True) for i in range(1, len(parts)))
+
+
+def scan_subtree(root, rel, path_filter=None):
+    """
+    Walk the directory rel below the payload root, leaving out what the payload filter excludes.
+    :return: a tuple of (dirs, files) like hpackagecopy.scan_tree, relative to rel.
+    """
+    sub_filter = SubtreeFilter(path_filter, rel) if path_filter else None
+    return hpackagecopy.scan_tree(os.path.join(root, rel) if rel else root, sub_filter)
+
+
+class InotifyWatcher(object):
+    """
+    Watches a payload directory tree with Linux inotify, through ctypes. Every directory gets a watch, and new
+    directories are watched (and reported with their contents) as they appear.
+    """
+    def __init__(self, root, path_filter=None):
+        import ctypes
+        self.ctypes = ctypes
+        self.libc = _get_libc()
+        self.root = root
+        self.path_filter = path_filter
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = dict()
+        try:
+            self._add_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, rel):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, rel)), WATCH_MASK)
+        if wd < 0:
+            e = self.ctypes.get_errno()
+            if e in (errno.ENOSPC, errno.ENOMEM):
+                # out of inotify watches (fs.inotify.max_user_watches).
+                raise OSError(e, os.strerror(e))
+            # the directory is already gone again.
+            return
+        self.paths[wd] = rel
+
+    def _add_tree(self, rel):
+        """
+        Watch a directory and every directory below it.
+        :return: the relative paths of the files found below it.
+        """
+        self._add(rel)
+        dirs, files = scan_subtree(self.root, rel, self.path_filter)
+        for d in dirs:
+            self._add(_join(rel, d))
+        return [_join(rel, f) for f in files]
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for changes.
+        :return: the set of changed relative paths, or None if events were lost and everything has to be compared.
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                base = self.paths.get(wd)
+                if base is None or not name:
+                    continue
+                rel = _join(base, os.fsdecode(name))
+                is_dir = bool(mask & IN_ISDIR)
+                if is_excluded(self.path_filter, rel, is_dir):
+                    continue
+                changed.add(rel)
+                if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                    # files can land in a new directory before its watch exists.
+                    changed.update(self._add_tree(rel))
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """
+    Watches a payload directory tree by comparing os.scandir snapshots of every file's size, mtime and mode.
+    """
+    def __init__(self, root, path_filter=None, interval=None):
+        self.root = root
+        self.path_filter = path_filter
+        self.interval = settings.WATCH_INTERVAL if interval is None else interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        dirs, files = hpackagecopy.scan_tree(self.root, self.path_filter)
+        snapshot = {rel: (st.st_size, st.st_mtime_ns, st.st_mode) for rel, st in files.items()}
+        snapshot.update((d, None) for d in dirs)
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        old = self.snapshot
+        self.snapshot = snapshot
+        changed = set(rel for rel, key in snapshot.items() if old.get(rel, 0) != key)
+        changed.update(rel for rel in old if rel not in snapshot)
+        return changed
+
+    def close(self):
+        pass
+
+
+def get_watcher(root, path_filter=None):
+    """
+    Return an inotify watcher on Linux, or a polling watcher elsewhere (or if inotify isn't usable).
+    """
+    if sys.platform.startswith("linux") and not settings.WATCH_POLL:
+        try:
+            watcher = InotifyWatcher(root, path_filter)
+            logging.info("Watching {} with inotify ({} directories).".format(root, len(watcher.paths)))
+            return watcher
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify unavailable ({}), polling for changes instead.".format(e))
+    logging.info("Watching {} by polling every {} s.".format(root, settings.WATCH_INTERVAL))
+    return PollingWatcher(root, path_filter)
+
+
+def sync_paths(src, dst, rels, path_filter=None):
+    """
+    Bring the given relative paths in dst up to date with src: changed files are copied, new directories are
+    copied with their contents, and paths that don't exist in src anymore are removed from dst. Paths the payload
+    filter excludes are left alone on both sides.
+    :return: a dict with the number of files copied and paths deleted.
+    """
+    stats = {"copied": 0, "deleted": 0}
+    done = set()
+    # parents first, so a new directory exists before the files in it.
+    for rel in sorted(rels):
+        if rel in done:
+            continue
+        src_path = os.path.join(src, rel)
+        dst_path = os.path.join(dst, rel)
+        is_dir = os.path.isdir(src_path) if os.path.exists(src_path) else os.path.isdir(dst_path)
+        if is_excluded(path_filter, rel, is_dir):
+            logging.debug("Ignoring change to excluded path: {}".format(rel))
+            continue
+        try:
+            if os.path.isdir(src_path):
+                os.makedirs(dst_path, exist_ok=True)
+                dirs, files = scan_subtree(src, rel, path_filter)
+                for d in dirs:
+                    os.makedirs(os.path.join(dst_path, d), exist_ok=True)
+                for f, st in files.items():
+                    full = _join(rel, f)
+                    target = os.path.join(dst, full)
+                    done.add(full)
+                    if hpackagecopy.needs_copy(os.path.join(src, full), st, target):
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        hpackagecopy.atomic_copy(os.path.join(src, full), target)
+                        stats["copied"] += 1
+            elif os.path.isfile(src_path):
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                hpackagecopy.atomic_copy(src_path, dst_path)
+                stats["copied"] += 1
+                logging.debug("Synced changed file: {}".format(rel))
+            elif os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                shutil.rmtree(dst_path)
+                stats["deleted"] += 1
+                logging.debug("Removed deleted directory: {}".format(rel))
+            elif os.path.lexists(dst_path):
+                os.remove(dst_path)
+                stats["deleted"] += 1
+                logging.debug("Removed deleted file: {}".format(rel))
+        except FileNotFoundError:
+            # changed again while it was being copied. the next batch picks it up.
+            logging.debug("Path changed while syncing: {}".format(rel))
+    return stats
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+def watch(payload, destination, path_list, package=None, callback=None, stop=None):
+    """
+    Keep an installed payload in sync with the payload directory while developing it. Changes are batched, and
+    only the touched files and deletions are propagated. When settings.py or the package template changes, the
+    settings are reloaded and the package JSONs rewritten, if their contents changed.
+    :param payload: the payload directory.
+    :param destination: the install destination. for a versioned install, its active version is updated in place.
+    :param path_list: the Houdini configurations the package is installed to.
+    :param package: the package JSON template.
+    :param callback: called with a dict for every applied batch: the files copied and deleted, the package files
+                     written, and the latency in seconds from the first detected change until it was applied.
+    :param stop: a threading.Event that ends the watch. watches until interrupted if None.
+    """
+    if not os.path.isdir(payload):
+        raise ValueError("Watch mode needs a payload directory, not {}".format(payload))
+    stop = stop or threading.Event()
+    root = hpackageversions.get_active_path(destination)
+    if root != destination:
+        install_path = hpackageversions.get_install_path(destination, os.path.basename(root))
+    else:
+        install_path = destination
+    watcher = get_watcher(payload, hpackagefilter.get_payload_filter())
+    # the destination won't match the payload the marker describes anymore.
+    hpackagelock.clear_marker(root)
+    watched = [getattr(settings, "__file__", None), package]
+    mtimes = [_mtime(p) for p in watched]
+    package_hash = hpackageregistry.data_hash(hpackagelib.build_package_data(package, install_path))
+    pending = set()
+    first_change = None
+    rescan = False
+    try:
+        while not stop.is_set():
+            changed = watcher.poll(settings.WATCH_DEBOUNCE if (pending or rescan) else 0.5)
+            now = time.perf_counter()
+            if changed is None:
+                logging.warning("Missed some changes, comparing the whole payload.")
+                rescan = True
+                changed = set()
+            if changed:
+                pending |= changed
+                first_change = first_change or now
+                if now - first_change < MAX_BATCH_DELAY:
+                    continue
+            batch = {"copied": 0, "deleted": 0, "package_files": list(), "latency": 0.0}
+            if rescan:
+                stats = hpackagecopy.copy_tree(payload, root, sync=True, delete=True,
+                                               path_filter=hpackagefilter.get_payload_filter())
+                batch["copied"], batch["deleted"] = stats["copied"], stats["deleted"]
+                rescan = False
+                pending.clear()
+            if pending:
+                batch.update(sync_paths(payload, root, pending, hpackagefilter.get_payload_filter()))
+                pending.clear()
+
+            new_mtimes = [_mtime(p) for p in watched]
+            if new_mtimes != mtimes:
+                if new_mtimes[0] != mtimes[0]:
+                    logging.info("Settings changed, reloading them.")
+                    importlib.reload(settings)
+                mtimes = new_mtimes
+                data = hpackagelib.build_package_data(package, install_path)
+                if hpackageregistry.data_hash(data) != package_hash:
+                    package_hash = hpackageregistry.data_hash(data)
+                    batch["package_files"] = hpackagelib.write_package_files(path_list, data)
+
+            if batch["copied"] or batch["deleted"] or batch["package_files"]:
+                batch["latency"] = time.perf_counter() - (first_change or now)
+                logging.info("Synced {copied} files, deleted {deleted}, wrote {n} package files in {ms:.0f} ms.".format(
+                    n=len(batch["package_files"]), ms=batch["latency"] * 1000.0, **batch))
+                if callback:
+                    callback(batch)
+            first_change = None
+    finally:
+        watcher.close()
@@ -2,10 +2,42 @@
 # this should exist in the same path or in a parent path of the payload.
 NAME = "MOPs"
 
+# the version of the package, recorded in the installed-package registry. optional.
+# example: VERSION = "1.8.0"
+VERSION = ""
+
 # if you want to embed the plugin files into your executable, provide the path here.
 # example: PAYLOAD = "D:/Projects/MOPS"
 PAYLOAD = ""
 
+# if you don't embed the payload, it can be downloaded from an artifact server instead. this is the URL of the
+# manifest that hpackagemaker.py --publish writes next to the packed payload.
+# example: PAYLOAD_URL = "https://artifacts.example.com/MOPs/1.8.0/manifest.json"
+PAYLOAD_URL = ""
+
+# downloaded payloads are cached here, keyed by their content hash, so they're only downloaded once per machine.
+# defaults to a cache shared by all users (/var/tmp/hpackage/cache, /Users/Shared/hpackage/cache or
+# %PROGRAMDATA%/hpackage/cache).
+DOWNLOAD_CACHE = ""
+
+# number of parts of a payload downloaded at once, if the server supports range requests.
+DOWNLOAD_WORKERS = 8
+
+# if True, an embedded payload is packed into a single compressed archive that is only expanded at install time.
+# if False, the payload directory is embedded as loose files.
+PACK_PAYLOAD = True
+
+# gitignore-style rules for payload files, applied when the payload is embedded and when it's installed.
+# a pattern without a "/" matches a name at any depth, a trailing "/" only matches directories, "**" matches across
+# directories and "!" re-includes something an earlier rule excluded. files and directories in the install path
+# that match PAYLOAD_EXCLUDE are never deleted by SYNC_DELETE.
+# if PAYLOAD_INCLUDE isn't empty, only files that match it are installed.
+# example: PAYLOAD_INCLUDE = ["otls/", "python*libs/", "toolbar/", "*.json"]
+# by default only version control directories and bytecode are left out. to also leave out HDA backups and OS
+# clutter, add e.g. "backup/", "*.bak", ".DS_Store" and "Thumbs.db" -- but not if the package ships a backup folder.
+PAYLOAD_INCLUDE = []
+PAYLOAD_EXCLUDE = [".git/", ".svn/", ".hg/", "__pycache__/", "*.pyc"]
+
 # if you want to build to a different location than the location of this file, provide a path here.
 # example: OUTPUT = "D:/Projects/MOPS/hpackage"
 OUTPUT = ""
@@ -19,6 +51,17 @@ PATH_VARS = []
 # this is a dictionary, i.e. OTHER_VARS = {"HOUDINI_PYTHONWARNINGS: "ignore", "load_package_once": true}
 OTHER_VARS = {}
 
+# to ship several packages in one installer, list them here. each entry sets NAME, PAYLOAD, PAYLOAD_URL, PATH_VARS,
+# OTHER_VARS and VERSION for one package, like the settings above do for a single package; NAME above then names the
+# bundle. every package is installed into its own <NAME> directory below the chosen install path, and the user can
+# pick which ones to install.
+# example: PACKAGES = [{"NAME": "MOPs", "PAYLOAD": "D:/Projects/MOPS", "PATH_VARS": ["MOPS"]},
+#                      {"NAME": "MOPsPlus", "PAYLOAD": "D:/Projects/MOPSPLUS", "PATH_VARS": ["MOPSPLUS"]}]
+PACKAGES = []
+
+# number of home directories processed at once by a fleet install (hpackagecli.py --homes).
+FLEET_WORKERS = 32
+
 # if your package is version-limited, you can whitelist supported major/minor versions here.
 # if it's empty, all found versions of houdini will be available for the package install UI.
 # example: SUPPORTED_VERSIONS = ["20.5", "20.0", "19.5"]
@@ -46,9 +89,108 @@ SUCCESS = "MOPs has been successfully installed!"
 # if True, the package won't actually copy any files or create/modify any packages
 DEBUG = False
 
-# these are currently nonfunctional
+# if set, a Chrome trace (chrome://tracing, ui.perfetto.dev) of the install phases is written to this path.
+# can also be set with the HPACKAGE_TRACE environment variable.
+TRACE_PATH = ""
+
+# if set, the installer runs under cProfile and saves the stats to this path.
+# can also be set with the HPACKAGE_PROFILE environment variable.
+PROFILE_PATH = ""
+
+# if True, reinstalling only copies payload files that are new or have changed since the last install.
+# if False, the whole payload is copied every time.
+SYNC = True
+
+# if True (and SYNC is enabled), files that were removed from the payload are also removed from the install path.
+SYNC_DELETE = False
+
+# optional shared content-addressed object store. if set, payload files are stored once under this root, keyed by
+# their content hash, and the install path is built out of hardlinks (or symlinks across devices) into the store.
+# installing another version of the package then only writes the files that changed. objects are read-only, since
+# every install links to the same files; one that was changed anyway is replaced when it's linked again, or by an
+# install with --force.
+# example: STORE_ROOT = "/mnt/tools/hpackage_store"
+STORE_ROOT = ""
+
+# where the registry of installed packages is kept. defaults to ~/.hpackage/registry.json.
+# the registry records what was installed where, so "--status" is a single file read, and reinstalling an
+# identical payload skips the copy.
+REGISTRY_PATH = ""
+
+# if True, every payload is installed into its own directory under <destination>/versions, and the package JSONs
+# reference a <destination>/current symlink that's switched to the new version once it's fully copied. artists with
+# Houdini open keep using the old version, and switching or rolling back doesn't copy anything.
+VERSIONED_INSTALLS = False
+
+# number of installed versions to keep when VERSIONED_INSTALLS is on. older ones are deleted in the background.
+# 0 keeps every version.
+KEEP_VERSIONS = 3
+
+# if True, the payload's Python files are compiled to bytecode at install time, so Houdini doesn't have to compile
+# them on every launch (or can't, because the install path is read-only). the Python interpreters of the installed
+# Houdini versions matching the selected configurations are used; if none are found, the installer's own is.
+PRECOMPILE = False
+
+# Houdini Python interpreters to precompile with, instead of searching the default install locations.
+# example: HOUDINI_PYTHONS = {"20.5": "C:/Program Files/Side Effects Software/Houdini 20.5.370/python311/python.exe"}
+HOUDINI_PYTHONS = {}
+
+# if True, the install is checked against the payload's content manifest after copying, and files that don't match
+# (e.g. truncated by a flaky network share) are copied again. only the files copied in this run are hashed; the
+# ones the sync left alone are checked by size. hpackagecli.py --verify hashes everything.
+VERIFY_INSTALL = True
+
+# installers copying to the same destination at the same time (e.g. a farm rolling out to a shared network path)
+# take turns through a lock file in the destination: the first one copies, the others wait and then only write their
+# package JSONs. this is how long, in seconds, to wait for another installer before giving up. 0 waits indefinitely;
+# a lock left behind by a crashed installer is taken over after a minute either way.
+LOCK_TIMEOUT = 0
+
+# watch mode (hpackagecli.py --watch) keeps an install in sync with the payload while you develop it. changes are
+# applied once no new change arrived for WATCH_DEBOUNCE seconds. on Linux, changes are picked up with inotify;
+# elsewhere (or with WATCH_POLL = True) the payload is rescanned every WATCH_INTERVAL seconds.
+WATCH_DEBOUNCE = 0.1
+WATCH_INTERVAL = 0.25
+WATCH_POLL = False
+
+# how payload files are copied. "parallel" copies files on a thread pool, "serial" copies them one at a time.
+COPY_ENGINE = "parallel"
+
+# number of copy threads for the parallel engine. 0 picks a default based on the number of CPUs.
+COPY_WORKERS = 0
+
+# binaries left out of the built installer, as filename patterns (e.g. "Qt6Pdf*") or, if they contain a "/",
+# patterns matched against the end of the bundled path (e.g. "plugins/imageformats/*svg*").
+# the list for the current platform is combined with CUSTOM_EXCLUDE_LIST, which applies everywhere.
 CUSTOM_EXCLUDE_LIST = []
-WINDOWS_EXCLUDE_LIST = ['opengl32sw.dll', 'Qt5Network.dll', 'Qt5Pdf.dll', 'Qt5Qml.dll', 'Qt5QmlModels.dll', 'Qt5Quick.dll', 'Qt5Svg.dll', 'Qt5VirtualKeyboard.dll', 'Qt5WebSockets.dll']
+WINDOWS_EXCLUDE_LIST = ['opengl32sw.dll', 'Qt6Network.dll', 'Qt6Pdf.dll', 'Qt6Qml.dll', 'Qt6QmlModels.dll',
+                        'Qt6QmlMeta.dll', 'Qt6QmlWorkerScript.dll', 'Qt6Quick.dll', 'Qt6Svg.dll',
+                        'Qt6VirtualKeyboard.dll', 'Qt6WebSockets.dll', 'Qt6OpenGL.dll', 'd3dcompiler_47.dll',
+                        'plugins/imageformats/*svg*', 'plugins/imageformats/*tiff*', 'plugins/imageformats/*webp*',
+                        'plugins/imageformats/*icns*', 'plugins/imageformats/*tga*', 'plugins/imageformats/*wbmp*',
+                        'plugins/iconengines/*', 'plugins/networkinformation/*', 'plugins/tls/*',
+                        'plugins/generic/*', 'translations/*']
+LINUX_EXCLUDE_LIST = ['libQt6Network.so*', 'libQt6Pdf.so*', 'libQt6Qml*.so*', 'libQt6Quick*.so*',
+                      'libQt6Svg.so*', 'libQt6VirtualKeyboard.so*', 'libQt6WebSockets.so*', 'libQt6OpenGL.so*',
+                      'libQt6EglFSDeviceIntegration.so*', 'libQt6EglFsKmsSupport.so*', 'libQt6EglFsKmsGbmSupport.so*',
+                      'libQt6WaylandClient.so*', 'libQt6WaylandEglClientHwIntegration.so*', 'libQt6WlShellIntegration.so*',
+                      'plugins/platforms/libqeglfs.so', 'plugins/platforms/libqlinuxfb.so',
+                      'plugins/platforms/libqminimalegl.so', 'plugins/platforms/libqvnc.so',
+                      'plugins/platforms/libqvkkhrdisplay.so', 'plugins/platforms/libqwayland*.so',
+                      'plugins/imageformats/*svg*', 'plugins/imageformats/*tiff*', 'plugins/imageformats/*webp*',
+                      'plugins/imageformats/*icns*', 'plugins/imageformats/*tga*', 'plugins/imageformats/*wbmp*',
+                      'plugins/iconengines/*', 'plugins/platforminputcontexts/*', 'plugins/egldeviceintegrations/*',
+                      'plugins/wayland-*/*', 'plugins/networkinformation/*', 'plugins/tls/*', 'plugins/generic/*',
+                      'translations/*']
+MACOS_EXCLUDE_LIST = ['QtNetwork', 'QtPdf', 'QtQml*', 'QtQuick*', 'QtSvg', 'QtVirtualKeyboard', 'QtWebSockets',
+                      'QtOpenGL', 'plugins/imageformats/*svg*', 'plugins/imageformats/*tiff*',
+                      'plugins/imageformats/*webp*', 'plugins/imageformats/*tga*', 'plugins/imageformats/*wbmp*',
+                      'plugins/iconengines/*', 'plugins/networkinformation/*', 'plugins/tls/*', 'plugins/generic/*',
+                      'translations/*']
+
+# python modules that are never bundled into the installer.
+EXCLUDE_MODULES = ['tkinter', 'unittest', 'pydoc', 'PySide6.QtNetwork', 'PySide6.QtQml', 'PySide6.QtQuick',
+                   'PySide6.QtSvg', 'PySide6.QtOpenGL', 'PyInstaller']
 
 # probably don't change this
 LABELWIDTH = 800
\ No newline at end of file
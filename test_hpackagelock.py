@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import hpackagecopy
+import hpackagelock
+
+
+class EmptyLockTest(unittest.TestCase):
+    """
+    A lock file left empty or half written by a crashed installer has to go stale like any other lock.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, hpackagecopy.LOCK_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_lock(self, contents, age):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        then = time.time() - age
+        os.utime(self.path, (then, then))
+
+    def test_old_empty_lock_is_stale(self):
+        self.write_lock("", 600)
+        owner = hpackagelock.read_owner(self.path)
+        self.assertTrue(hpackagelock.is_stale(owner))
+
+    def test_fresh_empty_lock_is_held(self):
+        self.write_lock("", 0)
+        owner = hpackagelock.read_owner(self.path)
+        self.assertFalse(hpackagelock.is_stale(owner))
+
+    def test_old_corrupt_lock_is_taken_over(self):
+        self.write_lock('{"host": "a', 600)
+        lock = hpackagelock.InstallLock(self.root, timeout=5)
+        start = time.perf_counter()
+        lock.acquire()
+        try:
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.assertEqual(hpackagelock.read_owner(self.path)["token"], lock.owner["token"])
+        finally:
+            lock.release()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class BreakRaceTest(unittest.TestCase):
+    """
+    Breaking a lock that was replaced in the meantime must not clobber the lock of yet another installer.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def break_with_third_installer(self):
+        live = hpackagelock.InstallLock(self.root)
+        self.assertTrue(live._try_create())
+        third = hpackagelock.InstallLock(self.root)
+        real_read_owner = hpackagelock.read_owner
+
+        def read_owner(path):
+            # the live lock has just been renamed away. a third installer finds the path free and takes the lock.
+            if path != third.path and third.owner is None:
+                self.assertTrue(third._try_create())
+            return real_read_owner(path)
+
+        breaker = hpackagelock.InstallLock(self.root)
+        with mock.patch.object(hpackagelock, "read_owner", read_owner):
+            breaker._break({"token": "crashed"})
+        return third
+
+    def test_third_lock_is_kept(self):
+        third = self.break_with_third_installer()
+        self.assertEqual(hpackagelock.read_owner(third.path)["token"], third.owner["token"])
+        self.assertEqual(os.listdir(self.root), [hpackagecopy.LOCK_NAME])
+
+    def test_third_lock_is_kept_without_hard_links(self):
+        with mock.patch("os.link", side_effect=OSError(1, "Operation not permitted")):
+            third = self.break_with_third_installer()
+        self.assertEqual(hpackagelock.read_owner(third.path)["token"], third.owner["token"])
+        self.assertEqual(os.listdir(self.root), [hpackagecopy.LOCK_NAME])
+
+    def test_live_lock_is_restored(self):
+        live = hpackagelock.InstallLock(self.root)
+        self.assertTrue(live._try_create())
+        hpackagelock.InstallLock(self.root)._break({"token": "crashed"})
+        self.assertEqual(hpackagelock.read_owner(live.path)["token"], live.owner["token"])
+        self.assertEqual(os.listdir(self.root), [hpackagecopy.LOCK_NAME])
+
+
+if __name__ == "__main__":
+    unittest.main()
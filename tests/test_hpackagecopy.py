@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import hpackagecopy
+
+
+class ShortCopyTest(unittest.TestCase):
+    """
+    A kernel-side copy that stops before the end of the file must not leave a truncated destination behind.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "tool.hda")
+        self.dst = os.path.join(self.tmp, "copy.hda")
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(256 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def copy_stopping_after(self, name, limit):
+        real = getattr(os, name)
+        copied = [0]
+
+        def stop_early(*args):
+            # copy the first part for real, then report the end of the file.
+            args = list(args)
+            count = min(args[-1], limit - copied[0])
+            if count <= 0:
+                return 0
+            args[-1] = count
+            sent = real(*args)
+            copied[0] += sent
+            return sent
+
+        methods = [m for m in hpackagecopy.get_fast_copy_methods() if m[0] == name]
+        if not methods:
+            self.skipTest("{} is not available".format(name))
+        with mock.patch.object(hpackagecopy, "FAST_COPY_METHODS", methods), mock.patch("os." + name, stop_early):
+            return hpackagecopy.copy_file(self.src, self.dst)
+
+    def assertFullCopy(self, method):
+        self.assertEqual(method, "buffered")
+        self.assertEqual(hpackagecopy.file_digest(self.dst), hpackagecopy.file_digest(self.src))
+
+    def test_short_copy_file_range(self):
+        self.assertFullCopy(self.copy_stopping_after("copy_file_range", 100 * 1024))
+
+    def test_short_sendfile(self):
+        self.assertFullCopy(self.copy_stopping_after("sendfile", 100 * 1024))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+from unittest import mock
+import hpackagecopy
+import hpackagefetch
+import hpackagepack
+
+
+class PayloadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files in the server's directory, with Range requests if the server allows them. http.server's own
+    handler ignores Range headers.
+    """
+    def do_GET(self):
+        path = os.path.join(self.server.directory, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range") or "")
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, start + len(body) - 1, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+    """
+    Downloads a packed payload from a local http.server, with and without range support.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        payload = os.path.join(self.tmp, "payload")
+        os.makedirs(os.path.join(payload, "otls"))
+        for i in range(4):
+            with open(os.path.join(payload, "otls", "tool{}.hda".format(i)), 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+        self.published = os.path.join(self.tmp, "published")
+        self.archive = os.path.join(self.published, hpackagepack.PACK_NAME)
+        hpackagepack.pack_payload(payload, self.archive)
+        self.manifest_path = hpackagefetch.write_manifest(self.archive)
+        self.cache = os.path.join(self.tmp, "cache")
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def serve(self, ranges):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PayloadHandler)
+        self.server.directory = self.published
+        self.server.ranges = ranges
+        self.server.requests = list()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{}/{}".format(self.server.server_port, hpackagefetch.MANIFEST_NAME)
+
+    def fetch(self, url):
+        # small parts, so the test payload is downloaded in several of them.
+        with mock.patch.object(hpackagefetch, "MIN_PART_SIZE", 32 * 1024):
+            return hpackagefetch.fetch_payload(url, self.cache, workers=4)
+
+    def archive_requests(self):
+        return [r for r in self.server.requests if r[0].endswith(hpackagepack.PACK_EXTENSION)]
+
+    def test_ranged_download(self):
+        cached = self.fetch(self.serve(ranges=True))
+        self.assertEqual(hpackagecopy.file_digest(cached), hpackagecopy.file_digest(self.archive))
+        ranges = [r for path, r in self.archive_requests() if r and r != "bytes=0-0"]
+        self.assertEqual(len(ranges), 4)
+
+    def test_download_without_ranges(self):
+        cached = self.fetch(self.serve(ranges=False))
+        self.assertEqual(hpackagecopy.file_digest(cached), hpackagecopy.file_digest(self.archive))
+        # the probe, then one plain GET.
+        self.assertEqual([r for path, r in self.archive_requests()], ["bytes=0-0", None])
+
+    def test_cache_hit(self):
+        url = self.serve(ranges=True)
+        first = self.fetch(url)
+        del self.server.requests[:]
+        self.assertEqual(self.fetch(url), first)
+        self.assertEqual(self.archive_requests(), [])
+
+    def test_corrupt_download(self):
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+        manifest["hash"] = "0" * 32
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        with self.assertRaises(IOError):
+            self.fetch(self.serve(ranges=True))
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_planted_cache_file_is_replaced(self):
+        url = self.serve(ranges=True)
+        manifest = hpackagefetch.read_manifest(url)
+        os.makedirs(self.cache)
+        planted = os.path.join(self.cache, manifest["hash"] + hpackagepack.PACK_EXTENSION)
+        with open(planted, 'wb') as f:
+            f.write(b"\0" * manifest["size"])
+        cached = self.fetch(url)
+        self.assertEqual(hpackagecopy.file_digest(cached), manifest["hash"])
+
+    def test_other_users_copy_is_used(self):
+        url = self.serve(ranges=True)
+        manifest = hpackagefetch.read_manifest(url)
+        cached = os.path.join(self.cache, manifest["hash"] + hpackagepack.PACK_EXTENSION)
+        replace = os.replace
+
+        def replace_denied(src, dst):
+            if dst == cached:
+                # another user finished the same download just before us, and the sticky shared cache doesn't
+                # let this user replace their file.
+                shutil.copyfile(src, cached)
+                raise PermissionError(1, "Operation not permitted", dst)
+            return replace(src, dst)
+
+        with mock.patch("os.replace", replace_denied):
+            self.assertEqual(self.fetch(url), cached)
+        self.assertEqual(hpackagecopy.file_digest(cached), manifest["hash"])
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(cached)])
+
+
+if __name__ == "__main__":
+    unittest.main()
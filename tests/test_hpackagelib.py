@@ -0,0 +1,53 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import hpackagelib
+import hpackageregistry
+import settings
+
+
+class BundleFailureTest(unittest.TestCase):
+    """
+    A package of a bundle that fails to install must not cost the others their package files or registry entries.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = os.path.join(self.tmp, "houdini20.5")
+        os.makedirs(self.config)
+        self.destination = os.path.join(self.tmp, "tools")
+        self.registry_path = os.path.join(self.tmp, "registry.json")
+        packages = list()
+        for name in ("Good", "AlsoGood"):
+            payload = os.path.join(self.tmp, "payloads", name)
+            os.makedirs(os.path.join(payload, "otls"))
+            with open(os.path.join(payload, "otls", "tool.hda"), 'wb') as f:
+                f.write(os.urandom(1024))
+            packages.append({"NAME": name, "PAYLOAD": payload})
+        packages.append({"NAME": "Missing", "PAYLOAD": os.path.join(self.tmp, "payloads", "Missing")})
+        self.patches = [mock.patch.object(settings, "PACKAGES", packages),
+                        mock.patch.object(settings, "REGISTRY_PATH", self.registry_path)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_installed_packages_are_recorded(self):
+        with self.assertRaises(IOError):
+            hpackagelib.install_packages([self.config], hpackagelib.get_package_specs(), self.destination)
+        registry = hpackageregistry.load()
+        self.assertEqual(sorted(registry["packages"]), ["AlsoGood", "Good"])
+        for name in ("Good", "AlsoGood"):
+            package_file = hpackagelib.get_package_file(self.config, name)
+            with open(package_file, 'r') as f:
+                self.assertIn(name, json.dumps(json.load(f)))
+            self.assertIn(hpackageregistry._normalize(self.config), registry["packages"][name]["configs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
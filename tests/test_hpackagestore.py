@@ -0,0 +1,67 @@
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+import hpackagecopy
+import hpackagestore
+
+
+class StoreRepairTest(unittest.TestCase):
+    """
+    Installs link to shared store objects, so a file edited in place through one install must not stick.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.payload = os.path.join(self.tmp, "payload")
+        self.store = os.path.join(self.tmp, "store")
+        os.makedirs(os.path.join(self.payload, "otls"))
+        for name in ("a.hda", "b.hda"):
+            with open(os.path.join(self.payload, "otls", name), 'wb') as f:
+                f.write(name.encode("utf-8") * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def install(self, name, force=False):
+        dst = os.path.join(self.tmp, name)
+        hpackagestore.install_from_store(self.payload, dst, self.store, force=force)
+        return dst
+
+    def edit_in_place(self, path):
+        # writable or not, root can write to it anyway; this is what a careless edit through an install does.
+        os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | stat.S_IWUSR)
+        with open(path, 'r+b') as f:
+            f.write(b"broken")
+
+    def assert_matches_payload(self, dst):
+        for name in ("a.hda", "b.hda"):
+            self.assertEqual(hpackagecopy.file_digest(os.path.join(dst, "otls", name)),
+                             hpackagecopy.file_digest(os.path.join(self.payload, "otls", name)))
+
+    def test_objects_are_read_only(self):
+        dst = self.install("one")
+        digest = hpackagecopy.file_digest(os.path.join(self.payload, "otls", "a.hda"))
+        mode = os.stat(hpackagestore.object_path(self.store, digest)).st_mode
+        self.assertFalse(mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        self.assertTrue(hpackagestore.is_linked(hpackagestore.object_path(self.store, digest),
+                                                os.path.join(dst, "otls", "a.hda")))
+
+    def test_edited_install_is_repaired(self):
+        one = self.install("one")
+        two = self.install("two")
+        self.edit_in_place(os.path.join(one, "otls", "a.hda"))
+
+        # a new install doesn't link the damaged object.
+        three = self.install("three")
+        self.assert_matches_payload(three)
+
+        # --force checks the linked objects and relinks the damaged installs.
+        self.install("one", force=True)
+        self.install("two", force=True)
+        self.assert_matches_payload(one)
+        self.assert_matches_payload(two)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import hpackagefilter
+import hpackagewatch
+
+
+class MoveDirectoryInTest(unittest.TestCase):
+    """
+    A directory moved into a watched payload is synced without the files the payload rules exclude.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.payload = os.path.join(self.tmp, "payload")
+        self.dst = os.path.join(self.tmp, "dst")
+        os.makedirs(os.path.join(self.payload, "python"))
+        os.makedirs(self.dst)
+        self.path_filter = hpackagefilter.get_payload_filter([], ["__pycache__/", "*.pyc"])
+        # build the directory outside of the payload, to move it in at once.
+        self.incoming = os.path.join(self.tmp, "tools")
+        os.makedirs(os.path.join(self.incoming, "__pycache__"))
+        os.makedirs(os.path.join(self.incoming, "sub"))
+        for rel in ("tool.py", "__pycache__/tool.cpython-311.pyc", "sub/helper.py", "sub/stale.pyc"):
+            with open(os.path.join(self.incoming, rel), 'w') as f:
+                f.write(rel)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assert_synced(self):
+        dst = os.path.join(self.dst, "python", "tools")
+        self.assertTrue(os.path.isfile(os.path.join(dst, "tool.py")))
+        self.assertTrue(os.path.isfile(os.path.join(dst, "sub", "helper.py")))
+        self.assertFalse(os.path.exists(os.path.join(dst, "__pycache__")))
+        self.assertFalse(os.path.exists(os.path.join(dst, "sub", "stale.pyc")))
+
+    def move_in(self):
+        os.rename(self.incoming, os.path.join(self.payload, "python", "tools"))
+
+    def watch_once(self, watcher):
+        try:
+            self.move_in()
+            changed = set()
+            for _ in range(20):
+                changed |= watcher.poll(0.05)
+                if changed and not watcher.poll(0.05):
+                    break
+        finally:
+            watcher.close()
+        self.assertTrue(changed)
+        self.assertFalse([rel for rel in changed if "__pycache__" in rel or rel.endswith(".pyc")])
+        hpackagewatch.sync_paths(self.payload, self.dst, changed, self.path_filter)
+        self.assert_synced()
+
+    def test_sync_paths(self):
+        self.move_in()
+        rels = ["python/tools", "python/tools/__pycache__", "python/tools/__pycache__/tool.cpython-311.pyc",
+                "python/tools/sub/stale.pyc"]
+        hpackagewatch.sync_paths(self.payload, self.dst, rels, self.path_filter)
+        self.assert_synced()
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+    def test_inotify(self):
+        self.watch_once(hpackagewatch.InotifyWatcher(self.payload, self.path_filter))
+
+    def test_polling(self):
+        self.watch_once(hpackagewatch.PollingWatcher(self.payload, self.path_filter, interval=0.05))
+
+
+if __name__ == "__main__":
+    unittest.main()